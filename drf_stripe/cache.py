@@ -0,0 +1,38 @@
+import logging
+
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+
+from .settings import drf_stripe_settings
+
+logger = logging.getLogger(__name__)
+
+"""
+Cache backends keeping entries in each process. A version replaced by one process would not be seen by the others,
+which would keep serving stale entries, so these backends are not used.
+"""
+_PER_PROCESS_BACKENDS = (DummyCache, LocMemCache)
+
+_warned_settings = set()
+
+
+def get_shared_cache(setting: str):
+    """
+    Returns the Django cache whose alias is the value of a DRF_STRIPE setting, or None if the setting is None or the
+    cache is not shared between processes, ie: LocMemCache or DummyCache. A warning is logged for the latter.
+
+    :param str setting: name of the setting, ie: "ENTITLEMENT_CACHE".
+    """
+    alias = getattr(drf_stripe_settings, setting)
+    if not alias:
+        return None
+
+    cache = caches[alias]
+    if isinstance(cache, _PER_PROCESS_BACKENDS):
+        if (setting, alias) not in _warned_settings:
+            _warned_settings.add((setting, alias))
+            logger.warning("%s cache '%s' uses %s, which is not shared between processes. Caching is disabled, "
+                           "use a shared cache such as Redis or Memcached.", setting, alias, type(cache).__name__)
+        return None
+    return cache
@@ -0,0 +1,127 @@
+import threading
+from typing import NamedTuple, Optional, Tuple
+from uuid import uuid4
+
+from django.db import transaction
+
+from .cache import get_shared_cache
+from .settings import drf_stripe_settings
+from .stripe_api.subscriptions import list_all_available_product_prices
+
+"""
+The catalog snapshot is an immutable copy of the available products, prices and features, kept in each process.
+A version shared through Django's cache is replaced whenever products, prices or features are written, and processes
+reload their snapshot the next time they find a version different from the snapshot's. The version expires after
+CATALOG_CACHE_TIMEOUT, so changes made without replacing it are seen within that time.
+"""
+_VERSION_KEY = "drf_stripe:catalog:version"
+
+_snapshot = None
+_snapshot_lock = threading.Lock()
+
+
+class FeatureRecord(NamedTuple):
+    """A Feature provided by a product in the catalog snapshot."""
+    feature_id: str
+    description: Optional[str]
+
+
+class ProductRecord(NamedTuple):
+    """An active Product in the catalog snapshot."""
+    product_id: str
+    name: Optional[str]
+    description: Optional[str]
+    features: Tuple[FeatureRecord, ...]
+
+
+class PriceRecord(NamedTuple):
+    """An active Price of an active Product in the catalog snapshot."""
+    price_id: str
+    product: ProductRecord
+    nickname: Optional[str]
+    price: int
+    freq: Optional[str]
+    active: bool
+    currency: str
+
+
+class CatalogSnapshot(NamedTuple):
+    """Available products and prices, loaded when the catalog had the given version."""
+    version: Optional[str]
+    products: Tuple[ProductRecord, ...]
+    prices: Tuple[PriceRecord, ...]
+
+
+def get_catalog_snapshot() -> CatalogSnapshot:
+    """
+    Returns the catalog snapshot of this process, reloading it from the database if the catalog changed since it was
+    loaded. When the catalog has not changed, no database query is made.
+    When CATALOG_CACHE is not set, or is not shared between processes, the snapshot is reloaded on every call.
+    """
+    global _snapshot
+
+    version = _get_version()
+    snapshot = _snapshot
+    if version is not None and snapshot is not None and snapshot.version == version:
+        return snapshot
+
+    with _snapshot_lock:
+        # another thread may have reloaded the snapshot while this one waited for the lock
+        if version is not None and _snapshot is not None and _snapshot.version == version:
+            return _snapshot
+        snapshot = _load_catalog_snapshot(version)
+        if version is not None:
+            _snapshot = snapshot
+    return snapshot
+
+
+def invalidate_catalog_snapshot():
+    """
+    Replace the catalog version, so that every process reloads its snapshot. Called after products, prices or features
+    are written by webhooks and the sync functions. Call it after editing them directly in the database.
+    """
+    if _get_cache() is None:
+        return
+    _set_new_version()
+    # snapshots loaded by other processes before the current transaction commits are stale, replace again
+    transaction.on_commit(_set_new_version)
+
+
+def _load_catalog_snapshot(version: Optional[str]) -> CatalogSnapshot:
+    """Query the available products, prices and features."""
+    products = {}
+    prices = []
+    for price in list_all_available_product_prices(expand=["feature"]):
+        product = products.get(price.product_id)
+        if product is None:
+            product = products[price.product_id] = ProductRecord(
+                product_id=price.product.product_id,
+                name=price.product.name,
+                description=price.product.description,
+                features=tuple(FeatureRecord(feature_id=link.feature.feature_id, description=link.feature.description)
+                               for link in price.product.linked_features.all())
+            )
+        prices.append(PriceRecord(price_id=price.price_id, product=product, nickname=price.nickname,
+                                  price=price.price, freq=price.freq, active=price.active, currency=price.currency))
+
+    return CatalogSnapshot(version=version, products=tuple(products.values()), prices=tuple(prices))
+
+
+def _get_cache():
+    return get_shared_cache("CATALOG_CACHE")
+
+
+def _get_version() -> Optional[str]:
+    cache = _get_cache()
+    if cache is None:
+        return None
+    version = cache.get(_VERSION_KEY)
+    if version is None:
+        version = uuid4().hex
+        if not cache.add(_VERSION_KEY, version, drf_stripe_settings.CATALOG_CACHE_TIMEOUT):
+            version = cache.get(_VERSION_KEY) or version
+    return version
+
+
+def _set_new_version():
+    _get_cache().set(_VERSION_KEY, uuid4().hex, drf_stripe_settings.CATALOG_CACHE_TIMEOUT)
@@ -0,0 +1,232 @@
+import time
+from functools import partial
+from typing import Collection, FrozenSet, Iterable, List, NamedTuple
+from uuid import uuid4
+
+from django.db import transaction
+from django.db.models import Max
+
+from .cache import get_shared_cache
+from .models import ProductFeature, StripeUser, Subscription, SubscriptionItem, UserEntitlement
+from .settings import drf_stripe_settings
+from .stripe_models.subscription import ACCESS_GRANTING_STATUSES
+
+"""
+Cached entitlements are keyed by user id, a per-user version and a catalog version. Versions are random tokens
+replaced when a user's subscriptions change, or when links between products and features change. Replacing a version
+orphans the entries computed before, so no entry has to be deleted, and an evicted version can never bring a stale
+entry back, as a restarted counter could.
+"""
+_KEY_PREFIX = "drf_stripe:entitlements"
+_CATALOG_VERSION_KEY = f"{_KEY_PREFIX}:catalog_version"
+
+_LOCK_TIMEOUT = 10  # seconds before a lock left by a crashed process expires
+_LOCK_WAIT = 0.05  # seconds between checks for entitlements computed by the process holding the lock
+_LOCK_WAIT_ATTEMPTS = 20
+
+
+class Entitlements(NamedTuple):
+    """
+    Ids of the products and features a user has access to through subscriptions granting access, and whether the user
+    has such a subscription, with or without items.
+    """
+    product_ids: FrozenSet[str]
+    feature_ids: FrozenSet[str]
+    has_active_subscription: bool = False
+
+
+def get_user_entitlements(user_id) -> Entitlements:
+    """
+    Returns the entitlements of a user, from the cache when possible.
+    On a cache miss, a single process computes the entitlements while others wait for them to be cached, instead of
+    every concurrent request querying the database.
+
+    :param user_id: primary key of the StripeUser, ie: the Django user id.
+    """
+    cache = _get_cache()
+    if cache is None:
+        return _load_user_entitlements(user_id)
+
+    key = _get_entitlements_key(cache, user_id)
+    entitlements = cache.get(key)
+    if entitlements is not None:
+        return entitlements
+
+    lock_key = f"{key}:lock"
+    if not cache.add(lock_key, True, _LOCK_TIMEOUT):
+        for _ in range(_LOCK_WAIT_ATTEMPTS):
+            time.sleep(_LOCK_WAIT)
+            entitlements = cache.get(key)
+            if entitlements is not None:
+                return entitlements
+        return _load_user_entitlements(user_id)
+
+    try:
+        entitlements = _load_user_entitlements(user_id)
+        cache.set(key, entitlements, drf_stripe_settings.ENTITLEMENT_CACHE_TIMEOUT)
+    finally:
+        cache.delete(lock_key)
+    return entitlements
+
+
+def refresh_user_entitlements(user_ids: Iterable):
+    """
+    Update UserEntitlement rows of users whose subscriptions or subscription items changed, and invalidate their
+    cached entitlements. Called from the subscription write paths, inside their transaction.
+
+    :param user_ids: primary keys of the StripeUsers.
+    """
+    user_ids = set(user_ids)
+    _update_entitlement_rows(user_ids)
+    invalidate_user_entitlements(user_ids)
+
+
+def refresh_product_entitlements(product_ids: Collection[str], batch_size: int = 1000):
+    """
+    Update UserEntitlement rows of users subscribed to products whose features changed, and invalidate cached
+    entitlements of all users.
+
+    :param product_ids: primary keys of the Products.
+    :param int batch_size: number of users whose rows are updated at a time.
+    """
+    user_ids = sorted(set(SubscriptionItem.objects.filter(
+        price__product_id__in=product_ids, subscription__status__in=ACCESS_GRANTING_STATUSES
+    ).values_list("subscription__stripe_user_id", flat=True)))
+    for start in range(0, len(user_ids), batch_size):
+        _update_entitlement_rows(user_ids[start:start + batch_size])
+    invalidate_catalog_entitlements()
+
+
+def rebuild_user_entitlements(batch_size: int = 1000) -> int:
+    """
+    Rebuild UserEntitlement rows of all users from their subscriptions, one batch of users per transaction.
+
+    Called from management command.
+
+    :param int batch_size: number of users whose rows are rebuilt per transaction.
+    :return: number of UserEntitlement rows.
+    """
+    last_user_id = None
+    while True:
+        users = StripeUser.objects.order_by("pk")
+        if last_user_id is not None:
+            users = users.filter(pk__gt=last_user_id)
+        user_ids = list(users.values_list("pk", flat=True)[:batch_size])
+        if not user_ids:
+            break
+        with transaction.atomic():
+            _update_entitlement_rows(user_ids)
+        last_user_id = user_ids[-1]
+
+    invalidate_catalog_entitlements()
+    return UserEntitlement.objects.count()
+
+
+def invalidate_user_entitlements(user_ids: Iterable):
+    """
+    Invalidate cached entitlements of users whose subscriptions or subscription items changed.
+
+    :param user_ids: primary keys of the StripeUsers.
+    """
+    _replace_versions([_get_user_version_key(user_id) for user_id in set(user_ids)])
+
+
+def invalidate_catalog_entitlements():
+    """Invalidate cached entitlements of all users, after the features linked to products changed."""
+    _replace_versions([_CATALOG_VERSION_KEY])
+
+
+def _load_user_entitlements(user_id) -> Entitlements:
+    """Query the entitlements of a user."""
+    # subscriptions without items are listed with a None product id
+    subscribed_product_ids = list(Subscription.objects.filter(
+        stripe_user_id=user_id, status__in=ACCESS_GRANTING_STATUSES
+    ).values_list("items__price__product_id", flat=True))
+    product_ids = frozenset(product_id for product_id in subscribed_product_ids if product_id is not None)
+    if not product_ids:
+        return Entitlements(product_ids=frozenset(), feature_ids=frozenset(),
+                            has_active_subscription=bool(subscribed_product_ids))
+    feature_ids = frozenset(ProductFeature.objects.filter(product_id__in=product_ids).values_list("feature_id",
+                                                                                                  flat=True))
+    return Entitlements(product_ids=product_ids, feature_ids=feature_ids, has_active_subscription=True)
+
+
+def _update_entitlement_rows(user_ids: Collection):
+    """
+    Synchronize UserEntitlement rows of the given users with their subscriptions granting access.
+    Existing rows are loaded in one query, then only new, changed and removed rows are written.
+    Called inside a transaction. The users' StripeUser rows are locked first, in primary key order so that concurrent
+    updates of overlapping users cannot deadlock, and rows are only computed once concurrent updates have committed.
+    """
+    if not user_ids:
+        return
+
+    list(StripeUser.objects.select_for_update().filter(pk__in=user_ids).order_by("pk").values_list("pk", flat=True))
+
+    wanted_rows = {
+        (user_id, feature_id): access_until for user_id, feature_id, access_until in SubscriptionItem.objects.filter(
+            subscription__stripe_user_id__in=user_ids,
+            subscription__status__in=ACCESS_GRANTING_STATUSES,
+            price__product__linked_features__isnull=False
+        ).values_list(
+            "subscription__stripe_user_id", "price__product__linked_features__feature_id"
+        ).annotate(access_until=Max("subscription__period_end")).order_by()
+    }
+
+    rows_to_delete = []
+    rows_to_update = []
+    for row in UserEntitlement.objects.filter(stripe_user_id__in=user_ids):
+        key = (row.stripe_user_id, row.feature_id)
+        if key not in wanted_rows:
+            rows_to_delete.append(row.pk)
+            continue
+        access_until = wanted_rows.pop(key)
+        if row.access_until != access_until:
+            row.access_until = access_until
+            rows_to_update.append(row)
+
+    if rows_to_delete:
+        UserEntitlement.objects.filter(pk__in=rows_to_delete).delete()
+    if rows_to_update:
+        UserEntitlement.objects.bulk_update(rows_to_update, ["access_until"])
+    # rows left over are new
+    UserEntitlement.objects.bulk_create([
+        UserEntitlement(stripe_user_id=user_id, feature_id=feature_id, access_until=access_until)
+        for (user_id, feature_id), access_until in wanted_rows.items()
+    ], ignore_conflicts=True)
+
+
+def _get_cache():
+    return get_shared_cache("ENTITLEMENT_CACHE")
+
+
+def _get_user_version_key(user_id) -> str:
+    return f"{_KEY_PREFIX}:user_version:{user_id}"
+
+
+def _get_entitlements_key(cache, user_id) -> str:
+    user_version_key = _get_user_version_key(user_id)
+    versions = cache.get_many([user_version_key, _CATALOG_VERSION_KEY])
+    user_version = versions.get(user_version_key) or _add_version(cache, user_version_key)
+    catalog_version = versions.get(_CATALOG_VERSION_KEY) or _add_version(cache, _CATALOG_VERSION_KEY)
+    return f"{_KEY_PREFIX}:{user_id}:{user_version}:{catalog_version}"
+
+
+def _add_version(cache, key: str) -> str:
+    """Set a version that is not cached yet, unless another process just did."""
+    version = uuid4().hex
+    if cache.add(key, version, None):
+        return version
+    return cache.get(key) or version
+
+
+def _replace_versions(keys: List[str]):
+    if not keys or _get_cache() is None:
+        return
+    _set_new_versions(keys)
+    # entitlements computed by other processes before the current transaction commits are stale, replace again
+    transaction.on_commit(partial(_set_new_versions, keys))
+
+
+def _set_new_versions(keys: List[str]):
+    _get_cache().set_many({key: uuid4().hex for key in keys}, None)
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from drf_stripe.stripe_api.subscriptions import archive_ended_subscriptions
+
+
+class Command(BaseCommand):
+    help = "Move subscriptions that ended more than a number of days ago to the archive table, or delete them"
+
+    def add_arguments(self, parser):
+        parser.add_argument("-d", "--days", type=int, help="Archive subscriptions ended more than this many days ago",
+                            default=90)
+        parser.add_argument("-b", "--batch_size", type=int, help="Number of subscriptions archived per transaction",
+                            default=500)
+        parser.add_argument("--delete", action="store_true", help="Delete the subscriptions instead of archiving them")
+
+    def handle(self, *args, **kwargs):
+        count = archive_ended_subscriptions(days=kwargs.get('days'), batch_size=kwargs.get('batch_size'),
+                                            delete=kwargs.get('delete'))
+        action = "Deleted" if kwargs.get('delete') else "Archived"
+        self.stdout.write(f"{action} {count} ended subscription(s).")
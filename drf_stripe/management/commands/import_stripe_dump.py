@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from drf_stripe.stripe_api.dumps import DUMP_OBJECT_TYPES, import_stripe_dump
+from drf_stripe.stripe_api.sync import format_sync_summary
+
+
+class Command(BaseCommand):
+    help = "Import Stripe products, prices, customers and subscriptions from JSON or JSON Lines dump files"
+
+    def add_arguments(self, parser):
+        parser.add_argument("paths", nargs="+", type=str, help="Dump files, imported in order")
+        parser.add_argument("-t", "--types", nargs="+", choices=DUMP_OBJECT_TYPES, default=list(DUMP_OBJECT_TYPES),
+                            help="Stripe object types to import")
+        parser.add_argument("-b", "--batch_size", type=int, help="Number of objects written per batch", default=100)
+
+    def handle(self, *args, **kwargs):
+        reports = import_stripe_dump(kwargs.get('paths'), object_types=kwargs.get('types'),
+                                     batch_size=kwargs.get('batch_size'))
+        for report in reports.values():
+            report.print_errors()
+        self.stdout.write(format_sync_summary(reports.values()))
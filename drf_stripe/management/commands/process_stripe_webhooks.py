@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from drf_stripe.stripe_webhooks.inbox import process_webhook_inbox
+
+
+class Command(BaseCommand):
+    help = "Process Stripe webhook events stored in the inbox table"
+
+    def add_arguments(self, parser):
+        parser.add_argument("-b", "--batch_size", type=int, help="Number of events processed per batch", default=100)
+        parser.add_argument("-m", "--max_attempts", type=int, help="Maximum attempts per event", default=5)
+        parser.add_argument("-r", "--retry_delay", type=float,
+                            help="Seconds before a failed event is retried, doubled after each failure", default=60)
+        parser.add_argument("--loop", action="store_true", help="Keep polling for new events")
+        parser.add_argument("--sleep", type=float, help="Seconds to wait when inbox is empty", default=1.0)
+
+    def handle(self, *args, **kwargs):
+        total = 0
+        while True:
+            count = process_webhook_inbox(batch_size=kwargs.get('batch_size'), max_attempts=kwargs.get('max_attempts'),
+                                          retry_delay=kwargs.get('retry_delay'))
+            total += count
+            if count == 0:
+                if not kwargs.get('loop'):
+                    break
+                time.sleep(kwargs.get('sleep'))
+
+        self.stdout.write(f"Processed {total} webhook event(s).")
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from drf_stripe.settings import drf_stripe_settings
+from drf_stripe.stripe_webhooks.ledger import prune_processed_events
+
+
+class Command(BaseCommand):
+    help = "Delete records of processed Stripe webhook events older than the retention period"
+
+    def add_arguments(self, parser):
+        parser.add_argument("-d", "--days", type=int, help="Retention period in days", default=None)
+        parser.add_argument("-b", "--batch_size", type=int, help="Number of rows deleted per batch", default=1000)
+
+    def handle(self, *args, **kwargs):
+        days = kwargs.get('days')
+        if days is None:
+            days = drf_stripe_settings.WEBHOOK_EVENT_RETENTION_DAYS
+
+        deleted_count = prune_processed_events(days=days, batch_size=kwargs.get('batch_size'))
+        self.stdout.write(f"Deleted {deleted_count} processed event record(s).")
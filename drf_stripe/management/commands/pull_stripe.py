@@ -1,11 +1,39 @@
-from django.core.management import BaseCommand
+from django.core.management import BaseCommand, CommandError
 from django.core.management import call_command
 
+from drf_stripe.stripe_api.pull import stripe_api_pull_concurrently
+from drf_stripe.stripe_api.sync import format_sync_summary
+
 
 class Command(BaseCommand):
     help = "Pull data from Stripe and update database."
 
+    def add_arguments(self, parser):
+        parser.add_argument("-w", "--workers", type=int, default=1,
+                            help="Number of threads fetching from Stripe, fetching runs concurrently if more than 1. "
+                                 "At most 4 are used, one per type of object")
+        parser.add_argument("--rate_limit", type=float, default=20,
+                            help="Maximum Stripe API requests per second when fetching concurrently")
+        parser.add_argument("-b", "--max_buffered_pages", type=int, default=2,
+                            help="Maximum pages fetched ahead of database updates, per object type")
+        parser.add_argument("-i", "--incremental", action="store_true",
+                            help="Only retrieve customers and subscriptions changed since the last incremental sync")
+        parser.add_argument("-r", "--resume", action="store_true",
+                            help="Resume customers and subscriptions after the last page committed by an interrupted run")
+
     def handle(self, *args, **kwargs):
+        if kwargs.get('workers') > 1:
+            if kwargs.get('incremental') or kwargs.get('resume'):
+                raise CommandError("--incremental and --resume cannot be combined with concurrent fetching (--workers > 1).")
+            reports = stripe_api_pull_concurrently(workers=kwargs.get('workers'), rate_limit=kwargs.get('rate_limit'),
+                                                   max_buffered_pages=kwargs.get('max_buffered_pages'))
+            for report in reports:
+                report.print_errors()
+            self.stdout.write(format_sync_summary(reports))
+            return
+
         call_command("update_stripe_products")
-        call_command("update_stripe_customers")
-        call_command("update_stripe_subscriptions")
+        call_command("update_stripe_customers", incremental=kwargs.get('incremental'),
+                     resume=kwargs.get('resume'))
+        call_command("update_stripe_subscriptions", incremental=kwargs.get('incremental'),
+                     resume=kwargs.get('resume'))
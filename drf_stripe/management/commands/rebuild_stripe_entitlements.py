@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from drf_stripe.entitlements import rebuild_user_entitlements
+
+
+class Command(BaseCommand):
+    help = "Rebuild the UserEntitlement table from subscriptions and product features"
+
+    def add_arguments(self, parser):
+        parser.add_argument("-b", "--batch_size", type=int, help="Number of users rebuilt per transaction",
+                            default=1000)
+
+    def handle(self, *args, **kwargs):
+        entitlement_count = rebuild_user_entitlements(batch_size=kwargs.get('batch_size'))
+        self.stdout.write(f"Rebuilt {entitlement_count} user entitlement(s).")
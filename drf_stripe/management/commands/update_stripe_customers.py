@@ -1,14 +1,22 @@
 from django.core.management.base import BaseCommand
 
 from drf_stripe.stripe_api.customers import stripe_api_update_customers
+from drf_stripe.stripe_api.sync import format_sync_summary
 
 
 class Command(BaseCommand):
     help = "Import Stripe Customer objects from Stripe"
 
     def add_arguments(self, parser):
-        parser.add_argument("-l", "--limit", type=int, help="Limit", default=100)
+        parser.add_argument("-l", "--limit", type=int, help="Number of objects retrieved per page", default=100)
         parser.add_argument("-s", "--starting_after", type=str, help="Starting after customer id", default=None)
+        parser.add_argument("-i", "--incremental", action="store_true",
+                            help="Only retrieve changes since the last incremental sync")
+        parser.add_argument("-r", "--resume", action="store_true",
+                            help="Resume after the last page committed by an interrupted run")
 
     def handle(self, *args, **kwargs):
-        stripe_api_update_customers(limit=kwargs.get('limit'), starting_after=kwargs.get('starting_after'))
+        report = stripe_api_update_customers(limit=kwargs.get('limit'), starting_after=kwargs.get('starting_after'),
+                                             incremental=kwargs.get('incremental'), resume=kwargs.get('resume'))
+        report.print_errors()
+        self.stdout.write(format_sync_summary([report]))
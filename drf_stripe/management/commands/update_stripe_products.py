@@ -1,6 +1,7 @@
 from django.core.management.base import BaseCommand
 
 from drf_stripe.stripe_api.products import stripe_api_update_products_prices
+from drf_stripe.stripe_api.sync import format_sync_summary
 
 
 class Command(BaseCommand):
@@ -10,4 +11,7 @@ class Command(BaseCommand):
         pass
 
     def handle(self, *args, **kwargs):
-        stripe_api_update_products_prices()
+        reports = stripe_api_update_products_prices()
+        for report in reports:
+            report.print_errors()
+        self.stdout.write(format_sync_summary(reports))
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.30 on 2026-10-18 01:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('drf_stripe', '0003_price_currency'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebhookEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_id', models.CharField(max_length=256, unique=True)),
+                ('event_type', models.CharField(max_length=128)),
+                ('payload', models.TextField()),
+                ('received_at', models.DateTimeField(auto_now_add=True)),
+                ('processed_at', models.DateTimeField(blank=True, null=True)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['processed_at', 'received_at'], name='drf_stripe__process_e2b714_idx')],
+            },
+        ),
+    ]
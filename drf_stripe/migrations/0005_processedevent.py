@@ -0,0 +1,21 @@
+# Generated by Django 4.2.30 on 2026-10-18 01:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('drf_stripe', '0004_webhookevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProcessedEvent',
+            fields=[
+                ('event_id', models.CharField(max_length=256, primary_key=True, serialize=False)),
+                ('event_type', models.CharField(max_length=128)),
+                ('processed_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+        ),
+    ]
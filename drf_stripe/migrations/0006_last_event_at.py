@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-18 01:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('drf_stripe', '0005_processedevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='price',
+            name='last_event_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='last_event_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='subscription',
+            name='last_event_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.30 on 2026-10-18 01:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('drf_stripe', '0006_last_event_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncState',
+            fields=[
+                ('resource', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('last_created', models.DateTimeField(blank=True, null=True)),
+                ('last_event_id', models.CharField(blank=True, max_length=256, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
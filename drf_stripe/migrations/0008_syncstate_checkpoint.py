@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 02:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('drf_stripe', '0007_syncstate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='syncstate',
+            name='checkpoint',
+            field=models.CharField(blank=True, max_length=256, null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-18 02:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('drf_stripe', '0008_syncstate_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='price',
+            name='fingerprint',
+            field=models.CharField(blank=True, max_length=32, null=True),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='fingerprint',
+            field=models.CharField(blank=True, max_length=32, null=True),
+        ),
+        migrations.AddField(
+            model_name='subscription',
+            name='fingerprint',
+            field=models.CharField(blank=True, max_length=32, null=True),
+        ),
+    ]
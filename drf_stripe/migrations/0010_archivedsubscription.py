@@ -0,0 +1,39 @@
+# Generated by Django 4.2.30 on 2026-10-18 02:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('drf_stripe', '0009_fingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedSubscription',
+            fields=[
+                ('subscription_id', models.CharField(max_length=256, primary_key=True, serialize=False)),
+                ('period_start', models.DateTimeField(blank=True, null=True)),
+                ('period_end', models.DateTimeField(blank=True, null=True)),
+                ('cancel_at', models.DateTimeField(blank=True, null=True)),
+                ('cancel_at_period_end', models.BooleanField()),
+                ('ended_at', models.DateTimeField(blank=True, null=True)),
+                ('status', models.CharField(max_length=64)),
+                ('trial_end', models.DateTimeField(blank=True, null=True)),
+                ('trial_start', models.DateTimeField(blank=True, null=True)),
+                ('items', models.JSONField(default=list)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='subscription',
+            index=models.Index(fields=['ended_at'], name='drf_stripe__ended_a_113b5b_idx'),
+        ),
+        migrations.AddField(
+            model_name='archivedsubscription',
+            name='stripe_user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_subscriptions', to='drf_stripe.stripeuser'),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 4.2.30 on 2026-10-18 02:16
+
+from django.db import migrations, models
+from django.db.models import Max
+import django.db.models.deletion
+
+"""
+Subscription statuses granting access, see drf_stripe.stripe_models.subscription.ACCESS_GRANTING_STATUSES.
+"""
+ACCESS_GRANTING_STATUSES = ("active", "past_due", "trialing")
+
+
+def create_user_entitlements(apps, schema_editor):
+    """Create UserEntitlement rows of existing subscriptions, like the 'rebuild_stripe_entitlements' command."""
+    SubscriptionItem = apps.get_model("drf_stripe", "SubscriptionItem")
+    UserEntitlement = apps.get_model("drf_stripe", "UserEntitlement")
+
+    rows = SubscriptionItem.objects.filter(
+        subscription__status__in=ACCESS_GRANTING_STATUSES,
+        price__product__linked_features__isnull=False
+    ).values_list(
+        "subscription__stripe_user_id", "price__product__linked_features__feature_id"
+    ).annotate(access_until=Max("subscription__period_end")).order_by()
+
+    UserEntitlement.objects.bulk_create([
+        UserEntitlement(stripe_user_id=user_id, feature_id=feature_id, access_until=access_until)
+        for user_id, feature_id, access_until in rows
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('drf_stripe', '0010_archivedsubscription'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserEntitlement',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('access_until', models.DateTimeField(blank=True, null=True)),
+                ('feature', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='drf_stripe.feature')),
+                ('stripe_user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='entitlements', to='drf_stripe.stripeuser')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='userentitlement',
+            constraint=models.UniqueConstraint(fields=('stripe_user', 'feature'), name='unique_user_entitlement'),
+        ),
+        migrations.RunPython(create_user_entitlements, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 02:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('drf_stripe', '0012_webhookevent_next_attempt_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='syncstate',
+            name='checkpoint_filters',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
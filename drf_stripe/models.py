@@ -40,16 +40,30 @@ class StripeUser(models.Model):
     @property
     def subscribed_products(self):
         """Returns a set of Product instances the StripeUser currently has"""
-        return {item.price.product for item in
-                self.current_subscription_items.prefetch_related("price", "price__product")}
+        product_ids = self.subscribed_product_ids
+        return set(Product.objects.filter(pk__in=product_ids)) if product_ids else set()
 
     @property
     def subscribed_features(self):
         """Returns a set of Feature instances the StripeUser has access to."""
-        price_list = self.current_subscription_items.values_list('price', flat=True)
-        product_list = Price.objects.filter(pk__in=price_list).values_list("product", flat=True)
-        return {item.feature for item in
-                ProductFeature.objects.filter(product_id__in=product_list).prefetch_related("feature")}
+        feature_ids = self.subscribed_feature_ids
+        return set(Feature.objects.filter(pk__in=feature_ids)) if feature_ids else set()
+
+    @property
+    def subscribed_product_ids(self):
+        """Returns a set of ids of the Products the StripeUser currently has, usually from cache."""
+        from .entitlements import get_user_entitlements
+        return get_user_entitlements(self.pk).product_ids
+
+    @property
+    def subscribed_feature_ids(self):
+        """Returns a set of ids of the Features the StripeUser has access to, usually from cache."""
+        from .entitlements import get_user_entitlements
+        return get_user_entitlements(self.pk).feature_ids
+
+    def has_feature(self, feature_id: str) -> bool:
+        """Returns True if the StripeUser has access to the Feature."""
+        return feature_id in self.subscribed_feature_ids
 
     class Meta:
         indexes = [
@@ -73,6 +87,8 @@ class Product(models.Model):
     active = models.BooleanField()
     description = models.CharField(max_length=1024, null=True, blank=True)
     name = models.CharField(max_length=256, null=True, blank=True)
+    last_event_at = models.DateTimeField(null=True, blank=True)  # created time of the last Stripe event applied
+    fingerprint = models.CharField(max_length=32, null=True, blank=True)  # hash of the synced Stripe fields
 
 
 class ProductFeature(models.Model):
@@ -91,6 +107,8 @@ class Price(models.Model):
     freq = models.CharField(max_length=64, null=True, blank=True)
     active = models.BooleanField()
     currency = models.CharField(max_length=3)
+    last_event_at = models.DateTimeField(null=True, blank=True)  # created time of the last Stripe event applied
+    fingerprint = models.CharField(max_length=32, null=True, blank=True)  # hash of the synced Stripe fields
 
     class Meta:
         indexes = [
@@ -112,10 +130,13 @@ class Subscription(models.Model):
     status = models.CharField(max_length=64)
     trial_end = models.DateTimeField(null=True, blank=True)
     trial_start = models.DateTimeField(null=True, blank=True)
+    last_event_at = models.DateTimeField(null=True, blank=True)  # created time of the last Stripe event applied
+    fingerprint = models.CharField(max_length=32, null=True, blank=True)  # hash of the synced Stripe fields
 
     class Meta:
         indexes = [
-            models.Index(fields=['stripe_user', 'status'])
+            models.Index(fields=['stripe_user', 'status']),
+            models.Index(fields=['ended_at'])
         ]
 
 
@@ -127,3 +148,83 @@ class SubscriptionItem(models.Model):
     subscription = models.ForeignKey(Subscription, on_delete=models.CASCADE, related_name="items")
     price = models.ForeignKey(Price, on_delete=models.CASCADE, related_name="+")
     quantity = models.PositiveIntegerField()
+
+
+class ArchivedSubscription(models.Model):
+    """
+    A model keeping an ended Subscription after it is moved out of the Subscription and SubscriptionItem tables by
+    the 'archive_stripe_subscriptions' command. Items are stored as a list of sub_item_id, price_id, quantity.
+    """
+    subscription_id = models.CharField(max_length=256, primary_key=True)
+    stripe_user = models.ForeignKey(StripeUser, on_delete=models.CASCADE, related_name="archived_subscriptions")
+    period_start = models.DateTimeField(null=True, blank=True)
+    period_end = models.DateTimeField(null=True, blank=True)
+    cancel_at = models.DateTimeField(null=True, blank=True)
+    cancel_at_period_end = models.BooleanField()
+    ended_at = models.DateTimeField(null=True, blank=True)
+    status = models.CharField(max_length=64)
+    trial_end = models.DateTimeField(null=True, blank=True)
+    trial_start = models.DateTimeField(null=True, blank=True)
+    items = models.JSONField(default=list)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+
+class UserEntitlement(models.Model):
+    """
+    A denormalized row for each Feature a StripeUser has access to, maintained whenever subscriptions or links between
+    products and features are written, see drf_stripe.entitlements. Rebuilt by the 'rebuild_stripe_entitlements'
+    command.
+    """
+    stripe_user = models.ForeignKey(StripeUser, on_delete=models.CASCADE, related_name="entitlements")
+    feature = models.ForeignKey(Feature, on_delete=models.CASCADE, related_name="+")
+    access_until = models.DateTimeField(null=True, blank=True)  # latest period end of the granting subscriptions
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['stripe_user', 'feature'], name='unique_user_entitlement')
+        ]
+
+
+class WebhookEvent(models.Model):
+    """
+    A model used to keep received Stripe webhook events until they are processed.
+    Events are only stored here when WEBHOOK_INBOX_ENABLED setting is on, and are processed by the
+    'process_stripe_webhooks' management command.
+    """
+    event_id = models.CharField(max_length=256, unique=True)
+    event_type = models.CharField(max_length=128)
+    payload = models.TextField()  # raw request body as sent by Stripe
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(null=True, blank=True)
+    next_attempt_at = models.DateTimeField(null=True, blank=True)  # failed events are not retried before this time
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['processed_at', 'received_at'])
+        ]
+
+
+class ProcessedEvent(models.Model):
+    """
+    A model used to keep track of Stripe events that have already been handled, so that repeated deliveries of the
+    same event are ignored. Old records can be removed with the 'prune_stripe_events' management command.
+    """
+    event_id = models.CharField(max_length=256, primary_key=True)
+    event_type = models.CharField(max_length=128)
+    processed_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+
+class SyncState(models.Model):
+    """
+    A model used to keep track of synchronization with Stripe for each type of object, so that incremental syncs
+    only retrieve objects or events created since the previous sync, and interrupted syncs can resume from the last
+    committed page.
+    """
+    resource = models.CharField(max_length=64, primary_key=True)
+    last_created = models.DateTimeField(null=True, blank=True)  # created time of the newest object or event synced
+    last_event_id = models.CharField(max_length=256, null=True, blank=True)
+    checkpoint = models.CharField(max_length=256, null=True, blank=True)  # id of the last object of the last committed page
+    checkpoint_filters = models.JSONField(null=True, blank=True)  # list filters of the sync that saved the checkpoint
+    updated_at = models.DateTimeField(auto_now=True)
@@ -0,0 +1,130 @@
+from typing import Hashable
+
+from rest_framework.permissions import BasePermission, OperationHolderMixin
+
+from .cache import get_shared_cache
+from .entitlements import Entitlements, get_user_entitlements
+from .models import Subscription, SubscriptionItem
+from .stripe_models.subscription import ACCESS_GRANTING_STATUSES
+
+
+class _EntitlementPermission(OperationHolderMixin, BasePermission):
+    """
+    Base of permissions granted by a user's subscriptions.
+
+    Checks are answered from the user's cached entitlements (see drf_stripe.entitlements), or with one indexed existence
+    query when ENTITLEMENT_CACHE is not set. Both read the user's subscriptions granting access, so every permission
+    gives the same answer in either mode. Results are memoized on the request, so several checks in one request
+    fetch the entitlements or run each query only once.
+
+    Permissions taking arguments are added to permission_classes as instances. DRF instantiates permission_classes,
+    so instances return themselves when called. They can be combined with other permissions using &, | and ~.
+    """
+
+    def __call__(self):
+        return self
+
+    def has_permission(self, request, view):
+        user = getattr(request, "user", None)
+        if user is None or not user.is_authenticated:
+            return False
+
+        memo = getattr(request, "_drf_stripe_permissions", None)
+        if memo is None:
+            memo = request._drf_stripe_permissions = {}
+
+        if get_shared_cache("ENTITLEMENT_CACHE") is not None:
+            if "entitlements" not in memo:
+                memo["entitlements"] = get_user_entitlements(user.pk)
+            return self.has_entitlement(memo["entitlements"])
+
+        key = self.get_memo_key()
+        if key not in memo:
+            memo[key] = self.query_entitlement(user.pk)
+        return memo[key]
+
+    def has_entitlement(self, entitlements: Entitlements) -> bool:
+        """Returns True if the cached entitlements grant the permission."""
+        raise NotImplementedError
+
+    def query_entitlement(self, user_id) -> bool:
+        """Returns True if the user's subscriptions grant the permission, using a single query."""
+        raise NotImplementedError
+
+    def get_memo_key(self) -> Hashable:
+        """Returns the key of the query result memoized on the request."""
+        raise NotImplementedError
+
+
+class HasFeature(_EntitlementPermission):
+    """
+    Allows access to users subscribed to a product providing the feature.
+
+    Usage: permission_classes = [HasFeature("FEATURE_A")]
+    """
+
+    def __init__(self, feature_id: str):
+        """
+        :param str feature_id: id of the required Feature.
+        """
+        self.feature_id = feature_id
+        self.message = f"Subscription to feature '{feature_id}' is required."
+
+    def has_entitlement(self, entitlements: Entitlements) -> bool:
+        return self.feature_id in entitlements.feature_ids
+
+    def query_entitlement(self, user_id) -> bool:
+        return SubscriptionItem.objects.filter(
+            subscription__stripe_user_id=user_id,
+            subscription__status__in=ACCESS_GRANTING_STATUSES,
+            price__product__linked_features__feature_id=self.feature_id
+        ).exists()
+
+    def get_memo_key(self) -> Hashable:
+        return "feature", self.feature_id
+
+
+class HasAnyProduct(_EntitlementPermission):
+    """
+    Allows access to users subscribed to at least one of the products.
+
+    Usage: permission_classes = [HasAnyProduct("prod_A", "prod_B")]
+    """
+
+    def __init__(self, *product_ids: str):
+        """
+        :param product_ids: ids of the Products, any of which grants access.
+        """
+        self.product_ids = frozenset(product_ids)
+        self.message = "Subscription to one of the required products is required."
+
+    def has_entitlement(self, entitlements: Entitlements) -> bool:
+        return not self.product_ids.isdisjoint(entitlements.product_ids)
+
+    def query_entitlement(self, user_id) -> bool:
+        return SubscriptionItem.objects.filter(
+            subscription__stripe_user_id=user_id,
+            subscription__status__in=ACCESS_GRANTING_STATUSES,
+            price__product_id__in=self.product_ids
+        ).exists()
+
+    def get_memo_key(self) -> Hashable:
+        return "products", self.product_ids
+
+
+class HasActiveSubscription(_EntitlementPermission):
+    """
+    Allows access to users with a subscription granting access, ie: active or trialing.
+
+    Usage: permission_classes = [HasActiveSubscription]
+    """
+    message = "An active subscription is required."
+
+    def has_entitlement(self, entitlements: Entitlements) -> bool:
+        return entitlements.has_active_subscription
+
+    def query_entitlement(self, user_id) -> bool:
+        return Subscription.objects.filter(stripe_user_id=user_id, status__in=ACCESS_GRANTING_STATUSES).exists()
+
+    def get_memo_key(self) -> Hashable:
+        return "active_subscription"
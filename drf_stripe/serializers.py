@@ -2,11 +2,25 @@ from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 from stripe.error import StripeError
 
+from drf_stripe.catalog import ProductRecord
 from drf_stripe.models import SubscriptionItem, Product, Price, Subscription
 from drf_stripe.stripe_api.checkout import stripe_api_create_checkout_session
 from drf_stripe.stripe_api.customers import get_or_create_stripe_user
 
 
+def get_product_feature_ids(product):
+    """
+    Returns feature ids and descriptions of a Product, or of a ProductRecord of the catalog snapshot. Reads the
+    product's prefetched linked_features, so querysets should prefetch them with their feature, see
+    drf_stripe.stripe_api.subscriptions.prefetch_product_features().
+    """
+    if isinstance(product, ProductRecord):
+        return [{"feature_id": feature.feature_id, "feature_desc": feature.description} for feature in
+                product.features]
+    return [{"feature_id": link.feature.feature_id, "feature_desc": link.feature.description} for link in
+            product.linked_features.all()]
+
+
 class SubscriptionSerializer(serializers.ModelSerializer):
     class Meta:
         model = Subscription
@@ -36,8 +50,7 @@ class SubscriptionItemSerializer(serializers.ModelSerializer):
     cancel_at_period_end = serializers.BooleanField(source='subscription.cancel_at_period_end')
 
     def get_feature_ids(self, obj):
-        return [{"feature_id": link.feature.feature_id, "feature_desc": link.feature.description} for link in
-                obj.price.product.linked_features.all().prefetch_related('feature')]
+        return get_product_feature_ids(obj.price.product)
 
     def get_subscription_expires_at(self, obj):
         return obj.subscription.period_end or \
@@ -66,9 +79,7 @@ class PriceSerializer(serializers.ModelSerializer):
     services = serializers.SerializerMethodField(method_name='get_feature_ids')
 
     def get_feature_ids(self, obj):
-        return [{"feature_id": prod_feature.feature.feature_id, "feature_desc": prod_feature.feature.description} for
-                prod_feature in
-                obj.product.linked_features.all().prefetch_related("feature")]
+        return get_product_feature_ids(obj.product)
 
     class Meta:
         model = Price
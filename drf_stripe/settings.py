@@ -6,6 +6,14 @@ USER_SETTINGS = getattr(settings, "DRF_STRIPE", None)
 DEFAULTS = {
     "STRIPE_API_SECRET": "my_stripe_api_key",
     "STRIPE_WEBHOOK_SECRET": "my_stripe_webhook_key",
+    "STRIPE_API_TIMEOUT": 30,  # seconds to wait for a Stripe API response
+    "STRIPE_API_MAX_RETRIES": 2,  # retries of rate limited (429), conflicting and failed Stripe API requests
+    "STRIPE_API_READ_RATE_LIMIT": 25,  # Stripe API read requests per second, Stripe allows 25 in test mode, 100 live
+    "STRIPE_API_WRITE_RATE_LIMIT": 25,  # Stripe API write requests per second
+    "STRIPE_API_POOL_SIZE": 10,  # connections kept open to Stripe API
+    "STRIPE_API_REPLACE_HTTP_CLIENT": False,  # replace a Stripe default HTTP client already set by the project
+    "STRIPE_API_FETCH_WORKERS": 4,  # threads retrieving missing customers and subscription items while syncing
+    "STRIPE_API_FETCH_RATE_LIMIT": 20,  # requests per second retrieving them, shared by all syncs in a process
     "FRONT_END_BASE_URL": "http://localhost:3000",
     "NEW_USER_FREE_TRIAL_DAYS": None,
     "CHECKOUT_SUCCESS_URL_PATH": "payment",
@@ -15,6 +23,14 @@ DEFAULTS = {
     "DEFAULT_DISCOUNTS": None,
     "ALLOW_PROMOTION_CODES": True,
     "DJANGO_USER_MODEL": None,
+    "ENTITLEMENT_CACHE": None,  # alias of a Django cache shared by all processes keeping user entitlements
+    "ENTITLEMENT_CACHE_TIMEOUT": 24 * 60 * 60,  # seconds, cached entitlements are also replaced when they change
+    "CATALOG_CACHE": None,  # alias of a Django cache shared by all processes keeping the catalog version
+    "CATALOG_CACHE_TIMEOUT": 60 * 60,  # seconds, processes reload their catalog snapshot at least this often
+    "SYNC_METRICS_CALLBACK": None,  # function or dotted path, called with metrics of each page synced from Stripe
+    "WEBHOOK_INBOX_ENABLED": False,  # store webhook events and process them with 'process_stripe_webhooks' command
+    "WEBHOOK_EVENT_LEDGER_ENABLED": True,  # skip events that have already been processed, based on event id
+    "WEBHOOK_EVENT_RETENTION_DAYS": 30,  # used by 'prune_stripe_events' command
     "DJANGO_USER_EMAIL_FIELD": "email",  # used to match Stripe customer email
     "USER_CREATE_DEFAULTS_ATTRIBUTE_MAP": {  # attributes to copy from Stripe customer when creating new Django user
         "username": "email"
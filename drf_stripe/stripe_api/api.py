@@ -1,8 +1,27 @@
 import stripe
 
+from .client import RateLimitedRequestsClient
 from ..settings import drf_stripe_settings
 
+
+def install_http_client():
+    """
+    Install RateLimitedRequestsClient as Stripe's default HTTP client, unless the project already set its own client
+    and setting STRIPE_API_REPLACE_HTTP_CLIENT is False.
+    """
+    if stripe.default_http_client is not None and not drf_stripe_settings.STRIPE_API_REPLACE_HTTP_CLIENT:
+        return
+    stripe.default_http_client = RateLimitedRequestsClient(
+        timeout=drf_stripe_settings.STRIPE_API_TIMEOUT,
+        max_retries=drf_stripe_settings.STRIPE_API_MAX_RETRIES,
+        read_rate_limit=drf_stripe_settings.STRIPE_API_READ_RATE_LIMIT,
+        write_rate_limit=drf_stripe_settings.STRIPE_API_WRITE_RATE_LIMIT,
+        pool_size=drf_stripe_settings.STRIPE_API_POOL_SIZE
+    )
+
+
 stripe.api_key = drf_stripe_settings.STRIPE_API_SECRET
 stripe.api_version = "2020-08-27"
+install_http_client()
 
 stripe_api = stripe
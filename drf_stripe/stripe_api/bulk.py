@@ -0,0 +1,36 @@
+from typing import List, Tuple, Type
+
+from django.db import connections, router
+from django.db.models import Model
+
+
+def bulk_upsert(model: Type[Model], objs: List[Model], update_fields: List[str]) -> Tuple[int, int]:
+    """
+    Insert new rows and update existing rows for a list of model instances, matched on primary key.
+    Uses a single INSERT ... ON CONFLICT DO UPDATE statement where the database backend supports it (Django 4.1+),
+    otherwise falls back to bulk_create for new rows and bulk_update for existing rows.
+
+    :param model: model class.
+    :param list objs: unsaved model instances with primary key set. If a primary key repeats, the last one is kept.
+    :param list update_fields: names of fields to update on existing rows.
+    :return: number of rows created and number of rows updated.
+    """
+    objs = list({obj.pk: obj for obj in objs}.values())
+    if not objs:
+        return 0, 0
+
+    existing_pks = set(model.objects.filter(pk__in=[obj.pk for obj in objs]).values_list("pk", flat=True))
+    new_objs = [obj for obj in objs if obj.pk not in existing_pks]
+    existing_objs = [obj for obj in objs if obj.pk in existing_pks]
+
+    connection = connections[router.db_for_write(model)]
+    if getattr(connection.features, "supports_update_conflicts_with_target", False):
+        model.objects.bulk_create(objs, update_conflicts=True, unique_fields=[model._meta.pk.name],
+                                  update_fields=update_fields)
+    else:
+        if new_objs:
+            model.objects.bulk_create(new_objs)
+        if existing_objs:
+            model.objects.bulk_update(existing_objs, update_fields)
+
+    return len(new_objs), len(existing_objs)
@@ -0,0 +1,55 @@
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    from stripe import RequestsClient
+except ImportError:  # stripe < 7
+    from stripe.http_client import RequestsClient
+
+from .concurrency import RateLimiter
+
+
+class RateLimitedRequestsClient(RequestsClient):
+    """
+    Stripe HTTP client sharing a pooled requests session between threads, limiting the rate of read (GET) and write
+    requests with separate token buckets, and retrying rate limited (429) requests as well as the connection errors,
+    conflicts and server errors retried by Stripe's client. Retries are delayed by a jittered exponential backoff,
+    or the Retry-After header when Stripe sends one.
+    """
+
+    def __init__(self, timeout: float = 30, max_retries: int = 2, read_rate_limit: float = 25,
+                 write_rate_limit: float = 25, pool_size: int = 10, **kwargs):
+        """
+        :param float timeout: seconds to wait for Stripe to respond to a request.
+        :param int max_retries: maximum number of times a request is retried.
+        :param float read_rate_limit: maximum number of read requests per second.
+        :param float write_rate_limit: maximum number of write requests per second.
+        :param int pool_size: maximum number of connections kept open to Stripe.
+        """
+        session = requests.Session()
+        session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        super().__init__(timeout=timeout, session=session, **kwargs)
+
+        self.max_retries = max_retries
+        self.read_rate_limiter = RateLimiter(read_rate_limit)
+        self.write_rate_limiter = RateLimiter(write_rate_limit)
+
+    def request(self, method, url, headers, post_data=None, **kwargs):
+        self._acquire(method)
+        return super().request(method, url, headers, post_data, **kwargs)
+
+    def request_stream(self, method, url, headers, post_data=None, **kwargs):
+        self._acquire(method)
+        return super().request_stream(method, url, headers, post_data, **kwargs)
+
+    def _acquire(self, method):
+        rate_limiter = self.read_rate_limiter if method.lower() == "get" else self.write_rate_limiter
+        rate_limiter.acquire()
+
+    def _max_network_retries(self):
+        return self.max_retries
+
+    def _should_retry(self, response, api_connection_error, num_retries):
+        if response is not None and response[1] == 429 and num_retries < self._max_network_retries():
+            return True
+        return super()._should_retry(response, api_connection_error, num_retries)
@@ -0,0 +1,140 @@
+import queue
+import threading
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor
+from functools import wraps
+from typing import Callable, Iterator
+
+from ..settings import drf_stripe_settings
+
+
+class RateLimiter:
+    """
+    Token bucket limiting how often a call can be made, shared between threads.
+    Tokens are added at the given rate up to the burst size; acquire() blocks until a token is available.
+    """
+
+    def __init__(self, rate: float, burst: int = None):
+        """
+        :param float rate: number of calls allowed per second.
+        :param int burst: maximum number of calls allowed at once, defaults to rate.
+        """
+        if rate <= 0:
+            raise ValueError("Argument rate should be a positive number.")
+
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self._tokens = float(self.burst)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def rate_limited(fn: Callable, rate_limiter: RateLimiter) -> Callable:
+    """Wrap a function so that each call first acquires a token from the rate limiter."""
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        rate_limiter.acquire()
+        return fn(*args, **kwargs)
+
+    return wrapper
+
+
+"""
+Thread pool and rate limiter shared by the functions retrieving Stripe objects concurrently while syncing, ie: missing
+customers and remaining subscription items, so that concurrent syncs in a process stay within one rate limit and reuse
+the same threads. They are created on first use.
+"""
+_shared_executor = None
+_shared_rate_limiter = None
+_shared_lock = threading.Lock()
+
+
+def get_shared_executor() -> Executor:
+    """Returns the thread pool of STRIPE_API_FETCH_WORKERS threads retrieving Stripe objects."""
+    global _shared_executor
+    with _shared_lock:
+        if _shared_executor is None:
+            _shared_executor = ThreadPoolExecutor(max_workers=drf_stripe_settings.STRIPE_API_FETCH_WORKERS,
+                                                  thread_name_prefix="drf_stripe_fetch")
+        return _shared_executor
+
+
+def get_shared_rate_limiter() -> RateLimiter:
+    """Returns the rate limiter allowing STRIPE_API_FETCH_RATE_LIMIT requests per second retrieving Stripe objects."""
+    global _shared_rate_limiter
+    with _shared_lock:
+        if _shared_rate_limiter is None:
+            _shared_rate_limiter = RateLimiter(drf_stripe_settings.STRIPE_API_FETCH_RATE_LIMIT)
+        return _shared_rate_limiter
+
+
+_END_OF_PAGES = object()
+
+
+class PrefetchedPages:
+    """
+    Iterates over pages fetched ahead of time on an executor thread, so that fetching the next pages overlaps with
+    processing the current one. At most max_buffered_pages pages are held in memory, fetching pauses when the
+    buffer is full.
+
+    The fetching thread must not access the database, pages are only processed by the consuming thread.
+    Call close() if the pages will not be consumed to the end, so the fetching thread can stop.
+    """
+
+    def __init__(self, pages: Iterator, executor: Executor, max_buffered_pages: int = 2):
+        """
+        :param pages: page iterator, ie: returned by iter_stripe_list_pages.
+        :param executor: executor running the fetching thread.
+        :param int max_buffered_pages: maximum number of pages fetched but not yet consumed.
+        """
+        self._pages = pages
+        self._buffer = queue.Queue(maxsize=max_buffered_pages)
+        self._closed = threading.Event()
+        executor.submit(self._fetch)
+
+    def __iter__(self):
+        try:
+            while True:
+                item = self._buffer.get()
+                if item is _END_OF_PAGES:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        self._closed.set()
+
+    def _fetch(self):
+        try:
+            for page in self._pages:
+                if not self._put(page):
+                    return
+        except Exception as e:
+            self._put(e)
+        else:
+            self._put(_END_OF_PAGES)
+
+    def _put(self, item) -> bool:
+        while not self._closed.is_set():
+            try:
+                self._buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
@@ -1,15 +1,31 @@
-from typing import overload
+import logging
+from datetime import datetime
+from functools import partial
+from operator import attrgetter
+from typing import overload, Dict, Iterable, List, Tuple
 
 from drf_stripe.models import get_drf_stripe_user_model as get_user_model
 from django.core.exceptions import ObjectDoesNotExist
 from django.db.transaction import atomic
+from django.utils import timezone
 
 from drf_stripe.models import StripeUser
 from drf_stripe.stripe_api.api import stripe_api as stripe
+from drf_stripe.stripe_api.concurrency import get_shared_executor, get_shared_rate_limiter, rate_limited
+from drf_stripe.stripe_api.pagination import iter_stripe_list_pages
+from drf_stripe.stripe_api.sync import CUSTOMERS_SYNC, STRIPE_EVENT_RETENTION_PERIOD, SyncReport, \
+    get_event_created, get_latest_stripe_event, get_sync_checkpoint, get_sync_cursor, parse_page_objects, \
+    save_sync_checkpoint, save_sync_cursor, write_page_objects
 from drf_stripe.stripe_models.customer import StripeCustomers, StripeCustomer
 from ..settings import drf_stripe_settings
 
 
+logger = logging.getLogger(__name__)
+
+
+CUSTOMER_EVENT_TYPES = ["customer.created", "customer.updated"]
+
+
 class CreatingNewUsersDisabledError(Exception):
     pass
 
@@ -98,7 +114,7 @@ def _get_or_create_stripe_user_from_customer_id(customer_id):
         customer = StripeCustomer(**customer_response)
         user, created = _get_or_create_django_user_if_configured(customer)
         if created:
-            print(f"Created new User with customer_id {customer_id}")
+            logger.info("Created new User with customer_id %s", customer_id)
 
     return _get_or_create_stripe_user_from_user_id_email(user.id, user.email, customer_id)
 
@@ -165,7 +181,7 @@ def get_or_create_stripe_user_from_customer(customer: StripeCustomer) -> StripeU
                 **defaults
             )
 
-            print(f"Created new Django User with email address for Stripe customer_id {customer.id}")
+            logger.info("Created new Django User with email address for Stripe customer_id %s", customer.id)
 
         stripe_user, stripe_user_created = StripeUser.objects.get_or_create(user_id=django_user.id, defaults={'customer_id': customer.id})
         if not stripe_user_created and stripe_user.customer_id:
@@ -214,60 +230,298 @@ def _stripe_api_get_or_create_customer_from_email(user_email: str):
     return customer
 
 
-@atomic
-def stripe_api_update_customers(limit=100, starting_after=None, test_data=None):
+def stripe_api_update_customers(limit=100, starting_after=None, test_data=None, pages=None, incremental=False,
+                                resume=False) -> SyncReport:
     """
-    Retrieve list of Stripe customer objects, create StripeUser instances and optionally Django User.
+    Retrieve all Stripe customer objects, create StripeUser instances and optionally Django User.
     If a Django user does not exist a Django User will be created if setting USER_CREATE_DEFAULTS_ATTRIBUTE_MAP is set,
-    otherwise the Customer will be skipped.
+    otherwise the Customer will be skipped. Users are created in bulk, without calling save() or sending signals.
+    Each page is committed in its own transaction together with a checkpoint, customers that cannot be synced are
+    recorded in the returned report and skipped.
 
     Called from management command.
 
-    :param int limit: Limit the number of customers to retrieve
+    :param int limit: number of customers to retrieve per page (between 0 and 100).
     :param str starting_after: Stripe Customer id to start retrieval
     :param test_data: Stripe.Customer.list API response, used for testing
+    :param pages: iterable of Stripe.Customer.list API responses, used instead of retrieving customers.
+    :param bool incremental: if True, only update customers created or updated since the last incremental sync,
+        using Stripe customer events. Retrieves all customers if there was no incremental sync within the last 30 days,
+        which is how long Stripe keeps events for.
+    :param bool resume: if True, start retrieving after the last page committed by an interrupted sync.
+    :return: SyncReport listing the customers that could not be synced.
     """
 
     if limit < 0 or limit > 100:
         raise ValueError("Argument limit should be a positive integer no greater than 100.")
 
-    if test_data is None:
-        customers_response = stripe.Customer.list(limit=limit, starting_after=starting_after)
+    report = SyncReport(CUSTOMERS_SYNC)
+    latest_event = None
+    started_at = None
+    checkpoint_filters = {"incremental": incremental}
+    if test_data is not None:
+        pages = [test_data]
+    elif pages is None:
+        if incremental:
+            # without events to record, the next incremental sync starts from the time this one started
+            started_at = timezone.now()
+            since = get_sync_cursor(CUSTOMERS_SYNC)
+            if since is not None and since > timezone.now() - STRIPE_EVENT_RETENTION_PERIOD:
+                _stripe_api_update_customers_from_events(since, started_at, report)
+                report.finish()
+                return report
+            # changes made while retrieving all customers are picked up by the next incremental sync
+            latest_event = get_latest_stripe_event(types=CUSTOMER_EVENT_TYPES)
+
+        if resume:
+            starting_after = get_sync_checkpoint(CUSTOMERS_SYNC, checkpoint_filters) or starting_after
+        pages = iter_stripe_list_pages(stripe.Customer.list, limit=limit, starting_after=starting_after)
+
+    user_creation_counts = []
+
+    def write_customers(customers: List[StripeCustomer]):
+        users_created, _ = _update_customers(customers, report)
+        user_creation_counts.append(users_created)
+
+    for customers_response in report.iter_pages(pages):
+        with report.write_page(len(customers_response["data"])):
+            stripe_customers = parse_page_objects(StripeCustomer, customers_response, report)
+            save_checkpoint = None
+            if customers_response["data"]:
+                save_checkpoint = partial(save_sync_checkpoint, CUSTOMERS_SYNC, customers_response["data"][-1]["id"],
+                                          checkpoint_filters)
+            write_page_objects(report, stripe_customers, write_customers, get_object_id=attrgetter("id"),
+                               after_write=save_checkpoint)
+
+    with atomic():
+        save_sync_checkpoint(CUSTOMERS_SYNC, None)
+        if latest_event is not None:
+            save_sync_cursor(CUSTOMERS_SYNC, get_event_created(latest_event), latest_event["id"])
+        elif started_at is not None:
+            save_sync_cursor(CUSTOMERS_SYNC, started_at)
+
+    logger.info("%d Django user(s) created for Stripe customers.", sum(user_creation_counts))
+    report.finish()
+    return report
+
+
+def _stripe_api_update_customers_from_events(since: datetime, started_at: datetime, report: SyncReport):
+    """
+    Update customers created or updated since the given time, from Stripe customer events.
+    Events are listed newest first, so only the latest state of each customer is applied.
+
+    :param datetime since: retrieve events created at or after this time.
+    :param datetime started_at: start time of the sync, recorded as the cursor when there is no event.
+    :param SyncReport report: report receiving the customers that could not be synced.
+    """
+    latest_event = None
+    customer_ids = set()
+    events_pages = iter_stripe_list_pages(stripe.Event.list, types=CUSTOMER_EVENT_TYPES,
+                                          created={"gte": int(since.timestamp())})
+
+    for events_response in report.iter_pages(events_pages):
+        customers_data = []
+        for event in events_response["data"]:
+            latest_event = latest_event or event
+            customer = event["data"]["object"]
+            if customer["id"] not in customer_ids:
+                customer_ids.add(customer["id"])
+                customers_data.append(customer)
+
+        with report.write_page(len(customers_data)):
+            stripe_customers = parse_page_objects(StripeCustomer, {"data": customers_data}, report)
+            write_page_objects(report, stripe_customers, partial(_update_customers, report=report),
+                               get_object_id=attrgetter("id"))
+
+    if latest_event is not None:
+        save_sync_cursor(CUSTOMERS_SYNC, get_event_created(latest_event), latest_event["id"])
     else:
-        customers_response = test_data
+        save_sync_cursor(CUSTOMERS_SYNC, started_at)
 
-    stripe_customers = StripeCustomers(**customers_response).data
 
-    user_creation_count = 0
-    stripe_user_creation_count = 0
+def _update_customers(stripe_customers: List[StripeCustomer], report: SyncReport):
+    """
+    Create StripeUser instances and optionally Django User for a page of Stripe customers.
+    Django users are resolved by email for the whole page at once, see _resolve_users_by_email().
 
+    :param SyncReport report: report receiving the customers that could not be synced.
+    :return: number of Django users created and number of StripeUser created.
+    """
+    # Stripe customer can have null as email, the first customer listed for an email is linked to its user
+    customers_by_email = {}
     for customer in stripe_customers:
-        # Stripe customer can have null as email
         if customer.email is not None:
-            query_filters = {drf_stripe_settings.DJANGO_USER_EMAIL_FIELD: customer.email}
-            if drf_stripe_settings.USER_CREATE_DEFAULTS_ATTRIBUTE_MAP:
-                defaults = {k: getattr(customer, v) for k, v in
-                    drf_stripe_settings.USER_CREATE_DEFAULTS_ATTRIBUTE_MAP.items()}
-                user, user_created = get_user_model().objects.get_or_create(
-                    **query_filters,
-                    defaults=defaults
-                )
-            else:
-                user_created = False
-                user = get_user_model().objects.filter(
-                    **query_filters
-                ).first()
+            customers_by_email.setdefault(customer.email, customer)
+
+    errors = {}
+    users_by_email, user_creation_count = _resolve_users_by_email(customers_by_email, errors)
+    for customer_id, error in errors.items():
+        report.add_error(customer_id, error)
+
+    customer_id_by_user_id = {}
+    for customer in stripe_customers:
+        if customer.email is None:
+            continue
+        user = users_by_email.get(customer.email)
+        if user:
+            customer_id_by_user_id.setdefault(user.id, customer.id)
+        elif not drf_stripe_settings.USER_CREATE_DEFAULTS_ATTRIBUTE_MAP:
+            logger.info("Could not find Stripe Customer id '%s' in user model '%s' with '%s' of '%s', USER_CREATE_DEFAULTS_ATTRIBUTE_MAP is not set so skipping Customer.",
+                        customer.id, get_user_model(), drf_stripe_settings.DJANGO_USER_EMAIL_FIELD, customer.email)
+
+    stripe_user_creation_count = _create_missing_stripe_users(customer_id_by_user_id)
+    report.add_counts(created=stripe_user_creation_count,
+                      skipped=len(stripe_customers) - stripe_user_creation_count - len(errors))
+
+    return user_creation_count, stripe_user_creation_count
+
+
+def _resolve_users_by_email(customers_by_email: Dict[str, StripeCustomer], errors: Dict[str, Exception]):
+    """
+    Find the Django users of a batch of Stripe customers in one query on DJANGO_USER_EMAIL_FIELD.
+    If setting USER_CREATE_DEFAULTS_ATTRIBUTE_MAP is set, missing users are created with bulk_create, which does not
+    call the user model's save() method or send pre_save/post_save signals: projects that hook user creation must not
+    rely on them for users created by syncs. If the bulk insert fails, users are created one at a time and the errors
+    of customers whose user cannot be created are collected.
+
+    :param dict customers_by_email: Stripe customers keyed by email address.
+    :param dict errors: receives the errors of customers whose user cannot be created, keyed by customer id.
+    :return: Django users keyed by email address, and number of Django users created.
+    """
+    user_model = get_user_model()
+    email_field = drf_stripe_settings.DJANGO_USER_EMAIL_FIELD
+
+    users_by_email = {
+        getattr(user, email_field): user
+        for user in user_model.objects.filter(**{f"{email_field}__in": customers_by_email.keys()})
+    }
 
+    attribute_map = drf_stripe_settings.USER_CREATE_DEFAULTS_ATTRIBUTE_MAP
+    missing_emails = [email for email in customers_by_email if email not in users_by_email]
+    if not attribute_map or not missing_emails:
+        return users_by_email, 0
+
+    def make_user(email):
+        customer = customers_by_email[email]
+        attrs = {k: getattr(customer, v) for k, v in attribute_map.items()}
+        attrs[email_field] = email
+        return user_model(**attrs)
+
+    try:
+        with atomic():
+            user_model.objects.bulk_create([make_user(email) for email in missing_emails])
+        user_creation_count = len(missing_emails)
+    except Exception:
+        user_creation_count = 0
+        for email in missing_emails:
+            try:
+                with atomic():
+                    make_user(email).save()
+                user_creation_count += 1
+            except Exception as e:
+                errors[customers_by_email[email].id] = e
+
+    # reload created users, bulk_create does not set primary keys on every database backend
+    users_by_email.update({
+        getattr(user, email_field): user
+        for user in user_model.objects.filter(**{f"{email_field}__in": missing_emails})
+    })
+    return users_by_email, user_creation_count
+
+
+def get_stripe_users_by_customer_id(customer_ids: Iterable[str], retrieve_missing: bool = True) \
+        -> Tuple[Dict[str, StripeUser], Dict[str, Exception]]:
+    """
+    Returns the StripeUser instances of a batch of Stripe customer ids, creating records if required.
+    Existing StripeUser instances are loaded in one query. Customers without one are retrieved from Stripe
+    concurrently, then their Django users are resolved by email in batch, see _resolve_users_by_email().
+    If a Django user does not exist for a customer's email address and USER_CREATE_DEFAULTS_ATTRIBUTE_MAP is not set,
+    the customer's error is a CreatingNewUsersDisabledError.
+
+    :param customer_ids: Stripe customer ids.
+    :param bool retrieve_missing: if False, customers without a StripeUser are not retrieved from Stripe and are
+        returned as errors.
+    :return: StripeUser instances keyed by customer id, and errors of customers that could not be resolved.
+    """
+    customer_ids = set(customer_ids)
+    stripe_users = {stripe_user.customer_id: stripe_user for stripe_user in
+                    StripeUser.objects.filter(customer_id__in=customer_ids).select_related("user")}
+    missing_customer_ids = sorted(customer_ids - stripe_users.keys())
+    if not missing_customer_ids:
+        return stripe_users, {}
+    if not retrieve_missing:
+        return stripe_users, {
+            customer_id: StripeUser.DoesNotExist(f"No StripeUser exists with customer id '{customer_id}'.")
+            for customer_id in missing_customer_ids
+        }
+
+    errors = {}
+    customers = _stripe_api_retrieve_customers(missing_customer_ids, errors)
+
+    # the first customer listed for an email is linked to its user, like _update_customers()
+    customers_by_email = {}
+    for customer in customers:
+        if customer.email is None:
+            errors[customer.id] = CreatingNewUsersDisabledError(f"Stripe customer id '{customer.id}' has no email address so it cannot be linked to a Django user.")
+        else:
+            customers_by_email.setdefault(customer.email, customer)
+
+    # customers were retrieved before the transaction is opened, so it is not held open by Stripe API calls
+    with atomic():
+        users_by_email, _ = _resolve_users_by_email(customers_by_email, errors)
+
+        customer_id_by_user_id = {}
+        for customer in customers:
+            user = users_by_email.get(customer.email)
             if user:
-                stripe_user, stripe_user_created = StripeUser.objects.get_or_create(user=user,
-                                                                                    defaults={"customer_id": customer.id})
-                print(f"Updated Stripe Customer {customer.id}")
-
-                if user_created is True:
-                    user_creation_count += 1
-                if stripe_user_created is True:
-                    stripe_user_creation_count += 1
-            else:
-                print(f"Could not find Stripe Customer id '{customer.id}' in user model '{get_user_model()}' with '{drf_stripe_settings.DJANGO_USER_EMAIL_FIELD}' of '{customer.email}', USER_CREATE_DEFAULTS_ATTRIBUTE_MAP is not set so skipping Customer.")
-
-    print(f"{user_creation_count} user(s) created, {stripe_user_creation_count} user(s) linked to Stripe customers.")
+                customer_id_by_user_id.setdefault(user.id, customer.id)
+            elif customer.id not in errors:
+                errors[customer.id] = CreatingNewUsersDisabledError(f"No Django user exists with Stripe customer id '{customer.id}'s email and USER_CREATE_DEFAULTS_ATTRIBUTE_MAP is not set so a Django user cannot be created.")
+
+        _create_missing_stripe_users(customer_id_by_user_id)
+        stripe_users.update({stripe_user.customer_id: stripe_user for stripe_user in
+                             StripeUser.objects.filter(customer_id__in=missing_customer_ids).select_related("user")})
+
+    for customer in customers:
+        if customer.id not in stripe_users and customer.id not in errors:
+            # the customer's Django user is already linked to a different customer id, see get_or_create_stripe_user_from_customer()
+            errors[customer.id] = ValueError(f"A StripeUser record already exists for the Django user of customer id '{customer.id}' which references a different customer id")
+
+    return stripe_users, errors
+
+
+def _stripe_api_retrieve_customers(customer_ids: List[str], errors: Dict[str, Exception]) -> List[StripeCustomer]:
+    """
+    Retrieve Stripe customers concurrently, by the thread pool and within the rate limit shared by all syncs.
+
+    :param list customer_ids: Stripe customer ids.
+    :param dict errors: receives the errors of customers that could not be retrieved, keyed by customer id.
+    :return: retrieved customers, in the order of customer_ids.
+    """
+    retrieve = rate_limited(stripe.Customer.retrieve, get_shared_rate_limiter())
+    executor = get_shared_executor()
+    futures = [(customer_id, executor.submit(retrieve, customer_id)) for customer_id in customer_ids]
+
+    customers = []
+    for customer_id, future in futures:
+        try:
+            customers.append(StripeCustomer(**future.result()))
+        except Exception as e:
+            errors[customer_id] = e
+    return customers
+
+
+def _create_missing_stripe_users(customer_id_by_user_id: dict) -> int:
+    """
+    Create StripeUser instances in bulk for Django users that do not have one yet.
+    Existing StripeUser instances are left unchanged.
+
+    :param dict customer_id_by_user_id: Stripe customer id keyed by Django user id.
+    :return: number of StripeUser created.
+    """
+    existing_user_ids = set(
+        StripeUser.objects.filter(user_id__in=customer_id_by_user_id.keys()).values_list("user_id", flat=True))
+    stripe_users = [StripeUser(user_id=user_id, customer_id=customer_id)
+                    for user_id, customer_id in customer_id_by_user_id.items() if user_id not in existing_user_ids]
+    StripeUser.objects.bulk_create(stripe_users, ignore_conflicts=True)
+    return len(stripe_users)
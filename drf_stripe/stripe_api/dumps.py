@@ -0,0 +1,162 @@
+import json
+from functools import partial
+from operator import attrgetter
+from typing import Dict, Iterable, Iterator, List, TextIO
+
+from .customers import _update_customers
+from .products import _update_prices, _update_products
+from .subscriptions import _prepare_subscriptions, _update_subscriptions
+from .sync import SyncReport, parse_page_objects, write_page_objects
+from ..stripe_models.customer import StripeCustomer
+from ..stripe_models.price import StripePrice
+from ..stripe_models.product import StripeProduct
+from ..stripe_models.subscription import StripeSubscription
+
+"""
+Stripe object types that can be imported from dumps, in the order their database rows depend on each other.
+"""
+DUMP_OBJECT_TYPES = ("product", "price", "customer", "subscription")
+
+_DUMP_OBJECT_MODELS = {
+    "product": StripeProduct,
+    "price": StripePrice,
+    "customer": StripeCustomer,
+    "subscription": StripeSubscription,
+}
+
+_READ_SIZE = 64 * 1024
+
+_WHITESPACE = " \t\n\r"
+
+
+def iter_dump_objects(fp: TextIO) -> Iterator[dict]:
+    """
+    Parse Stripe objects from a JSON or JSON Lines file one at a time, so memory use does not depend on file size.
+    The file can contain Stripe objects or list API responses, either one per line (JSON Lines), or as elements of
+    a top level JSON array. Objects of list API responses are yielded one by one.
+    Invalid JSON raises a ValueError giving its line and column in the file.
+
+    :param fp: text file object.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    line_offset = 0  # number of lines read before the buffer's start
+    column_offset = 0  # number of characters of the buffer's first line read before the buffer's start
+    eof = False
+    in_array = False
+
+    def read_more():
+        nonlocal buffer, position, line_offset, column_offset, eof
+        last_line_break = buffer.rfind("\n", 0, position)
+        if last_line_break == -1:
+            column_offset += position
+        else:
+            line_offset += buffer.count("\n", 0, position)
+            column_offset = position - last_line_break - 1
+        # read at least as much as is buffered, so a value spanning many chunks is not parsed again for each chunk
+        chunk = fp.read(max(_READ_SIZE, len(buffer) - position))
+        buffer = buffer[position:] + chunk
+        position = 0
+        eof = not chunk
+
+    while True:
+        # skip whitespace and, inside a top level array, the separators between elements
+        while position < len(buffer) and (buffer[position] in _WHITESPACE or (in_array and buffer[position] == ",")):
+            position += 1
+
+        if position == len(buffer):
+            if eof:
+                if in_array:
+                    raise ValueError("Unexpected end of file, top level JSON array is not closed.")
+                return
+            read_more()
+            continue
+
+        if not in_array and buffer[position] == "[":
+            in_array = True
+            position += 1
+            continue
+        if in_array and buffer[position] == "]":
+            in_array = False
+            position += 1
+            continue
+
+        try:
+            value, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError as e:
+            # a value cut at the end of the buffer fails on its last token, which never spans a line break. An error
+            # followed by a line break in the buffer is invalid JSON, more data would not fix it.
+            if not eof and "\n" not in buffer[e.pos:]:
+                read_more()
+                continue
+            column = e.colno + column_offset if e.lineno == 1 else e.colno
+            raise ValueError(f"Invalid JSON at line {line_offset + e.lineno} column {column}: {e.msg}") from e
+
+        position = end
+        if isinstance(value, dict) and value.get("object") == "list":
+            yield from value.get("data", [])
+        else:
+            yield value
+
+
+def import_stripe_dump(paths: Iterable[str], object_types: Iterable[str] = DUMP_OBJECT_TYPES,
+                       batch_size: int = 100) -> Dict[str, SyncReport]:
+    """
+    Import Stripe products, prices, customers and subscriptions from JSON or JSON Lines dump files, see
+    iter_dump_objects(). Objects are written in batches, each in its own transaction. Stripe API is not called, so
+    objects must come after the objects they reference, in the same or an earlier file: products before their prices,
+    customers and prices before subscriptions.
+
+    Called from management command.
+
+    :param paths: paths of the dump files, imported in order.
+    :param object_types: Stripe object types to import, other objects are skipped.
+    :param int batch_size: number of objects of a type written per batch.
+    :return: SyncReport of each imported object type.
+    """
+    object_types = [object_type for object_type in DUMP_OBJECT_TYPES if object_type in set(object_types)]
+    reports = {object_type: SyncReport(object_type) for object_type in object_types}
+    batches: Dict[str, List[dict]] = {object_type: [] for object_type in object_types}
+
+    def flush(up_to_type: str):
+        # batches of the types a row depends on are written first, ie: products before prices
+        for object_type in object_types[:object_types.index(up_to_type) + 1]:
+            if batches[object_type]:
+                _import_batch(object_type, batches[object_type], reports[object_type])
+                batches[object_type] = []
+
+    for path in paths:
+        with open(path, encoding="utf-8") as fp:
+            for data in iter_dump_objects(fp):
+                object_type = data.get("object") if isinstance(data, dict) else None
+                if object_type not in batches:
+                    continue
+                batches[object_type].append(data)
+                if len(batches[object_type]) >= batch_size:
+                    flush(object_type)
+
+    if object_types:
+        flush(object_types[-1])
+
+    for report in reports.values():
+        report.finish()
+    return reports
+
+
+def _import_batch(object_type: str, batch: List[dict], report: SyncReport):
+    """Write a batch of dumped Stripe objects of one type in a transaction, see write_page_objects()."""
+    report.pages += 1
+    with report.write_page(len(batch)):
+        stripe_objects = parse_page_objects(_DUMP_OBJECT_MODELS[object_type], {"data": batch}, report)
+        if object_type == "product":
+            write_page_objects(report, stripe_objects, partial(_update_products, report=report), attrgetter("id"))
+        elif object_type == "price":
+            write_page_objects(report, stripe_objects, partial(_update_prices, report=report), attrgetter("id"))
+        elif object_type == "customer":
+            write_page_objects(report, stripe_objects, partial(_update_customers, report=report), attrgetter("id"))
+        else:
+            subscriptions, items_by_subscription = _prepare_subscriptions(stripe_objects, report, offline=True)
+            write_page_objects(report, subscriptions, partial(_update_subscriptions,
+                                                              items_by_subscription=items_by_subscription,
+                                                              report=report), attrgetter("pk"))
@@ -0,0 +1,37 @@
+from hashlib import blake2b
+from typing import List, Type
+
+from django.db.models import Model
+
+
+def make_fingerprint(*values) -> str:
+    """
+    Returns a compact hash of the Stripe field values synced to a database row.
+    Rows store the fingerprint of the values they were last written with, so unchanged Stripe objects can be skipped.
+
+    :param values: field values, in a fixed order. Values must have a stable repr(), ie: str, int, datetime, tuple.
+    """
+    return blake2b(repr(values).encode(), digest_size=16).hexdigest()
+
+
+def is_unchanged(model: Type[Model], pk: str, fingerprint: str) -> bool:
+    """
+    Check whether a database row was last written with the given fingerprint.
+
+    :param model: model class with a 'fingerprint' field.
+    :param str pk: primary key of the row.
+    :param str fingerprint: fingerprint of the new Stripe field values.
+    """
+    return model.objects.filter(pk=pk, fingerprint=fingerprint).exists()
+
+
+def exclude_unchanged(model: Type[Model], objs: List[Model]) -> List[Model]:
+    """
+    Returns the model instances whose fingerprint differs from the stored row, or which have no stored row yet.
+    Stored fingerprints are loaded in one query.
+
+    :param model: model class with a 'fingerprint' field.
+    :param list objs: unsaved model instances with primary key and fingerprint set.
+    """
+    stored = dict(model.objects.filter(pk__in=[obj.pk for obj in objs]).values_list("pk", "fingerprint"))
+    return [obj for obj in objs if obj.pk not in stored or stored[obj.pk] != obj.fingerprint]
@@ -0,0 +1,20 @@
+from typing import Callable, Iterator
+
+
+def iter_stripe_list_pages(list_fn: Callable, limit: int = 100, starting_after: str = None, **params) -> Iterator:
+    """
+    Call a Stripe list API repeatedly, following has_more and starting_after until the last page.
+    Pages are fetched lazily and yielded one at a time, so only the current page is held in memory.
+
+    :param list_fn: Stripe list API function, ie: stripe.Customer.list
+    :param int limit: number of objects per page (between 1 and 100).
+    :param str starting_after: object id to start retrieval after.
+    :param params: additional parameters passed to list_fn.
+    """
+    while True:
+        page = list_fn(limit=limit, starting_after=starting_after, **params)
+        yield page
+
+        if not page["has_more"] or not page["data"]:
+            return
+        starting_after = page["data"][-1]["id"]
@@ -1,89 +1,144 @@
-from django.db.models import Q
+import logging
+from itertools import chain
+from typing import List
+
 from django.db.transaction import atomic
 
+from drf_stripe.catalog import invalidate_catalog_snapshot
+from drf_stripe.entitlements import refresh_product_entitlements
 from drf_stripe.models import Product, Price, Feature, ProductFeature
 from .api import stripe_api as stripe
-from ..stripe_models.price import StripePrices
-from ..stripe_models.product import StripeProducts
+from .bulk import bulk_upsert
+from .fingerprint import exclude_unchanged, make_fingerprint
+from .pagination import iter_stripe_list_pages
+from .sync import PRICES_SYNC, PRODUCTS_SYNC, SyncReport, parse_page_objects
+from ..stripe_models.price import StripePrice
+from ..stripe_models.product import StripeProduct
+
+logger = logging.getLogger(__name__)
 
 
 @atomic()
 def stripe_api_update_products_prices(**kwargs):
     """
-    Fetches list of Products and Price from Stripe, updates database.
+    Fetches all Products and Prices from Stripe, updates database.
     :key dict test_products: mock event data for testing
     :key dict test_prices: mock event data for testing
+    :key product_pages: iterable of stripe.Product.list() responses, used instead of retrieving products.
+    :key price_pages: iterable of stripe.Price.list() responses, used instead of retrieving prices.
+    :return: SyncReport of products and of prices.
     """
-    _stripe_api_fetch_update_products(**kwargs)
-    _stripe_api_fetch_update_prices(**kwargs)
+    return [_stripe_api_fetch_update_products(**kwargs), _stripe_api_fetch_update_prices(**kwargs)]
 
 
-def _stripe_api_fetch_update_products(test_products=None, **kwargs):
+def _stripe_api_fetch_update_products(test_products=None, product_pages=None, **kwargs):
     """
-    Fetch list of Stripe Products and updates database.
+    Fetch all Stripe Products page by page and updates database.
 
     :param dict test_products:  Response from calling Stripe API: stripe.Product.list(). Used for testing.
+    :param product_pages: Optional, iterable of responses from calling Stripe API: stripe.Product.list().
+    :return: SyncReport of the sync.
     """
-    if test_products is None:
-        products_data = stripe.Product.list(limit=100)
+    if test_products is not None:
+        pages = [test_products]
+    elif product_pages is not None:
+        pages = product_pages
     else:
-        products_data = test_products
-
-    products = StripeProducts(**products_data).data
+        pages = iter_stripe_list_pages(stripe.Product.list)
 
-    creation_count = 0
-    for product in products:
-        product_obj, created = Product.objects.update_or_create(
-            product_id=product.id,
-            defaults={
-                "active": product.active,
-                "description": product.description,
-                "name": product.name
-            }
-        )
-        create_update_product_features(product)
-        if created is True:
-            creation_count += 1
+    report = SyncReport(PRODUCTS_SYNC)
+    for products_data in report.iter_pages(pages):
+        with report.write_page(len(products_data["data"])):
+            _update_products(parse_page_objects(StripeProduct, products_data, report), report)
 
-    print(f"Created {creation_count} new Products")
+    report.finish()
+    return report
 
 
-def _stripe_api_fetch_update_prices(test_prices=None, **kwargs):
+def _stripe_api_fetch_update_prices(test_prices=None, price_pages=None, **kwargs):
     """
-    Fetch list of Stripe Prices and updates database.
+    Fetch all Stripe Prices page by page and updates database.
 
     :param dict test_prices: Optional, response from calling Stripe API: stripe.Price.list(). Used for testing.
+    :param price_pages: Optional, iterable of responses from calling Stripe API: stripe.Price.list().
+    :return: SyncReport of the sync.
     """
-    if test_prices is None:
-        prices_data = stripe.Price.list(limit=100)
+    if test_prices is not None:
+        pages = [test_prices]
+    elif price_pages is not None:
+        pages = price_pages
     else:
-        prices_data = test_prices
+        pages = iter_stripe_list_pages(stripe.Price.list)
 
-    prices = StripePrices(**prices_data).data
+    report = SyncReport(PRICES_SYNC)
+    for prices_data in report.iter_pages(pages):
+        with report.write_page(len(prices_data["data"])):
+            _update_prices(parse_page_objects(StripePrice, prices_data, report), report)
 
-    creation_count = 0
-    for price in prices:
-        price_obj, created = Price.objects.update_or_create(
-            price_id=price.id,
-            defaults={
-                "product_id": price.product,
-                "nickname": price.nickname,
-                "price": price.unit_amount,
-                "freq": get_freq_from_stripe_price(price),
-                "active": price.active,
-                "currency": price.currency
-            }
-        )
-        if created is True:
-            creation_count += 1
+    report.finish()
+    return report
 
-    print(f"Created {creation_count} new Prices")
+
+def _update_products(products: List[StripeProduct], report: SyncReport) -> int:
+    """
+    Update Product and ProductFeature instances for a batch of Stripe products, skipping unchanged products.
+
+    :param SyncReport report: report receiving the number of products created, updated and skipped.
+    :return: number of Products created.
+    """
+    changed_products = exclude_unchanged(Product, [
+        Product(product_id=product.id, active=product.active, description=product.description, name=product.name,
+                fingerprint=get_product_fingerprint(product))
+        for product in products
+    ])
+    creation_count, update_count = bulk_upsert(Product, changed_products,
+                                               update_fields=["active", "description", "name", "fingerprint"])
+    report.add_counts(created=creation_count, updated=update_count, skipped=len(products) - len(changed_products))
+    changed_product_ids = {product.pk for product in changed_products}
+    update_products_features([product for product in products if product.id in changed_product_ids])
+    if changed_products:
+        invalidate_catalog_snapshot()
+    return creation_count
+
+
+def _update_prices(prices: List[StripePrice], report: SyncReport) -> int:
+    """
+    Update Price instances for a batch of Stripe prices, skipping unchanged prices.
+
+    :param SyncReport report: report receiving the number of prices created, updated and skipped.
+    :return: number of Prices created.
+    """
+    changed_prices = exclude_unchanged(Price, [
+        Price(price_id=price.id, product_id=price.product, nickname=price.nickname, price=price.unit_amount,
+              freq=get_freq_from_stripe_price(price), active=price.active, currency=price.currency,
+              fingerprint=get_price_fingerprint(price))
+        for price in prices
+    ])
+    creation_count, update_count = bulk_upsert(Price, changed_prices,
+                                               update_fields=["product", "nickname", "price", "freq", "active",
+                                                              "currency", "fingerprint"])
+    report.add_counts(created=creation_count, updated=update_count, skipped=len(prices) - len(changed_prices))
+    if changed_prices:
+        invalidate_catalog_snapshot()
+    return creation_count
 
 
 def get_freq_from_stripe_price(price_data):
     """Get 'freq' string from Stripe price data"""
     if price_data.recurring:
-        return f"{price_data.recurring.interval}_{price_data.recurring.interval_count}"
+        return f"{price_data.recurring.interval.value}_{price_data.recurring.interval_count}"
+
+
+def get_product_fingerprint(product_data) -> str:
+    """Returns the fingerprint of the Product fields and features synced from Stripe product data."""
+    return make_fingerprint(product_data.active, product_data.description, product_data.name,
+                            tuple(_get_feature_ids_from_stripe_product(product_data)))
+
+
+def get_price_fingerprint(price_data) -> str:
+    """Returns the fingerprint of the Price fields synced from Stripe price data."""
+    return make_fingerprint(price_data.product, price_data.nickname, price_data.unit_amount,
+                            get_freq_from_stripe_price(price_data), price_data.active, price_data.currency)
 
 
 @atomic
@@ -93,21 +148,62 @@ def create_update_product_features(product_data):
     The features are specified in Stripe Product object metadata.features as space delimited strings.
     See https://stripe.com/docs/api/products/object#product_object-metadata
     """
-    if hasattr(product_data, "metadata") and \
-            hasattr(product_data.metadata, "features") and \
-            product_data.metadata.features:
-        features = product_data.metadata.features.split(" ")
+    update_products_features([product_data])
 
-        ProductFeature.objects.filter(Q(product_id=product_data.id) & ~Q(feature_id__in=features)).delete()
 
-        for feature_id in features:
-            feature_id = feature_id.strip()
-            feature, created_new_feature = Feature.objects.get_or_create(
-                feature_id=feature_id,
-                defaults={"description": feature_id}
-            )
-            ProductFeature.objects.get_or_create(product_id=product_data.id, feature=feature)
+def update_products_features(products_data: List[StripeProduct]):
+    """
+    Create/update Feature and ProductFeature instances for a batch of products given product data.
+    Existing product features are loaded in one query, then only missing Feature and ProductFeature instances are
+    created and ProductFeature instances no longer listed are deleted.
+    Products without features in metadata are left unchanged.
+    Entitlements of the products' subscribers are refreshed when links between products and features change.
 
-            if created_new_feature:
-                print(
-                    f"Created new feature_id {feature_id}, please set feature description manually in database.")
+    :param list products_data: Stripe products.
+    """
+    feature_ids_by_product = {product.id: _get_feature_ids_from_stripe_product(product) for product in products_data}
+    feature_ids_by_product = {product_id: feature_ids for product_id, feature_ids in feature_ids_by_product.items()
+                              if feature_ids}
+    if not feature_ids_by_product:
+        return
+
+    feature_ids = set(chain.from_iterable(feature_ids_by_product.values()))
+    existing_feature_ids = set(Feature.objects.filter(feature_id__in=feature_ids).values_list("feature_id", flat=True))
+    new_feature_ids = sorted(feature_ids - existing_feature_ids)
+    Feature.objects.bulk_create([Feature(feature_id=feature_id, description=feature_id)
+                                 for feature_id in new_feature_ids], ignore_conflicts=True)
+    for feature_id in new_feature_ids:
+        logger.warning("Created new feature_id %s, please set feature description manually in database.", feature_id)
+
+    wanted_links = {(product_id, feature_id) for product_id, feature_ids in feature_ids_by_product.items()
+                    for feature_id in feature_ids}
+    existing_links = set()
+    links_to_delete = []
+    changed_product_ids = set()
+    for pk, product_id, feature_id in ProductFeature.objects.filter(
+            product_id__in=feature_ids_by_product.keys()).values_list("pk", "product_id", "feature_id"):
+        if (product_id, feature_id) in wanted_links and (product_id, feature_id) not in existing_links:
+            existing_links.add((product_id, feature_id))
+        else:
+            links_to_delete.append(pk)
+            changed_product_ids.add(product_id)
+
+    links_to_create = sorted(wanted_links - existing_links)
+    changed_product_ids.update(product_id for product_id, _ in links_to_create)
+    if links_to_delete:
+        ProductFeature.objects.filter(pk__in=links_to_delete).delete()
+    ProductFeature.objects.bulk_create([ProductFeature(product_id=product_id, feature_id=feature_id)
+                                        for product_id, feature_id in links_to_create])
+    if changed_product_ids:
+        refresh_product_entitlements(changed_product_ids)
+    if new_feature_ids or changed_product_ids:
+        invalidate_catalog_snapshot()
+
+
+def _get_feature_ids_from_stripe_product(product_data) -> List[str]:
+    """Returns the unique feature ids listed in Stripe product metadata.features, in listed order."""
+    if hasattr(product_data, "metadata") and \
+            hasattr(product_data.metadata, "features") and \
+            product_data.metadata.features:
+        return list(dict.fromkeys(product_data.metadata.features.split()))
+    return []
@@ -0,0 +1,45 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from .api import stripe_api as stripe
+from .concurrency import RateLimiter, PrefetchedPages, rate_limited
+from .customers import stripe_api_update_customers
+from .pagination import iter_stripe_list_pages
+from .products import stripe_api_update_products_prices
+from .subscriptions import stripe_api_update_subscriptions
+
+
+def stripe_api_pull_concurrently(workers: int = 4, rate_limit: float = 20, max_buffered_pages: int = 2):
+    """
+    Fetch products, prices, customers and subscriptions from Stripe and update database.
+    Pages are fetched on a pool of threads, ahead of the database updates which run in the calling thread in the same
+    order as the 'pull_stripe' command: products, prices, customers then subscriptions.
+
+    Called from management command.
+
+    :param int workers: number of threads fetching from Stripe. Each type of object is listed one page after another
+        by a single thread, so at most 4 threads are used.
+    :param float rate_limit: maximum number of Stripe API requests per second, shared by all threads.
+    :param int max_buffered_pages: maximum number of pages fetched ahead for each type of object.
+    :return: SyncReport of products, prices, customers and subscriptions.
+    """
+    rate_limiter = RateLimiter(rate_limit)
+    # fetching starts in this order, which is also the order pages are consumed in
+    list_fns = (stripe.Product.list, stripe.Price.list, stripe.Customer.list, stripe.Subscription.list)
+
+    # pages of a list are fetched one after another, threads beyond one per list would stay idle
+    with ThreadPoolExecutor(max_workers=min(workers, len(list_fns)), thread_name_prefix="drf_stripe_pull") as executor:
+        all_pages = [
+            PrefetchedPages(iter_stripe_list_pages(rate_limited(list_fn, rate_limiter)), executor, max_buffered_pages)
+            for list_fn in list_fns
+        ]
+        product_pages, price_pages, customer_pages, subscription_pages = all_pages
+
+        try:
+            reports = stripe_api_update_products_prices(product_pages=product_pages, price_pages=price_pages)
+            reports.append(stripe_api_update_customers(pages=customer_pages))
+            reports.append(stripe_api_update_subscriptions(pages=subscription_pages))
+        finally:
+            for pages in all_pages:
+                pages.close()
+
+    return reports
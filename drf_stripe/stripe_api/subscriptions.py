@@ -1,15 +1,31 @@
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta
+from functools import partial
 from itertools import chain
 from operator import attrgetter
-from typing import Literal, List
+from typing import Literal, List, Dict, Tuple
 
-from django.db.models import Q
+from django.db.models import Prefetch, Q
 from django.db.models import QuerySet
 from django.db.transaction import atomic
+from django.utils import timezone
 
 from drf_stripe.stripe_api.api import stripe_api as stripe
-from .customers import get_or_create_stripe_user, CreatingNewUsersDisabledError
-from ..models import Subscription, Price, SubscriptionItem
-from ..stripe_models.subscription import ACCESS_GRANTING_STATUSES, StripeSubscriptions
+from drf_stripe.stripe_api.bulk import bulk_upsert
+from drf_stripe.stripe_api.concurrency import get_shared_executor, get_shared_rate_limiter, rate_limited
+from drf_stripe.stripe_api.fingerprint import exclude_unchanged, make_fingerprint
+from drf_stripe.stripe_api.pagination import iter_stripe_list_pages
+from drf_stripe.stripe_api.sync import STRIPE_EVENT_RETENTION_PERIOD, SUBSCRIPTIONS_SYNC, SyncReport, \
+    get_event_created, get_latest_stripe_event, get_sync_checkpoint, get_sync_cursor, parse_page_objects, \
+    save_sync_checkpoint, save_sync_cursor, write_page_objects
+from .customers import get_stripe_users_by_customer_id, CreatingNewUsersDisabledError
+from ..entitlements import refresh_user_entitlements
+from ..models import ArchivedSubscription, Subscription, Price, ProductFeature, SubscriptionItem
+from ..stripe_models.subscription import ACCESS_GRANTING_STATUSES, StripeSubscription, StripeSubscriptionItems, \
+    StripeSubscriptionItemsDataItem
+
+logger = logging.getLogger(__name__)
 
 """
 status argument, see https://stripe.com/docs/api/subscriptions/list?lang=python#list_subscriptions-status
@@ -27,106 +43,359 @@ STATUS_ARG = Literal[
 ]
 
 
-@atomic
+SUBSCRIPTION_EVENT_TYPES = "customer.subscription.*"
+
+SUBSCRIPTION_UPDATE_FIELDS = [
+    "stripe_user", "period_start", "period_end", "cancel_at", "cancel_at_period_end", "ended_at", "status",
+    "trial_end", "trial_start", "fingerprint"
+]
+
+
+ARCHIVED_SUBSCRIPTION_FIELDS = [
+    "subscription_id", "stripe_user_id", "period_start", "period_end", "cancel_at", "cancel_at_period_end", "ended_at",
+    "status", "trial_end", "trial_start"
+]
+
+
 def stripe_api_update_subscriptions(status: STATUS_ARG = None, limit: int = 100, starting_after: str = None,
-                                    test_data=None, ignore_new_user_creation_errors = False):
+                                    test_data=None, ignore_new_user_creation_errors = False, pages=None,
+                                    incremental=False, resume=False) -> SyncReport:
     """
     Retrieve all subscriptions. Updates database.
+    Each page is committed in its own transaction together with a checkpoint, subscriptions that cannot be synced are
+    recorded in the returned report and skipped.
 
     Called from management command.
 
     :param STATUS_ARG status: subscription status to retrieve.
-    :param int limit: number of instances to retrieve( between 0 and 100).
+    :param int limit: number of instances to retrieve per page (between 0 and 100).
     :param str starting_after: subscription id to start retrieving.
     :param test_data: response data from Stripe API stripe.Subscription.list, used for testing
-    :param ignore_new_user_creation_errors: if True, CreatingNewUsersDisabledError thrown by get_or_create_stripe_user() will be skipped
+    :param ignore_new_user_creation_errors: if True, subscriptions whose customer has no Django user while
+        USER_CREATE_DEFAULTS_ATTRIBUTE_MAP is not set (CreatingNewUsersDisabledError) are skipped without being
+        reported as errors.
+    :param pages: iterable of stripe.Subscription.list API responses, used instead of retrieving subscriptions.
+    :param bool incremental: if True, only update subscriptions changed since the last incremental sync, using
+        Stripe subscription events. Retrieves all subscriptions if there was no incremental sync within the last
+        30 days, which is how long Stripe keeps events for.
+    :param bool resume: if True, start retrieving after the last page committed by an interrupted sync.
+    :return: SyncReport listing the subscriptions that could not be synced.
     """
 
     if limit < 0 or limit > 100:
         raise ValueError("Argument limit should be a positive integer no greater than 100.")
 
-    if test_data is None:
-        subscriptions_response = stripe.Subscription.list(status=status, limit=limit, starting_after=starting_after)
+    report = SyncReport(SUBSCRIPTIONS_SYNC)
+    latest_event = None
+    started_at = None
+    checkpoint_filters = {"status": status, "incremental": incremental}
+    if test_data is not None:
+        pages = [test_data]
+    elif pages is None:
+        if incremental:
+            # without events to record, the next incremental sync starts from the time this one started
+            started_at = timezone.now()
+            since = get_sync_cursor(SUBSCRIPTIONS_SYNC)
+            if since is not None and since > timezone.now() - STRIPE_EVENT_RETENTION_PERIOD:
+                _stripe_api_update_subscriptions_from_events(since, started_at, report, ignore_new_user_creation_errors)
+                report.finish()
+                return report
+            # changes made while retrieving all subscriptions are picked up by the next incremental sync
+            latest_event = get_latest_stripe_event(type=SUBSCRIPTION_EVENT_TYPES)
+
+        if resume:
+            starting_after = get_sync_checkpoint(SUBSCRIPTIONS_SYNC, checkpoint_filters) or starting_after
+        pages = iter_stripe_list_pages(stripe.Subscription.list, limit=limit, starting_after=starting_after,
+                                       status=status)
+
+    for subscriptions_response in report.iter_pages(pages):
+        with report.write_page(len(subscriptions_response["data"])):
+            stripe_subscriptions = parse_page_objects(StripeSubscription, subscriptions_response, report)
+            with report.fetching():
+                subscriptions, items_by_subscription = _prepare_subscriptions(stripe_subscriptions, report,
+                                                                              ignore_new_user_creation_errors)
+            save_checkpoint = None
+            if subscriptions_response["data"]:
+                save_checkpoint = partial(save_sync_checkpoint, SUBSCRIPTIONS_SYNC,
+                                          subscriptions_response["data"][-1]["id"], checkpoint_filters)
+            write_page_objects(report, subscriptions,
+                               partial(_update_subscriptions, items_by_subscription=items_by_subscription,
+                                       report=report),
+                               get_object_id=attrgetter("pk"), after_write=save_checkpoint)
+
+    with atomic():
+        save_sync_checkpoint(SUBSCRIPTIONS_SYNC, None)
+        if latest_event is not None:
+            save_sync_cursor(SUBSCRIPTIONS_SYNC, get_event_created(latest_event), latest_event["id"])
+        elif started_at is not None:
+            save_sync_cursor(SUBSCRIPTIONS_SYNC, started_at)
+
+    report.finish()
+    return report
+
+
+def _stripe_api_update_subscriptions_from_events(since: datetime, started_at: datetime, report: SyncReport,
+                                                 ignore_new_user_creation_errors=False):
+    """
+    Update subscriptions changed since the given time, from Stripe subscription events.
+    Events are listed newest first, so only the latest state of each subscription is applied.
+
+    :param datetime since: retrieve events created at or after this time.
+    :param datetime started_at: start time of the sync, recorded as the cursor when there is no event.
+    :param SyncReport report: report receiving the subscriptions that could not be synced.
+    :param ignore_new_user_creation_errors: if True, CreatingNewUsersDisabledError is not reported.
+    """
+    latest_event = None
+    subscription_ids = set()
+    events_pages = iter_stripe_list_pages(stripe.Event.list, type=SUBSCRIPTION_EVENT_TYPES,
+                                          created={"gte": int(since.timestamp())})
+
+    for events_response in report.iter_pages(events_pages):
+        subscriptions_data = []
+        for event in events_response["data"]:
+            latest_event = latest_event or event
+            subscription = event["data"]["object"]
+            if subscription["id"] not in subscription_ids:
+                subscription_ids.add(subscription["id"])
+                subscriptions_data.append(subscription)
+
+        with report.write_page(len(subscriptions_data)):
+            stripe_subscriptions = parse_page_objects(StripeSubscription, {"data": subscriptions_data}, report)
+            with report.fetching():
+                subscriptions, items_by_subscription = _prepare_subscriptions(stripe_subscriptions, report,
+                                                                              ignore_new_user_creation_errors)
+            write_page_objects(report, subscriptions,
+                               partial(_update_subscriptions, items_by_subscription=items_by_subscription,
+                                       report=report),
+                               get_object_id=attrgetter("pk"))
+
+    if latest_event is not None:
+        save_sync_cursor(SUBSCRIPTIONS_SYNC, get_event_created(latest_event), latest_event["id"])
     else:
-        subscriptions_response = test_data
+        save_sync_cursor(SUBSCRIPTIONS_SYNC, started_at)
 
-    stripe_subscriptions = StripeSubscriptions(**subscriptions_response).data
 
-    creation_count = 0
+def _prepare_subscriptions(stripe_subscriptions: List[StripeSubscription], report: SyncReport,
+                           ignore_new_user_creation_errors=False, offline=False) \
+        -> Tuple[List[Subscription], Dict[str, List[StripeSubscriptionItemsDataItem]]]:
+    """
+    Build Subscription instances and collect the items of a page of Stripe subscriptions, before they are written
+    by _update_subscriptions(). StripeUser instances of the page's customers are resolved in batch, see
+    get_stripe_users_by_customer_id(), and remaining subscription items are retrieved. Stripe API calls are made here,
+    so that they do not hold the page's transaction open. Subscriptions moved to ArchivedSubscription are skipped, so
+    ended subscriptions still listed by Stripe are not brought back.
+
+    :param SyncReport report: report receiving the subscriptions that could not be synced.
+    :param ignore_new_user_creation_errors: if True, CreatingNewUsersDisabledError is not reported.
+    :param bool offline: if True, Stripe API is not called. Subscriptions whose customer has no StripeUser, or whose
+        items are not all embedded, are reported instead.
+    :return: Subscription instances, and Stripe subscription items data keyed by subscription id.
+    """
+    archived_ids = set(ArchivedSubscription.objects.filter(
+        subscription_id__in=[subscription.id for subscription in stripe_subscriptions]
+    ).values_list("subscription_id", flat=True))
+    if archived_ids:
+        report.add_counts(skipped=len(archived_ids))
+        stripe_subscriptions = [subscription for subscription in stripe_subscriptions
+                                if subscription.id not in archived_ids]
+
+    subscriptions = []
+    items_by_subscription = {}
+    stripe_users, errors = get_stripe_users_by_customer_id(
+        (subscription.customer for subscription in stripe_subscriptions), retrieve_missing=not offline)
+    if offline:
+        item_errors = {subscription.id: ValueError("Subscription items list is incomplete.")
+                       for subscription in stripe_subscriptions
+                       if subscription.items is not None and subscription.items.has_more}
+    else:
+        item_errors = stripe_api_fetch_remaining_subscription_items(stripe_subscriptions)
 
     for subscription in stripe_subscriptions:
-        try:
-            stripe_user = get_or_create_stripe_user(customer_id=subscription.customer)
-
-            _, created = Subscription.objects.update_or_create(
-                subscription_id=subscription.id,
-                defaults={
-                    "stripe_user": stripe_user,
-                    "period_start": subscription.current_period_start,
-                    "period_end": subscription.current_period_end,
-                    "cancel_at": subscription.cancel_at,
-                    "cancel_at_period_end": subscription.cancel_at_period_end,
-                    "ended_at": subscription.ended_at,
-                    "status": subscription.status,
-                    "trial_end": subscription.trial_end,
-                    "trial_start": subscription.trial_start
-                }
-            )
-            print(f"Updated subscription {subscription.id}")
-            _update_subscription_items(subscription.id, subscription.items.data)
-            if created is True:
-                creation_count += 1
-        except CreatingNewUsersDisabledError as e:
-            if not ignore_new_user_creation_errors:
-                raise e
+        if subscription.id in item_errors:
+            report.add_error(subscription.id, item_errors[subscription.id])
+            continue
+
+        stripe_user = stripe_users.get(subscription.customer)
+        if stripe_user is None:
+            error = errors.get(subscription.customer)
+            if isinstance(error, CreatingNewUsersDisabledError) and ignore_new_user_creation_errors:
+                logger.info("User for customer id '%s' with subscription '%s' does not exist, skipping.",
+                            subscription.customer, subscription.id)
+                report.add_counts(skipped=1)
             else:
-                print(f"User for customer id '{subscription.customer}' with subscription '{subscription.id}' does not exist, skipping.")
+                report.add_error(subscription.id, error)
+            continue
+
+        subscriptions.append(Subscription(
+            subscription_id=subscription.id,
+            stripe_user=stripe_user,
+            period_start=subscription.current_period_start,
+            period_end=subscription.current_period_end,
+            cancel_at=subscription.cancel_at,
+            cancel_at_period_end=subscription.cancel_at_period_end,
+            ended_at=subscription.ended_at,
+            status=subscription.status,
+            trial_end=subscription.trial_end,
+            trial_start=subscription.trial_start,
+            fingerprint=get_subscription_fingerprint(subscription)
+        ))
+        items_by_subscription[subscription.id] = subscription.items.data
+
+    return subscriptions, items_by_subscription
+
+
+def _update_subscriptions(subscriptions: List[Subscription],
+                          items_by_subscription: Dict[str, List[StripeSubscriptionItemsDataItem]],
+                          report: SyncReport) -> int:
+    """
+    Write Subscription and SubscriptionItem instances of a page prepared by _prepare_subscriptions(). Only the
+    subscriptions that changed are written. Called inside the page's transaction.
+
+    :param list subscriptions: Subscription instances.
+    :param dict items_by_subscription: Stripe subscription items data keyed by subscription id.
+    :param SyncReport report: report receiving the counts of written subscriptions.
+    :return: number of Subscriptions created.
+    """
+    changed_subscriptions = exclude_unchanged(Subscription, subscriptions)
+    creation_count, update_count = bulk_upsert(Subscription, changed_subscriptions,
+                                               update_fields=SUBSCRIPTION_UPDATE_FIELDS)
+    update_subscription_items({subscription.pk: items_by_subscription[subscription.pk]
+                               for subscription in changed_subscriptions})
+    refresh_user_entitlements(subscription.stripe_user_id for subscription in changed_subscriptions)
+    report.add_counts(created=creation_count, updated=update_count,
+                      skipped=len(subscriptions) - len(changed_subscriptions))
+
+    return creation_count
+
+
+def stripe_api_fetch_remaining_subscription_items(stripe_subscriptions: List[StripeSubscription]) \
+        -> Dict[str, Exception]:
+    """
+    Stripe subscription objects embed only the first page of their items. For subscriptions whose items list has more
+    pages, retrieve the remaining items and append them to the subscription's items.data in place.
+    Items of different subscriptions are retrieved concurrently, by the thread pool and within the rate limit shared
+    by all syncs, see settings STRIPE_API_FETCH_WORKERS and STRIPE_API_FETCH_RATE_LIMIT.
+
+    :param list stripe_subscriptions: Stripe subscriptions.
+    :return: errors of subscriptions whose items could not be retrieved, keyed by subscription id.
+    """
+    incomplete_subscriptions = [subscription for subscription in stripe_subscriptions
+                                if subscription.items is not None and subscription.items.has_more]
+    if not incomplete_subscriptions:
+        return {}
+
+    list_items = rate_limited(stripe.SubscriptionItem.list, get_shared_rate_limiter())
 
-    print(f"Created {creation_count} new Subscriptions.")
+    def fetch_remaining_items(subscription: StripeSubscription) -> List[StripeSubscriptionItemsDataItem]:
+        starting_after = subscription.items.data[-1].id if subscription.items.data else None
+        pages = iter_stripe_list_pages(list_items, starting_after=starting_after, subscription=subscription.id)
+        return list(chain.from_iterable(StripeSubscriptionItems(**page).data for page in pages))
 
+    executor = get_shared_executor()
+    futures = [(subscription, executor.submit(fetch_remaining_items, subscription))
+               for subscription in incomplete_subscriptions]
 
-def _update_subscription_items(subscription_id, items_data):
-    SubscriptionItem.objects.filter(subscription=subscription_id).delete()
-    for item in items_data:
-        _, created = SubscriptionItem.objects.update_or_create(
-            sub_item_id=item.id,
-            defaults={
-                "subscription_id": subscription_id,
-                "price_id": item.price.id,
-                "quantity": item.quantity
-            }
+    errors = {}
+    for subscription, future in futures:
+        try:
+            subscription.items.data.extend(future.result())
+            subscription.items.has_more = False
+        except Exception as e:
+            errors[subscription.id] = e
+    return errors
+
+
+def get_subscription_fingerprint(subscription: StripeSubscription) -> str:
+    """Returns the fingerprint of the Subscription fields and subscription items synced from a Stripe subscription."""
+    items = tuple(sorted((item.id, item.price.id, item.quantity) for item in subscription.items.data))
+    return make_fingerprint(subscription.customer, subscription.current_period_start, subscription.current_period_end,
+                            subscription.cancel_at, subscription.cancel_at_period_end, subscription.ended_at,
+                            subscription.status, subscription.trial_end, subscription.trial_start, items)
+
+
+def update_subscription_items(items_by_subscription: Dict[str, List[StripeSubscriptionItemsDataItem]]):
+    """
+    Synchronize SubscriptionItem instances of the given subscriptions with Stripe subscription items data.
+    Existing items are loaded in one query, then only new, changed and removed items are written.
+
+    :param dict items_by_subscription: Stripe subscription items data keyed by subscription id.
+    :return: number of created, updated and deleted items.
+    """
+    items_data = {item.id: (subscription_id, item) for subscription_id, items in items_by_subscription.items()
+                  for item in items}
+
+    existing_items = {
+        item.sub_item_id: item for item in SubscriptionItem.objects.filter(
+            Q(subscription_id__in=items_by_subscription.keys()) | Q(sub_item_id__in=items_data.keys())
         )
-        print(f"Updated sub item {item.id}")
-
-
-# def _stripe_api_update_subscription_items(subscription_id, limit=100, ending_before=None, test_data=None):
-#     """
-#     param: str subscription_id: subscription id for which to retrieve subscription items
-#     :param int limit: number of instances to retrieve( between 0 and 100).
-#     :param str ending_before: subscription item id to retrieve before.
-#     """
-#     if limit < 0 or limit > 100:
-#         raise ValueError("Argument limit should be a positive integer no greater than 100.")
-#
-#     if test_data is None:
-#         items_response = stripe.SubscriptionItem.list(subscription=subscription_id,
-#                                                       limit=limit,
-#                                                       ending_before=ending_before)
-#     else:
-#         items_response = test_data
-#
-#     sub_items = StripeSubscriptionItems(**items_response).data
-#
-#     SubscriptionItem.objects.filter(subscription=subscription_id).delete()
-#     for item in sub_items:
-#         SubscriptionItem.objects.update_or_create(
-#             sub_item_id=item.id,
-#             defaults={
-#                 "subscription_id": subscription_id,
-#                 "price_id": item.price.id,
-#                 "quantity": item.quantity
-#             }
-#         )
+    }
+
+    items_to_create = []
+    items_to_update = []
+    for sub_item_id, (subscription_id, item) in items_data.items():
+        sub_item = existing_items.pop(sub_item_id, None)
+        if sub_item is None:
+            items_to_create.append(SubscriptionItem(sub_item_id=sub_item_id, subscription_id=subscription_id,
+                                                    price_id=item.price.id, quantity=item.quantity))
+        elif (sub_item.subscription_id, sub_item.price_id, sub_item.quantity) != \
+                (subscription_id, item.price.id, item.quantity):
+            sub_item.subscription_id = subscription_id
+            sub_item.price_id = item.price.id
+            sub_item.quantity = item.quantity
+            items_to_update.append(sub_item)
+
+    # items left over belong to the given subscriptions but are no longer listed by Stripe
+    if existing_items:
+        SubscriptionItem.objects.filter(sub_item_id__in=existing_items.keys()).delete()
+    if items_to_create:
+        SubscriptionItem.objects.bulk_create(items_to_create)
+    if items_to_update:
+        SubscriptionItem.objects.bulk_update(items_to_update, ["subscription", "price", "quantity"])
+
+    return len(items_to_create), len(items_to_update), len(existing_items)
+
+
+def archive_ended_subscriptions(days: int, batch_size: int = 500, delete: bool = False) -> int:
+    """
+    Move subscriptions that ended more than the given number of days ago, with their items, from the Subscription and
+    SubscriptionItem tables to ArchivedSubscription, or delete them. Subscriptions are processed in batches, each in
+    its own short transaction, so rows are never locked for long.
+
+    Called from management command.
+
+    :param int days: archive subscriptions that ended more than this number of days ago.
+    :param int batch_size: number of subscriptions archived per transaction.
+    :param bool delete: if True, delete the subscriptions without archiving them.
+    :return: number of subscriptions archived or deleted.
+    """
+    ended_before = timezone.now() - timedelta(days=days)
+    count = 0
+
+    while True:
+        with atomic():
+            subscriptions = list(Subscription.objects.filter(ended_at__lt=ended_before).order_by("pk")[:batch_size])
+            if not subscriptions:
+                return count
+            subscription_ids = [subscription.pk for subscription in subscriptions]
+
+            if not delete:
+                items_by_subscription = defaultdict(list)
+                for sub_item_id, subscription_id, price_id, quantity in SubscriptionItem.objects.filter(
+                        subscription_id__in=subscription_ids).values_list(
+                        "sub_item_id", "subscription_id", "price_id", "quantity"):
+                    items_by_subscription[subscription_id].append(
+                        {"sub_item_id": sub_item_id, "price_id": price_id, "quantity": quantity})
+
+                bulk_upsert(ArchivedSubscription, [ArchivedSubscription(
+                    items=items_by_subscription[subscription.pk],
+                    **{field: getattr(subscription, field) for field in ARCHIVED_SUBSCRIPTION_FIELDS}
+                ) for subscription in subscriptions], update_fields=ARCHIVED_SUBSCRIPTION_FIELDS[1:] + ["items"])
+
+            SubscriptionItem.objects.filter(subscription_id__in=subscription_ids).delete()
+            Subscription.objects.filter(pk__in=subscription_ids).delete()
+            refresh_user_entitlements(subscription.stripe_user_id for subscription in subscriptions)
+
+        count += len(subscriptions)
 
 
 def list_user_subscriptions(user_id, current=True) -> QuerySet[Subscription]:
@@ -156,7 +425,8 @@ def list_user_subscription_items(user_id, current=True) -> QuerySet[Subscription
     if current is True:
         q &= Q(subscription__status__in=ACCESS_GRANTING_STATUSES)
 
-    return SubscriptionItem.objects.filter(q)
+    return SubscriptionItem.objects.filter(q).select_related("subscription", "price__product").prefetch_related(
+        prefetch_product_features("price__product"))
 
 
 def list_user_subscription_products(user_id, current=True):
@@ -180,21 +450,32 @@ def list_subscribable_product_prices_to_user(user_id):
 
     :param user_id: Django user id.
     """
-    current_products = set(map(attrgetter('product_id'), list_user_subscription_products(user_id)))
+    current_products = SubscriptionItem.objects.filter(
+        subscription__stripe_user__user_id=user_id, subscription__status__in=ACCESS_GRANTING_STATUSES
+    ).values("price__product_id")
     prices = Price.objects.filter(
         Q(active=True) &
         Q(product__active=True) &
         ~Q(product__product_id__in=current_products)
-    )
+    ).select_related("product").prefetch_related(prefetch_product_features("product"))
     return prices
 
 
 def list_all_available_product_prices(expand: List = None):
     """Retrieve a set of all Price instances that are available to public."""
 
-    prices = Price.objects.filter(Q(active=True) & Q(product__active=True))
+    prices = Price.objects.filter(Q(active=True) & Q(product__active=True)).select_related("product")
 
     if expand and "feature" in expand:
-        prices = prices.prefetch_related("product__linked_features__feature")
+        prices = prices.prefetch_related(prefetch_product_features("product"))
 
     return prices
+
+
+def prefetch_product_features(product_lookup: str) -> Prefetch:
+    """
+    Returns a Prefetch of the linked_features of Products, with their Feature, in a single query.
+
+    :param str product_lookup: lookup of the Product from the queryset's model, ie: "price__product".
+    """
+    return Prefetch(f"{product_lookup}__linked_features", queryset=ProductFeature.objects.select_related("feature"))
@@ -0,0 +1,287 @@
+import logging
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone as dt_timezone
+from typing import Callable, Iterable, Iterator, List, NamedTuple, Optional, Type
+
+from django.db.transaction import atomic
+from django.utils.module_loading import import_string
+from pydantic import BaseModel
+
+from drf_stripe.models import SyncState
+from drf_stripe.stripe_api.api import stripe_api as stripe
+from ..settings import drf_stripe_settings
+
+logger = logging.getLogger(__name__)
+
+PRODUCTS_SYNC = "products"
+PRICES_SYNC = "prices"
+CUSTOMERS_SYNC = "customers"
+SUBSCRIPTIONS_SYNC = "subscriptions"
+
+STRIPE_EVENT_RETENTION_PERIOD = timedelta(days=30)
+
+
+def get_latest_stripe_event(**event_filters):
+    """
+    Returns the most recent Stripe event matching the filters, or None.
+
+    :param event_filters: stripe.Event.list filters, ie: type="customer.subscription.*"
+    """
+    events = stripe.Event.list(limit=1, **event_filters)["data"]
+    return events[0] if events else None
+
+
+def get_event_created(event) -> datetime:
+    """Returns the created time of a Stripe event."""
+    return datetime.fromtimestamp(event["created"], tz=dt_timezone.utc)
+
+
+def get_sync_cursor(resource: str) -> Optional[datetime]:
+    """
+    Returns the created time of the newest object or event processed by the last incremental sync of a resource,
+    or None if the resource has not been synced incrementally before.
+
+    :param str resource: name of the synchronized resource, ie: CUSTOMERS_SYNC
+    """
+    return SyncState.objects.filter(resource=resource).values_list("last_created", flat=True).first()
+
+
+def save_sync_cursor(resource: str, last_created: datetime, last_event_id: str = None):
+    """
+    Record the created time (and event id, for resources synced from Stripe events) of the newest object processed.
+
+    :param str resource: name of the synchronized resource, ie: CUSTOMERS_SYNC
+    :param datetime last_created: high-water mark for the next incremental sync.
+    :param str last_event_id: id of the newest Stripe event processed.
+    """
+    SyncState.objects.update_or_create(resource=resource, defaults={
+        "last_created": last_created,
+        "last_event_id": last_event_id
+    })
+
+
+def get_sync_checkpoint(resource: str, filters: dict = None) -> Optional[str]:
+    """
+    Returns the id of the last object of the last page committed by an interrupted sync of a resource,
+    or None if the last sync completed, or if it listed objects with other filters: resuming after an object of
+    another listing would skip objects.
+
+    :param str resource: name of the synchronized resource, ie: CUSTOMERS_SYNC
+    :param dict filters: list filters of the sync resuming, ie: {"status": "all"}
+    """
+    state = SyncState.objects.filter(resource=resource).values_list("checkpoint", "checkpoint_filters").first()
+    if state is None:
+        return None
+    checkpoint, checkpoint_filters = state
+    if checkpoint_filters != _get_set_filters(filters):
+        logger.warning("Ignoring %s sync checkpoint saved with filters %s, not %s.", resource, checkpoint_filters,
+                       filters)
+        return None
+    return checkpoint
+
+
+def save_sync_checkpoint(resource: str, checkpoint: Optional[str], filters: dict = None):
+    """
+    Record the id of the last object of a committed page, or clear it with None once a sync completes.
+    Call this in the same transaction as the page updates.
+
+    :param str resource: name of the synchronized resource, ie: CUSTOMERS_SYNC
+    :param str checkpoint: Stripe object id to resume retrieval after.
+    :param dict filters: list filters of the sync, a checkpoint is only resumed by a sync with the same filters.
+    """
+    SyncState.objects.update_or_create(resource=resource, defaults={"checkpoint": checkpoint,
+                                                                    "checkpoint_filters": _get_set_filters(filters)})
+
+
+def _get_set_filters(filters: Optional[dict]) -> Optional[dict]:
+    """Returns the filters that are set, or None, so that unset filters compare equal to no filters."""
+    filters = {key: value for key, value in (filters or {}).items() if value is not None and value is not False}
+    return filters or None
+
+
+class SyncError(NamedTuple):
+    object_id: Optional[str]
+    error: str
+
+
+class SyncReport:
+    """
+    Outcome and throughput of a sync: pages and rows processed, rows created, updated and skipped as unchanged, time
+    spent waiting for Stripe and writing to the database, and the Stripe objects that could not be synced.
+    Objects that fail are recorded here and skipped, the rest of the page and later pages are still synced.
+
+    Metrics of each page are logged to the 'drf_stripe.stripe_api.sync' logger, and passed to the function set by
+    setting SYNC_METRICS_CALLBACK, if any, as callback(resource, metrics).
+    """
+
+    def __init__(self, resource: str):
+        self.resource = resource
+        self.pages = 0
+        self.rows = 0
+        self.created = 0
+        self.updated = 0
+        self.skipped = 0
+        self.fetch_seconds = 0.0
+        self.write_seconds = 0.0
+        self.errors: List[SyncError] = []
+        self.started_at = time.monotonic()
+        self.finished_at = None
+
+    def add_error(self, object_id: Optional[str], error: Exception):
+        self.errors.append(SyncError(object_id, f"{type(error).__name__}: {error}"))
+
+    def add_counts(self, created: int = 0, updated: int = 0, skipped: int = 0):
+        self.created += created
+        self.updated += updated
+        self.skipped += skipped
+
+    def _get_counts(self) -> tuple:
+        return self.created, self.updated, self.skipped, len(self.errors)
+
+    def _reset_counts(self, counts: tuple):
+        """Forget the counts and errors added by a write that was rolled back."""
+        self.created, self.updated, self.skipped = counts[:3]
+        del self.errors[counts[3]:]
+
+    def iter_pages(self, pages: Iterable) -> Iterator:
+        """Iterate over pages of Stripe objects, counting them and timing how long each takes to be retrieved."""
+        pages = iter(pages)
+        while True:
+            started_at = time.monotonic()
+            try:
+                page = next(pages)
+            except StopIteration:
+                return
+            finally:
+                self.fetch_seconds += time.monotonic() - started_at
+            self.pages += 1
+            yield page
+
+    @contextmanager
+    def fetching(self):
+        """Time Stripe API calls made while processing a page, ie: retrieving missing customers, as fetch time."""
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            self.fetch_seconds += time.monotonic() - started_at
+
+    @contextmanager
+    def write_page(self, rows: int):
+        """
+        Time the processing and database writes of a page of rows, then report the page metrics.
+        Time spent in fetching() blocks within the page is counted as fetch time, not write time.
+
+        :param int rows: number of Stripe objects in the page.
+        """
+        before = (self.created, self.updated, self.skipped, len(self.errors))
+        fetch_seconds_before = self.fetch_seconds
+        started_at = time.monotonic()
+        yield
+        write_seconds = time.monotonic() - started_at - (self.fetch_seconds - fetch_seconds_before)
+        self.write_seconds += write_seconds
+        self.rows += rows
+
+        metrics = {
+            "rows": rows,
+            "created": self.created - before[0],
+            "updated": self.updated - before[1],
+            "skipped": self.skipped - before[2],
+            "errors": len(self.errors) - before[3],
+            "write_seconds": write_seconds,
+        }
+        logger.info("Synced %s page %d: %d rows, %d created, %d updated, %d skipped, %d errors in %.3fs",
+                    self.resource, self.pages, rows, metrics["created"], metrics["updated"], metrics["skipped"],
+                    metrics["errors"], write_seconds)
+        callback = drf_stripe_settings.SYNC_METRICS_CALLBACK
+        if callback:
+            if isinstance(callback, str):
+                callback = import_string(callback)
+            callback(self.resource, metrics)
+
+    def finish(self):
+        """Record the end of the sync and log its totals."""
+        self.finished_at = time.monotonic()
+        logger.info("Synced %s: %d pages, %d rows, %d created, %d updated, %d skipped, %d errors, %.1f rows/s",
+                    self.resource, self.pages, self.rows, self.created, self.updated, self.skipped, len(self.errors),
+                    self.rows_per_second)
+
+    @property
+    def rows_per_second(self) -> float:
+        elapsed = (self.finished_at or time.monotonic()) - self.started_at
+        return self.rows / elapsed if elapsed > 0 else 0.0
+
+    def print_errors(self):
+        for object_id, error in self.errors:
+            print(f"Could not sync {self.resource} '{object_id}': {error}")
+
+
+def format_sync_summary(reports: Iterable[SyncReport]) -> str:
+    """Returns a table of the totals of sync reports, one row per resource."""
+    columns = ["resource", "pages", "rows", "created", "updated", "skipped", "errors", "fetch s", "write s", "rows/s"]
+    rows = [[report.resource, report.pages, report.rows, report.created, report.updated, report.skipped,
+             len(report.errors), f"{report.fetch_seconds:.2f}", f"{report.write_seconds:.2f}",
+             f"{report.rows_per_second:.1f}"] for report in reports]
+    widths = [max(len(str(value)) for value in column) for column in zip(columns, *rows)]
+    return "\n".join(
+        "  ".join(str(value).ljust(width) if i == 0 else str(value).rjust(width)
+                  for i, (value, width) in enumerate(zip(row, widths)))
+        for row in [columns] + rows
+    )
+
+
+def parse_page_objects(model: Type[BaseModel], response, report: SyncReport) -> list:
+    """
+    Parse each object of a Stripe list API response, recording objects that fail validation in the report.
+
+    :param model: pydantic model of a single Stripe object, ie: StripeSubscription
+    :param response: Stripe list API response.
+    :param SyncReport report: report receiving parsing errors.
+    """
+    objects = []
+    for data in response["data"]:
+        try:
+            objects.append(model.parse_obj(data))
+        except ValueError as e:
+            report.add_error(data.get("id"), e)
+    return objects
+
+
+def write_page_objects(report: SyncReport, objects: list, write: Callable[[list], None],
+                       get_object_id: Callable[[object], str], after_write: Callable[[], None] = None):
+    """
+    Write a page of objects in one transaction. If writing the page fails, ie: an object references a row that is
+    not synced, the page is written again one object at a time, each in its own savepoint, and the objects that fail
+    are recorded in the report instead of aborting the sync.
+
+    :param SyncReport report: report receiving the objects that could not be written.
+    :param list objects: objects of the page.
+    :param write: function writing a list of objects and adding its counts to the report.
+    :param get_object_id: function returning the Stripe id of an object.
+    :param after_write: function called in the page's transaction once its objects are written, ie: saving a
+        checkpoint.
+    """
+    counts = report._get_counts()
+    try:
+        with atomic():
+            write(objects)
+            if after_write is not None:
+                after_write()
+        return
+    except Exception as e:
+        logger.warning("Writing %s page %d failed, writing its objects one at a time: %s: %s", report.resource,
+                       report.pages, type(e).__name__, e)
+        report._reset_counts(counts)
+
+    with atomic():
+        for obj in objects:
+            counts = report._get_counts()
+            try:
+                with atomic():
+                    write([obj])
+            except Exception as e:
+                report._reset_counts(counts)
+                report.add_error(get_object_id(obj), e)
+        if after_write is not None:
+            after_write()
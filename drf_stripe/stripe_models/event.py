@@ -1,3 +1,4 @@
+from datetime import datetime
 from enum import Enum
 from typing import Union, Literal, Any, Optional
 
@@ -48,11 +49,17 @@ class StripeBaseEvent(BaseModel):
     """
     id: str
     api_version: str
+    created: Optional[datetime] = None
     request: StripeEventRequest
     data: Any  # overwrite this attribute when inheriting
     type: Literal[Any]  # overwrite this attribute when inheriting
 
 
+class StripeGenericEvent(StripeBaseEvent):
+    """Any Stripe event, data is left unparsed. Used for event types without a more specific event class."""
+    type: str
+
+
 class StripeInvoiceEvent(StripeBaseEvent):
     data: StripeInvoiceEventData
     type: Literal[
@@ -1,8 +1,36 @@
-from drf_stripe.models import Subscription, SubscriptionItem, StripeUser
+from datetime import datetime
+
+from django.db.transaction import atomic
+
+from drf_stripe.entitlements import refresh_user_entitlements
+from drf_stripe.models import ArchivedSubscription, Subscription, StripeUser
+from drf_stripe.stripe_api.fingerprint import is_unchanged
+from drf_stripe.stripe_api.subscriptions import get_subscription_fingerprint, \
+    stripe_api_fetch_remaining_subscription_items, update_subscription_items
 from drf_stripe.stripe_models.event import StripeSubscriptionEventData
+from .ordering import advance_last_event_at, is_stale_event, event_created_defaults
+
+
+def _prepare_customer_subscription_event_data(data: StripeSubscriptionEventData, event_created: datetime = None) -> bool:
+    """
+    Retrieve the remaining items of the event's subscription from Stripe, before the transaction applying the event is
+    opened. Returns False if the event should not be applied.
+    """
+    # ended subscriptions moved to the archive are not brought back
+    if ArchivedSubscription.objects.filter(subscription_id=data.object.id).exists():
+        return False
+    # items are only retrieved for events that are not known stale, the locked check is repeated when applying
+    if is_stale_event(Subscription, data.object.id, event_created, lock=False):
+        return False
 
+    errors = stripe_api_fetch_remaining_subscription_items([data.object])
+    if errors:
+        raise errors[data.object.id]
+    return True
 
-def _handle_customer_subscription_event_data(data: StripeSubscriptionEventData):
+
+@atomic
+def _apply_customer_subscription_event_data(data: StripeSubscriptionEventData, event_created: datetime = None):
     subscription_id = data.object.id
     customer = data.object.customer
     period_start = data.object.current_period_start
@@ -14,6 +42,13 @@ def _handle_customer_subscription_event_data(data: StripeSubscriptionEventData):
     trial_end = data.object.trial_end
     trial_start = data.object.trial_start
 
+    fingerprint = get_subscription_fingerprint(data.object)
+    if is_stale_event(Subscription, subscription_id, event_created):
+        return
+    if is_unchanged(Subscription, subscription_id, fingerprint):
+        advance_last_event_at(Subscription, subscription_id, event_created)
+        return
+
     stripe_user = StripeUser.objects.get(customer_id=customer)
 
     subscription, created = Subscription.objects.update_or_create(
@@ -27,20 +62,10 @@ def _handle_customer_subscription_event_data(data: StripeSubscriptionEventData):
             "ended_at": ended_at,
             "status": status,
             "trial_end": trial_end,
-            "trial_start": trial_start
+            "trial_start": trial_start,
+            "fingerprint": fingerprint,
+            **event_created_defaults(event_created)
         })
 
-    subscription.items.all().delete()
-    _create_subscription_items(data)
-
-
-def _create_subscription_items(data: StripeSubscriptionEventData):
-    for item in data.object.items.data:
-        SubscriptionItem.objects.update_or_create(
-            sub_item_id=item.id,
-            defaults={
-                "subscription_id": data.object.id,
-                "price_id": item.price.id,
-                "quantity": item.quantity
-            }
-        )
+    update_subscription_items({subscription_id: data.object.items.data})
+    refresh_user_entitlements([stripe_user.pk])
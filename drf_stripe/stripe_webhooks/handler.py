@@ -1,88 +1,148 @@
-from pydantic import ValidationError
+import json
+
+from django.db.transaction import atomic
 from rest_framework.request import Request
 
+from drf_stripe.models import WebhookEvent
 from drf_stripe.settings import drf_stripe_settings
 from drf_stripe.stripe_api.api import stripe_api as stripe
-from drf_stripe.stripe_models.event import EventType
-from drf_stripe.stripe_models.event import StripeEvent
-from .customer_subscription import _handle_customer_subscription_event_data
+from drf_stripe.stripe_models.event import EventType, StripeSubscriptionEvent, StripeProductEvent, StripePriceEvent
+from .customer_subscription import _apply_customer_subscription_event_data, \
+    _prepare_customer_subscription_event_data
+from .ledger import is_processed_event, record_processed_event
 from .price import _handle_price_event_data
 from .product import _handle_product_event_data
+from .registry import register_webhook_event_handler, get_webhook_event_handlers, \
+    get_webhook_event_handler_prepare
 
 
 def handle_stripe_webhook_request(request):
     event = _make_webhook_event_from_request(request)
-    handle_webhook_event(event)
 
+    if drf_stripe_settings.WEBHOOK_INBOX_ENABLED:
+        if get_webhook_event_handlers(event["type"]):
+            _store_webhook_event(event, request.body)
+    else:
+        handle_webhook_event(event)
 
-def _make_webhook_event_from_request(request: Request):
-    """
-    Given a Rest Framework request, construct a webhook event.
 
-    :param event: event from Stripe Webhook, defaults to None. Used for test.
+def _store_webhook_event(event, payload: bytes):
     """
+    Store a verified webhook event in the inbox table, to be processed by 'process_stripe_webhooks' command.
+    Events that have already been received (same event id) are ignored.
 
-    return stripe.Webhook.construct_event(
-        payload=request.body,
-        sig_header=request.META['HTTP_STRIPE_SIGNATURE'],
-        secret=drf_stripe_settings.STRIPE_WEBHOOK_SECRET)
+    :param event: verified Stripe event.
+    :param bytes payload: raw request body.
+    """
+    WebhookEvent.objects.bulk_create([
+        WebhookEvent(event_id=event["id"], event_type=event["type"], payload=payload.decode("utf-8"))
+    ], ignore_conflicts=True)
 
 
-def _handle_event_type_validation_error(err: ValidationError):
+def _make_webhook_event_from_request(request: Request) -> dict:
     """
-    Handle Pydantic ValidationError raised when parsing StripeEvent,
-    ignores the error if it is caused by unimplemented event.type;
-    Otherwise, raise the error.
+    Given a Rest Framework request, verify the Stripe signature and construct a webhook event.
+    The request body is decoded once into plain dicts, which the event models are parsed from directly.
+
+    :param request: request made by Stripe to the webhook endpoint.
     """
-    event_type_error = False
+    payload = request.body.decode("utf-8")
 
-    for error in err.errors():
-        error_loc = error['loc']
-        if error_loc[0] == 'event' and error.get('ctx', {}).get('discriminator_key', {}) == 'type':
-            event_type_error = True
-            break
+    stripe.WebhookSignature.verify_header(
+        payload=payload,
+        header=request.META['HTTP_STRIPE_SIGNATURE'],
+        secret=drf_stripe_settings.STRIPE_WEBHOOK_SECRET,
+        tolerance=stripe.Webhook.DEFAULT_TOLERANCE)
 
-    if event_type_error is False:
-        raise err
+    return json.loads(payload)
 
 
 def handle_webhook_event(event):
-    """Perform actions given Stripe Webhook event data."""
+    """
+    Perform actions given Stripe Webhook event data.
+    Only event types with registered handlers are parsed and handled, other events are ignored.
+    Events that have already been processed are ignored, unless WEBHOOK_EVENT_LEDGER_ENABLED setting is off.
+    """
+    prepared_handlers = prepare_webhook_event(event)
+    if prepared_handlers:
+        apply_webhook_event(event, prepared_handlers)
 
-    try:
-        e = StripeEvent(event=event)
-    except ValidationError as err:
-        _handle_event_type_validation_error(err)
+
+def prepare_webhook_event(event) -> list:
+    """
+    Parse the event into each handler's event model, at most once per model, and run the handlers' prepare step.
+    This is done before any transaction is opened, so Stripe API calls made by prepare steps do not hold one open.
+    Returns the (handler, parsed event) pairs to pass to apply_webhook_event(), handlers whose prepare step returned
+    False are left out.
+    """
+    handlers = get_webhook_event_handlers(event.get("type"))
+    if not handlers or _use_event_ledger(event) and is_processed_event(event):
+        return []
+
+    parsed_events = {}
+    prepared_handlers = []
+    for event_model, handler in handlers:
+        if event_model not in parsed_events:
+            parsed_events[event_model] = event_model.parse_obj(event)
+        prepare = get_webhook_event_handler_prepare(handler)
+        if prepare is None or prepare(parsed_events[event_model]) is not False:
+            prepared_handlers.append((handler, parsed_events[event_model]))
+    return prepared_handlers
+
+
+def apply_webhook_event(event, prepared_handlers: list):
+    """
+    Call the handlers returned by prepare_webhook_event(), in the transaction recording the event as processed
+    unless the ledger is disabled.
+    """
+    if not _use_event_ledger(event):
+        _call_webhook_event_handlers(prepared_handlers)
         return
 
-    event_type = e.event.type
+    with atomic():
+        if record_processed_event(event):
+            _call_webhook_event_handlers(prepared_handlers)
+
 
-    if event_type is EventType.CUSTOMER_SUBSCRIPTION_CREATED:
-        _handle_customer_subscription_event_data(e.event.data)
+def _use_event_ledger(event) -> bool:
+    return drf_stripe_settings.WEBHOOK_EVENT_LEDGER_ENABLED and bool(event.get("id"))
 
-    elif event_type is EventType.CUSTOMER_SUBSCRIPTION_UPDATED:
-        _handle_customer_subscription_event_data(e.event.data)
 
-    elif event_type is EventType.CUSTOMER_SUBSCRIPTION_DELETED:
-        _handle_customer_subscription_event_data(e.event.data)
+def _call_webhook_event_handlers(prepared_handlers: list):
+    for handler, parsed_event in prepared_handlers:
+        handler(parsed_event)
 
 
-    elif event_type is EventType.PRODUCT_CREATED:
-        _handle_product_event_data(e.event.data)
+def _prepare_customer_subscription_event(event: StripeSubscriptionEvent) -> bool:
+    return _prepare_customer_subscription_event_data(event.data, event.created)
 
-    elif event_type is EventType.PRODUCT_UPDATED:
-        _handle_product_event_data(e.event.data)
 
-    elif event_type is EventType.PRODUCT_DELETED:
-        _handle_product_event_data(e.event.data)
+@register_webhook_event_handler(
+    EventType.CUSTOMER_SUBSCRIPTION_CREATED,
+    EventType.CUSTOMER_SUBSCRIPTION_UPDATED,
+    EventType.CUSTOMER_SUBSCRIPTION_DELETED,
+    event_model=StripeSubscriptionEvent,
+    prepare=_prepare_customer_subscription_event
+)
+def _handle_customer_subscription_event(event: StripeSubscriptionEvent):
+    _apply_customer_subscription_event_data(event.data, event.created)
 
 
-    elif event_type is EventType.PRICE_CREATED:
-        _handle_price_event_data(e.event.data)
+@register_webhook_event_handler(
+    EventType.PRODUCT_CREATED,
+    EventType.PRODUCT_UPDATED,
+    EventType.PRODUCT_DELETED,
+    event_model=StripeProductEvent
+)
+def _handle_product_event(event: StripeProductEvent):
+    _handle_product_event_data(event.data, event.created)
 
-    elif event_type is EventType.PRICE_UPDATED:
-        _handle_price_event_data(e.event.data)
 
-    elif event_type is EventType.PRICE_DELETED:
-        _handle_price_event_data(e.event.data)
-   
+@register_webhook_event_handler(
+    EventType.PRICE_CREATED,
+    EventType.PRICE_UPDATED,
+    EventType.PRICE_DELETED,
+    event_model=StripePriceEvent
+)
+def _handle_price_event(event: StripePriceEvent):
+    _handle_price_event_data(event.data, event.created)
@@ -0,0 +1,84 @@
+import json
+from datetime import timedelta
+
+from django.db import connection
+from django.db.models import Q
+from django.db.transaction import atomic
+from django.utils import timezone
+
+from drf_stripe.models import WebhookEvent
+from .handler import apply_webhook_event, prepare_webhook_event
+
+MAX_RETRY_DELAY = 60 * 60  # seconds
+
+
+def process_webhook_inbox(batch_size: int = 100, max_attempts: int = 5, retry_delay: float = 60) -> int:
+    """
+    Process a batch of pending webhook events stored in the inbox table, oldest first.
+    Each event is prepared by its handlers, ie: retrieving data from Stripe, without any transaction open, then locked
+    and applied in its own transaction, so multiple workers can drain the inbox at the same time and a slow event does
+    not hold locks on the others.
+    An event that fails is kept with its error message and retried after an exponential backoff, until it reaches
+    max_attempts.
+
+    :param int batch_size: maximum number of events to process.
+    :param int max_attempts: events that failed this many times are no longer retried.
+    :param float retry_delay: seconds to wait before retrying an event after its first failure, doubled after each
+        further failure, up to an hour.
+    :return: number of events processed in this batch, including failed ones.
+    """
+    processed_count = 0
+    seen_ids = set()
+    while processed_count < batch_size:
+        webhook_event = _pending_webhook_events(max_attempts).exclude(pk__in=seen_ids).order_by("received_at").first()
+        if webhook_event is None:
+            break
+        seen_ids.add(webhook_event.pk)
+
+        # handlers' prepare steps may call the Stripe API, they run before the event is locked
+        event = json.loads(webhook_event.payload)
+        try:
+            prepared_handlers, prepare_error = prepare_webhook_event(event), None
+        except Exception as e:
+            prepared_handlers, prepare_error = None, e
+
+        with atomic():
+            webhook_event = _pending_webhook_events(max_attempts).select_for_update(
+                skip_locked=connection.features.has_select_for_update_skip_locked
+            ).filter(pk=webhook_event.pk).first()
+            if webhook_event is None:
+                # processed by another worker in the meantime
+                continue
+            _process_webhook_event(webhook_event, event, prepared_handlers, prepare_error, retry_delay)
+        processed_count += 1
+
+    return processed_count
+
+
+def _pending_webhook_events(max_attempts: int):
+    return WebhookEvent.objects.filter(
+        Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=timezone.now()),
+        processed_at__isnull=True, attempts__lt=max_attempts
+    )
+
+
+def _process_webhook_event(webhook_event: WebhookEvent, event: dict, prepared_handlers: list,
+                           prepare_error: Exception, retry_delay: float):
+    """Apply a single stored webhook event once prepared, recording the outcome on the inbox row."""
+    webhook_event.attempts += 1
+    try:
+        if prepare_error is not None:
+            raise prepare_error
+        if prepared_handlers:
+            with atomic():
+                apply_webhook_event(event, prepared_handlers)
+    except Exception as e:
+        webhook_event.last_error = repr(e)
+        delay = min(retry_delay * 2 ** (webhook_event.attempts - 1), MAX_RETRY_DELAY)
+        webhook_event.next_attempt_at = timezone.now() + timedelta(seconds=delay)
+    else:
+        webhook_event.processed_at = timezone.now()
+        webhook_event.last_error = None
+        webhook_event.next_attempt_at = None
+
+    webhook_event.save(update_fields=["attempts", "processed_at", "last_error", "next_attempt_at"])
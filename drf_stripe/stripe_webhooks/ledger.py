@@ -0,0 +1,53 @@
+from datetime import timedelta
+from typing import Type
+
+from django.db.models import Model
+from django.utils import timezone
+
+from drf_stripe.models import ProcessedEvent, WebhookEvent
+
+
+def record_processed_event(event) -> bool:
+    """
+    Record a Stripe event as processed, should be called within the transaction that handles the event.
+    Returns False if the event has been processed before, in which case it should be ignored.
+
+    :param event: Stripe event, as dict or stripe.Event.
+    """
+    _, created = ProcessedEvent.objects.get_or_create(event_id=event["id"],
+                                                      defaults={"event_type": event.get("type", "")})
+    return created
+
+
+def is_processed_event(event) -> bool:
+    """
+    Check whether a Stripe event has already been recorded as processed, without locking, ie: to skip work before the
+    transaction handling the event. record_processed_event() remains the authoritative check.
+
+    :param event: Stripe event, as dict or stripe.Event.
+    """
+    return ProcessedEvent.objects.filter(event_id=event["id"]).exists()
+
+
+def prune_processed_events(days: int, batch_size: int = 1000) -> int:
+    """
+    Delete processed event records and processed inbox events older than the given number of days.
+    Records are deleted in batches to keep each delete statement short.
+
+    :param int days: retention period in days.
+    :param int batch_size: maximum number of rows deleted per statement.
+    :return: total number of rows deleted.
+    """
+    cutoff = timezone.now() - timedelta(days=days)
+    return _delete_in_batches(ProcessedEvent, {"processed_at__lt": cutoff}, batch_size) + \
+        _delete_in_batches(WebhookEvent, {"processed_at__lt": cutoff}, batch_size)
+
+
+def _delete_in_batches(model: Type[Model], filters: dict, batch_size: int) -> int:
+    deleted_count = 0
+    while True:
+        pks = list(model.objects.filter(**filters).values_list("pk", flat=True)[:batch_size])
+        if not pks:
+            return deleted_count
+        deleted, _ = model.objects.filter(pk__in=pks).delete()
+        deleted_count += deleted
@@ -0,0 +1,42 @@
+from datetime import datetime
+from typing import Type
+
+from django.db.models import Model, Q
+
+
+def is_stale_event(model: Type[Model], pk: str, event_created: datetime = None, lock: bool = True) -> bool:
+    """
+    Check whether a Stripe event is older than the last event applied to a database row.
+    The row is locked until the end of the current transaction, so concurrent deliveries are applied one at a time.
+
+    :param model: model class with a 'last_event_at' field.
+    :param str pk: primary key of the row the event applies to.
+    :param datetime event_created: the event's created time, events without it are never stale.
+    :param bool lock: if False, the row is not locked, ie: to skip work before the transaction applying the event.
+    """
+    if event_created is None:
+        return False
+
+    rows = model.objects.select_for_update() if lock else model.objects
+    last_event_at = rows.filter(pk=pk).values_list("last_event_at", flat=True).first()
+    return last_event_at is not None and last_event_at > event_created
+
+
+def advance_last_event_at(model: Type[Model], pk: str, event_created: datetime = None):
+    """
+    Record an event as applied to a database row whose other fields it leaves unchanged, ie: an event carrying the
+    same fingerprint. Older events delivered later are then recognized as stale.
+
+    :param model: model class with a 'last_event_at' field.
+    :param str pk: primary key of the row the event applies to.
+    :param datetime event_created: the event's created time, nothing is recorded without it.
+    """
+    if event_created is None:
+        return
+    model.objects.filter(Q(last_event_at__lt=event_created) | Q(last_event_at__isnull=True), pk=pk).update(
+        last_event_at=event_created)
+
+
+def event_created_defaults(event_created: datetime = None) -> dict:
+    """Returns model field values recording the event's created time, if known."""
+    return {} if event_created is None else {"last_event_at": event_created}
@@ -1,9 +1,17 @@
+from datetime import datetime
+
+from django.db.transaction import atomic
+
+from drf_stripe.catalog import invalidate_catalog_snapshot
 from drf_stripe.models import Price
-from drf_stripe.stripe_api.products import get_freq_from_stripe_price
+from drf_stripe.stripe_api.fingerprint import is_unchanged
+from drf_stripe.stripe_api.products import get_freq_from_stripe_price, get_price_fingerprint
 from drf_stripe.stripe_models.price import StripePriceEventData
+from .ordering import advance_last_event_at, is_stale_event, event_created_defaults
 
 
-def _handle_price_event_data(data: StripePriceEventData):
+@atomic
+def _handle_price_event_data(data: StripePriceEventData, event_created: datetime = None):
     price_id = data.object.id
     product_id = data.object.product
     nickname = data.object.nickname
@@ -12,6 +20,13 @@ def _handle_price_event_data(data: StripePriceEventData):
     freq = get_freq_from_stripe_price(data.object)
     currency = data.object.currency
 
+    fingerprint = get_price_fingerprint(data.object)
+    if is_stale_event(Price, price_id, event_created):
+        return
+    if is_unchanged(Price, price_id, fingerprint):
+        advance_last_event_at(Price, price_id, event_created)
+        return
+
     price_obj, created = Price.objects.update_or_create(
         price_id=price_id,
         defaults={
@@ -20,6 +35,9 @@ def _handle_price_event_data(data: StripePriceEventData):
             "price": price,
             "active": active,
             "freq": freq,
-            "currency": currency
+            "currency": currency,
+            "fingerprint": fingerprint,
+            **event_created_defaults(event_created)
         }
     )
+    invalidate_catalog_snapshot()
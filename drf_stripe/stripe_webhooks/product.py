@@ -1,18 +1,36 @@
+from datetime import datetime
+
+from django.db.transaction import atomic
+
+from drf_stripe.catalog import invalidate_catalog_snapshot
 from drf_stripe.models import Product
-from drf_stripe.stripe_api.products import create_update_product_features
+from drf_stripe.stripe_api.fingerprint import is_unchanged
+from drf_stripe.stripe_api.products import create_update_product_features, get_product_fingerprint
 from drf_stripe.stripe_models.product import StripeProductEventData
+from .ordering import advance_last_event_at, is_stale_event, event_created_defaults
 
 
-def _handle_product_event_data(data: StripeProductEventData):
+@atomic
+def _handle_product_event_data(data: StripeProductEventData, event_created: datetime = None):
     product_id = data.object.id
     active = data.object.active
     description = data.object.description
     name = data.object.name
 
+    fingerprint = get_product_fingerprint(data.object)
+    if is_stale_event(Product, product_id, event_created):
+        return
+    if is_unchanged(Product, product_id, fingerprint):
+        advance_last_event_at(Product, product_id, event_created)
+        return
+
     product, created = Product.objects.update_or_create(product_id=product_id, defaults={
         "active": active,
         "description": description,
-        "name": name
+        "name": name,
+        "fingerprint": fingerprint,
+        **event_created_defaults(event_created)
     })
 
     create_update_product_features(data.object)
+    invalidate_catalog_snapshot()
@@ -0,0 +1,55 @@
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Tuple, Type, Union
+
+from drf_stripe.stripe_models.event import EventType, StripeBaseEvent, StripeGenericEvent
+
+WebhookEventHandler = Callable[[StripeBaseEvent], None]
+WebhookEventPrepare = Callable[[StripeBaseEvent], bool]
+
+_webhook_event_handlers: Dict[str, List[Tuple[Type[StripeBaseEvent], WebhookEventHandler]]] = defaultdict(list)
+_webhook_event_prepare: Dict[WebhookEventHandler, WebhookEventPrepare] = {}
+
+
+def register_webhook_event_handler(*event_types: Union[EventType, str],
+                                   event_model: Type[StripeBaseEvent] = StripeGenericEvent,
+                                   prepare: Optional[WebhookEventPrepare] = None):
+    """
+    Decorator registering a function to be called for the given Stripe event types, ie:
+
+        @register_webhook_event_handler("invoice.paid", event_model=StripeInvoiceEvent)
+        def handle_invoice_paid(event: StripeInvoiceEvent):
+            ...
+
+    Multiple handlers can be registered for the same event type, they are called in the order of registration.
+
+    :param event_types: Stripe event types, see https://stripe.com/docs/api/events/types
+    :param event_model: pydantic model the event is parsed into before being passed to the handler.
+    :param prepare: optional function called with the parsed event before the transaction recording and handling the
+        event is opened, ie: to retrieve data from Stripe. The handler is not called if it returns False.
+    """
+
+    def decorator(handler: WebhookEventHandler):
+        for event_type in event_types:
+            _webhook_event_handlers[getattr(event_type, "value", event_type)].append((event_model, handler))
+        if prepare is not None:
+            _webhook_event_prepare[handler] = prepare
+        return handler
+
+    return decorator
+
+
+def unregister_webhook_event_handler(handler: WebhookEventHandler):
+    """Remove a handler from all event types it was registered for."""
+    for event_type, handlers in _webhook_event_handlers.items():
+        handlers[:] = [(model, fn) for model, fn in handlers if fn != handler]
+    _webhook_event_prepare.pop(handler, None)
+
+
+def get_webhook_event_handlers(event_type: str) -> List[Tuple[Type[StripeBaseEvent], WebhookEventHandler]]:
+    """Returns the (event model, handler) pairs registered for an event type."""
+    return _webhook_event_handlers.get(event_type, [])
+
+
+def get_webhook_event_handler_prepare(handler: WebhookEventHandler) -> Optional[WebhookEventPrepare]:
+    """Returns the prepare function registered with a handler, if any."""
+    return _webhook_event_prepare.get(handler)
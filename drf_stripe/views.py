@@ -3,11 +3,12 @@ from rest_framework.generics import ListAPIView
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from drf_stripe.catalog import get_catalog_snapshot
 from drf_stripe.stripe_webhooks.handler import handle_stripe_webhook_request
 from .serializers import SubscriptionSerializer, PriceSerializer, SubscriptionItemSerializer, CheckoutRequestSerializer
 from .stripe_api.customer_portal import stripe_api_create_billing_portal_session
 from .stripe_api.subscriptions import list_user_subscriptions, list_user_subscription_items, \
-    list_subscribable_product_prices_to_user, list_all_available_product_prices
+    list_subscribable_product_prices_to_user
 
 
 class Subscription(ListAPIView):
@@ -44,7 +45,7 @@ class SubscribableProductPrice(ListAPIView):
 
     def get_queryset(self):
         if self.request.user.is_anonymous:
-            return list_all_available_product_prices()
+            return get_catalog_snapshot().prices
         else:
             return list_subscribable_product_prices_to_user(self.request.user.id)
 
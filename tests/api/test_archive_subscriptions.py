@@ -0,0 +1,80 @@
+import json
+import tempfile
+from datetime import timedelta
+from pathlib import Path
+from unittest.mock import patch
+
+from django.core.management import call_command
+from django.utils import timezone
+
+from drf_stripe.models import ArchivedSubscription, Subscription, SubscriptionItem
+from drf_stripe.stripe_api.dumps import import_stripe_dump
+from drf_stripe.stripe_api.subscriptions import archive_ended_subscriptions, stripe_api_update_subscriptions
+from drf_stripe.stripe_webhooks.handler import handle_webhook_event
+from ..base import BaseTest
+
+
+class TestArchiveSubscriptions(BaseTest):
+    def setUp(self) -> None:
+        self.setup_user_customer()
+        self.setup_product_prices()
+        with patch('stripe.Subscription.list') as subscription_list_fn, \
+                patch('stripe.Customer.retrieve') as retrieve_fn:
+            subscription_list_fn.return_value = self._load_test_data("v1/api_subscription_list.json")
+            retrieve_fn.return_value = {"email": "tester2@example.com", "id": "cus_tester2"}
+            stripe_api_update_subscriptions()
+        Subscription.objects.filter(subscription_id="sub_0001").update(
+            status="canceled", ended_at=timezone.now() - timedelta(days=100))
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_archive_ended_subscriptions(self):
+        """
+        Test subscriptions ended before the cutoff are moved to the archive table with their items.
+        """
+        call_command("archive_stripe_subscriptions", days=90, batch_size=1)
+
+        self.assertFalse(Subscription.objects.filter(subscription_id="sub_0001").exists())
+        self.assertFalse(SubscriptionItem.objects.filter(subscription_id="sub_0001").exists())
+        self.assertTrue(Subscription.objects.filter(subscription_id="sub_0002").exists())
+
+        archived = ArchivedSubscription.objects.get(subscription_id="sub_0001")
+        self.assertEqual(archived.status, "canceled")
+        self.assertEqual(archived.stripe_user.customer_id, "cus_tester")
+        self.assertEqual([item["price_id"] for item in archived.items], ["price_1KHkCLL14ex1CGCipzcBdnOp"])
+
+    def test_archived_subscriptions_not_restored(self):
+        """
+        Test pulls, dump imports and webhook events do not bring archived subscriptions back.
+        """
+        archive_ended_subscriptions(days=90)
+
+        with patch('stripe.Subscription.list') as subscription_list_fn:
+            subscription_list_fn.return_value = self._load_test_data("v1/api_subscription_list.json")
+            report = stripe_api_update_subscriptions()
+        self.assertEqual(report.skipped, 2)
+
+        subscription = self._load_test_data("v1/api_subscription_list.json")["data"][0]
+        path = Path(self.tmp_dir.name) / "subscriptions.jsonl"
+        path.write_text(json.dumps(subscription), encoding="utf-8")
+        reports = import_stripe_dump([str(path)], object_types=["subscription"])
+        self.assertEqual(reports["subscription"].skipped, 1)
+
+        event = self._load_test_data("2020-08-27/webhook_subscription_created.json")
+        event["data"]["object"]["id"] = "sub_0001"
+        handle_webhook_event(event)
+
+        self.assertFalse(Subscription.objects.filter(subscription_id="sub_0001").exists())
+        self.assertFalse(SubscriptionItem.objects.filter(subscription_id="sub_0001").exists())
+
+    def test_delete_ended_subscriptions(self):
+        """
+        Test ended subscriptions are deleted without archiving when requested, recent ones are kept.
+        """
+        self.assertEqual(archive_ended_subscriptions(days=120, delete=True), 0)
+        self.assertEqual(archive_ended_subscriptions(days=90, delete=True), 1)
+
+        self.assertFalse(Subscription.objects.filter(subscription_id="sub_0001").exists())
+        self.assertFalse(ArchivedSubscription.objects.exists())
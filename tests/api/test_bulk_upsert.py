@@ -0,0 +1,33 @@
+from unittest.mock import patch
+
+from django.db import connection
+
+from drf_stripe.models import Product
+from drf_stripe.stripe_api.bulk import bulk_upsert
+from ..base import BaseTest
+
+
+class TestBulkUpsert(BaseTest):
+
+    def _upsert_products(self):
+        Product.objects.create(product_id="prod_1", active=True, name="Old name")
+        return bulk_upsert(Product, [
+            Product(product_id="prod_1", active=False, name="New name"),
+            Product(product_id="prod_2", active=True, name="Product 2"),
+        ], update_fields=["active", "name"])
+
+    def _assert_products_upserted(self, counts):
+        self.assertEqual(counts, (1, 1))
+        product_1 = Product.objects.get(product_id="prod_1")
+        self.assertEqual(product_1.name, "New name")
+        self.assertFalse(product_1.active)
+        self.assertEqual(Product.objects.get(product_id="prod_2").name, "Product 2")
+
+    def test_bulk_upsert(self):
+        """Test new rows are inserted and existing rows are updated."""
+        self._assert_products_upserted(self._upsert_products())
+
+    def test_bulk_upsert_without_conflict_update_support(self):
+        """Test fallback to bulk_create and bulk_update on backends without INSERT ... ON CONFLICT."""
+        with patch.object(connection.features, "supports_update_conflicts_with_target", False, create=True):
+            self._assert_products_upserted(self._upsert_products())
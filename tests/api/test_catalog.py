@@ -0,0 +1,68 @@
+from django.core.cache import caches
+from django.test import override_settings
+from rest_framework.test import APIClient
+
+from drf_stripe import cache
+from drf_stripe.catalog import get_catalog_snapshot
+from drf_stripe.settings import drf_stripe_settings
+from drf_stripe.stripe_webhooks.handler import handle_webhook_event
+from ..base import BaseTest
+
+
+@override_settings(DRF_STRIPE={**drf_stripe_settings.user_settings, "CATALOG_CACHE": "shared"})
+class TestCatalogSnapshot(BaseTest):
+    def setUp(self) -> None:
+        caches["shared"].clear()
+        self.setup_product_prices()
+        self.client = APIClient()
+
+    def test_snapshot_served_without_queries(self):
+        """
+        Test the anonymous subscribable product list is served from the snapshot once loaded.
+        """
+        with self.assertNumQueries(2):
+            expected = self.client.get("/stripe/subscribable-product/").data
+        with self.assertNumQueries(0):
+            response = self.client.get("/stripe/subscribable-product/")
+        self.assertEqual(response.data, expected)
+        self.assertTrue(all(price["services"] for price in response.data))
+
+    def test_snapshot_reloaded_after_price_webhook(self):
+        """
+        Test a price webhook event replaces the catalog version, and the snapshot is reloaded on the next read.
+        """
+        snapshot = get_catalog_snapshot()
+        self.assertIs(get_catalog_snapshot(), snapshot)
+
+        event = self._load_test_data("2020-08-27/webhook_price_updated.json")
+        event["data"]["object"]["nickname"] = "Renamed price"
+        handle_webhook_event(event)
+
+        reloaded = get_catalog_snapshot()
+        self.assertIsNot(reloaded, snapshot)
+        self.assertNotEqual(reloaded.version, snapshot.version)
+        self.assertIn("Renamed price", {price.nickname for price in reloaded.prices})
+        self.assertIs(get_catalog_snapshot(), reloaded)
+
+    @override_settings(CACHES={
+        "process_a": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "process_a"},
+        "process_b": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "process_b"},
+    })
+    def test_per_process_cache_not_used(self):
+        """
+        Test a snapshot is not served from a cache kept in each process, where the version replaced by another process
+        is never seen.
+        """
+        cache._warned_settings.clear()
+        with override_settings(DRF_STRIPE={**drf_stripe_settings.user_settings, "CATALOG_CACHE": "process_a"}):
+            with self.assertLogs("drf_stripe.cache", "WARNING"):
+                get_catalog_snapshot()
+
+        # another process, whose cache is not the reader's, applies a price webhook event
+        with override_settings(DRF_STRIPE={**drf_stripe_settings.user_settings, "CATALOG_CACHE": "process_b"}):
+            event = self._load_test_data("2020-08-27/webhook_price_updated.json")
+            event["data"]["object"]["nickname"] = "Renamed price"
+            handle_webhook_event(event)
+
+        with override_settings(DRF_STRIPE={**drf_stripe_settings.user_settings, "CATALOG_CACHE": "process_a"}):
+            self.assertIn("Renamed price", {price.nickname for price in get_catalog_snapshot().prices})
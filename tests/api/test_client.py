@@ -0,0 +1,76 @@
+from unittest.mock import MagicMock, patch
+
+import stripe
+from django.test import override_settings
+
+from drf_stripe.settings import drf_stripe_settings
+from drf_stripe.stripe_api.api import install_http_client
+from drf_stripe.stripe_api.client import RateLimitedRequestsClient
+from ..base import BaseTest
+
+
+class TestRateLimitedRequestsClient(BaseTest):
+    def _make_client(self, responses, **kwargs):
+        client = RateLimitedRequestsClient(**kwargs)
+        client._sleep_time_seconds = lambda num_retries, response=None: 0
+        client.read_rate_limiter = MagicMock()
+        client.write_rate_limiter = MagicMock()
+        client._session = MagicMock()
+        client._session.request.side_effect = [
+            MagicMock(status_code=status_code, content=b"{}", headers={}) for status_code in responses
+        ]
+        return client
+
+    def test_stripe_uses_client(self):
+        """
+        Test the client is installed as Stripe's default HTTP client.
+        """
+        self.assertIsInstance(stripe.default_http_client, RateLimitedRequestsClient)
+
+    def test_project_client_kept(self):
+        """
+        Test a default HTTP client set by the project is only replaced when STRIPE_API_REPLACE_HTTP_CLIENT is True.
+        """
+        project_client = MagicMock()
+        with patch.object(stripe, "default_http_client", project_client):
+            install_http_client()
+            self.assertIs(stripe.default_http_client, project_client)
+
+            with override_settings(DRF_STRIPE={**drf_stripe_settings.user_settings,
+                                               "STRIPE_API_REPLACE_HTTP_CLIENT": True}):
+                install_http_client()
+            self.assertIsInstance(stripe.default_http_client, RateLimitedRequestsClient)
+
+    def test_stream_request_rate_limited(self):
+        """
+        Test streamed requests, ie: file downloads, take a token from the read bucket.
+        """
+        client = self._make_client([200])
+
+        _, status_code, _ = client.request_stream_with_retries("get", "https://files.stripe.com/v1/files/file_1", {})
+
+        self.assertEqual(status_code, 200)
+        self.assertEqual(client.read_rate_limiter.acquire.call_count, 1)
+
+    def test_retry_rate_limited_request(self):
+        """
+        Test a rate limited request is retried, and each attempt takes a token from the read bucket.
+        """
+        client = self._make_client([429, 200], max_retries=2)
+
+        _, status_code, _ = client.request_with_retries("get", "https://api.stripe.com/v1/customers", {})
+
+        self.assertEqual(status_code, 200)
+        self.assertEqual(client.read_rate_limiter.acquire.call_count, 2)
+        client.write_rate_limiter.acquire.assert_not_called()
+
+    def test_retries_exhausted(self):
+        """
+        Test the last response is returned once retries are exhausted.
+        """
+        client = self._make_client([429, 429], max_retries=1)
+
+        _, status_code, _ = client.request_with_retries("post", "https://api.stripe.com/v1/customers", {})
+
+        self.assertEqual(status_code, 429)
+        self.assertEqual(client.write_rate_limiter.acquire.call_count, 2)
@@ -0,0 +1,91 @@
+from unittest.mock import patch
+
+from django.core.cache import caches
+from django.test import override_settings
+
+from drf_stripe import cache, entitlements
+from drf_stripe.models import StripeUser, Subscription
+from drf_stripe.settings import drf_stripe_settings
+from drf_stripe.stripe_api.products import stripe_api_update_products_prices
+from drf_stripe.stripe_webhooks.handler import handle_webhook_event
+from ..base import BaseTest
+
+
+@override_settings(DRF_STRIPE={**drf_stripe_settings.user_settings, "ENTITLEMENT_CACHE": "shared"})
+class TestEntitlementCache(BaseTest):
+    def setUp(self) -> None:
+        caches["shared"].clear()
+        self.setup_product_prices()
+        self.user, _ = self.setup_user_customer()
+        handle_webhook_event(self._load_test_data("2020-08-27/webhook_subscription_created.json"))
+
+    def _get_stripe_user(self):
+        return StripeUser.objects.get(user_id=self.user.id)
+
+    def test_feature_checks_are_cached(self):
+        """
+        Test entitlements are queried once, then feature checks do not query the database.
+        """
+        stripe_user = self._get_stripe_user()
+        with self.assertNumQueries(2):
+            self.assertTrue(stripe_user.has_feature("A"))
+        with self.assertNumQueries(0):
+            self.assertTrue(stripe_user.has_feature("B"))
+            self.assertFalse(stripe_user.has_feature("C"))
+            self.assertEqual(stripe_user.subscribed_product_ids, {"prod_KxfXRXOd7dnLbz"})
+        self.assertEqual({feature.feature_id for feature in stripe_user.subscribed_features}, {"A", "B", "D"})
+
+    def test_subscription_webhook_invalidates_user(self):
+        """
+        Test a subscription webhook event invalidates the cached entitlements of the subscription's user.
+        """
+        self.assertTrue(self._get_stripe_user().has_feature("A"))
+
+        handle_webhook_event(self._load_test_data("2020-08-27/webhook_subscription_updated_cancel_immediate.json"))
+
+        self.assertFalse(self._get_stripe_user().has_feature("A"))
+
+    def test_product_features_change_invalidates_catalog(self):
+        """
+        Test cached entitlements of all users are invalidated when features linked to a product change.
+        """
+        self.assertFalse(self._get_stripe_user().has_feature("E"))
+
+        products = self._load_test_data("v1/api_product_list.json")
+        for product in products["data"]:
+            if product["id"] == "prod_KxfXRXOd7dnLbz":
+                product["metadata"]["features"] = "A E"
+        stripe_api_update_products_prices(test_products=products,
+                                          test_prices=self._load_test_data("v1/api_price_list.json"))
+
+        stripe_user = self._get_stripe_user()
+        self.assertTrue(stripe_user.has_feature("E"))
+        self.assertFalse(stripe_user.has_feature("B"))
+
+    def test_cache_miss_waits_for_lock_holder(self):
+        """
+        Test a cache miss waits for entitlements computed by the process holding the lock, instead of querying.
+        """
+        shared_cache = caches["shared"]
+        key = entitlements._get_entitlements_key(shared_cache, self.user.id)
+        shared_cache.add(f"{key}:lock", True)
+
+        def sleep(seconds):
+            shared_cache.set(key, entitlements.Entitlements(product_ids=frozenset(), feature_ids=frozenset({"Z"})))
+
+        with patch.object(entitlements.time, "sleep", side_effect=sleep), self.assertNumQueries(0):
+            self.assertEqual(entitlements.get_user_entitlements(self.user.id).feature_ids, {"Z"})
+
+    @override_settings(CACHES={"local": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+                       DRF_STRIPE={**drf_stripe_settings.user_settings, "ENTITLEMENT_CACHE": "local"})
+    def test_per_process_cache_not_used(self):
+        """
+        Test a cache kept in each process is not used for entitlements, since other processes cannot invalidate it.
+        """
+        cache._warned_settings.clear()
+        with self.assertLogs("drf_stripe.cache", "WARNING"):
+            self.assertTrue(self._get_stripe_user().has_feature("A"))
+        self.assertEqual(caches["local"].get_many([entitlements._CATALOG_VERSION_KEY]), {})
+
+        Subscription.objects.update(status="canceled")
+        self.assertFalse(self._get_stripe_user().has_feature("A"))
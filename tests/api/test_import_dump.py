@@ -0,0 +1,79 @@
+import io
+import json
+import tempfile
+from pathlib import Path
+from unittest.mock import patch
+
+from django.core.management import call_command
+
+from drf_stripe.models import Price, Product, StripeUser, Subscription
+from drf_stripe.stripe_api import dumps
+from drf_stripe.stripe_api.dumps import iter_dump_objects
+from ..base import BaseTest
+
+
+class TestImportDump(BaseTest):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def _write_dump(self, name, content):
+        path = Path(self.tmp_dir.name) / name
+        path.write_text(content, encoding="utf-8")
+        return str(path)
+
+    def test_iter_dump_objects_json_array(self):
+        """
+        Test objects of a top level JSON array are parsed across read chunks, list responses are flattened.
+        """
+        customers = self._load_test_data("v1/api_customer_list_2_items.json")
+        content = json.dumps([customers["data"][0], customers], indent=2)
+
+        with patch.object(dumps, "_READ_SIZE", 16):
+            objects = list(iter_dump_objects(io.StringIO(content)))
+
+        self.assertEqual([obj["id"] for obj in objects], ["cus_tester", "cus_tester", "cus_tester2", "cus_tester3"])
+
+    def test_iter_dump_objects_invalid_line(self):
+        """
+        Test a corrupt line in the middle of a JSON Lines file raises an error giving its position, without reading
+        the rest of the file.
+        """
+        customers = self._load_test_data("v1/api_customer_list_2_items.json")["data"]
+        lines = [json.dumps(customer) for customer in customers]
+        lines[1] = lines[1][:20] + "}"
+        fp = io.StringIO("\n".join(lines) + "\n" + "\n".join(lines * 100))
+
+        with patch.object(dumps, "_READ_SIZE", 64):
+            objects = iter_dump_objects(fp)
+            self.assertEqual(next(objects)["id"], "cus_tester")
+            with self.assertRaisesRegex(ValueError, "^Invalid JSON at line 2 column 22"):
+                next(objects)
+
+        self.assertLess(fp.tell(), len(fp.getvalue()) / 10)
+
+    @patch('stripe.Customer.retrieve')
+    def test_import_stripe_dump(self, mocked_retrieve_fn):
+        """
+        Test importing products, prices, customers and subscriptions from JSON Lines dumps without calling Stripe.
+        """
+        self.setup_user_customer()
+        catalog_path = self._write_dump("catalog.jsonl", "\n".join([
+            json.dumps(self._load_test_data("v1/api_product_list.json")),
+            json.dumps(self._load_test_data("v1/api_price_list.json")),
+        ]))
+        customers = self._load_test_data("v1/api_customer_list_2_items.json")
+        subscriptions = self._load_test_data("v1/api_subscription_list.json")
+        accounts_path = self._write_dump("accounts.jsonl", "\n".join(
+            json.dumps(obj) for obj in customers["data"] + subscriptions["data"]))
+
+        call_command("import_stripe_dump", catalog_path, accounts_path, batch_size=1)
+
+        mocked_retrieve_fn.assert_not_called()
+        self.assertTrue(Product.objects.filter(product_id="prod_KxfXRXOd7dnLbz").exists())
+        self.assertTrue(Price.objects.filter(price_id="price_1KHkCLL14ex1CGCipzcBdnOp").exists())
+        self.assertEqual(StripeUser.objects.get(customer_id="cus_tester2").user.email, "tester2@example.com")
+        self.assertEqual(Subscription.objects.get(subscription_id="sub_0002").stripe_user.customer_id, "cus_tester2")
+        self.assertEqual(Subscription.objects.get(subscription_id="sub_0001").items.count(), 1)
@@ -0,0 +1,120 @@
+from copy import deepcopy
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+
+from django.test import override_settings
+
+from drf_stripe.models import StripeUser, Subscription
+from drf_stripe.settings import drf_stripe_settings
+from drf_stripe.stripe_api.customers import stripe_api_update_customers
+from drf_stripe.stripe_api.subscriptions import stripe_api_update_subscriptions
+from drf_stripe.stripe_api.sync import CUSTOMERS_SYNC, SUBSCRIPTIONS_SYNC, get_sync_cursor, save_sync_cursor
+from ..base import BaseTest
+
+
+class TestIncrementalSync(BaseTest):
+    def setUp(self) -> None:
+        self.setup_user_customer()
+        self.setup_product_prices()
+
+    def _make_event(self, event_id, created, subscription):
+        return {"id": event_id, "object": "event", "type": "customer.subscription.updated", "created": created,
+                "data": {"object": subscription}}
+
+    @patch('stripe.Customer.list')
+    @patch('stripe.Event.list')
+    def test_incremental_customers(self, event_list_fn, customer_list_fn):
+        """
+        Test first incremental customer sync lists all customers, the next one applies customer events, including
+        updates of existing customers.
+        """
+        customer_list_fn.return_value = {"data": [], "has_more": False}
+        created = int((datetime.now(tz=timezone.utc) - timedelta(days=1)).timestamp())
+        event_list_fn.return_value = {"data": [self._make_event("evt_latest", created, {})], "has_more": False}
+
+        stripe_api_update_customers(incremental=True)
+        customer_list_fn.assert_called_once()
+        self.assertEqual(get_sync_cursor(CUSTOMERS_SYNC), datetime.fromtimestamp(created, tz=timezone.utc))
+
+        customer = self._load_test_data("v1/api_customer_list_2_items.json")["data"][1]
+        event = self._make_event("evt_updated", created + 60, customer)
+        event["type"] = "customer.updated"
+        event_list_fn.return_value = {"data": [event], "has_more": False}
+
+        with override_settings(DRF_STRIPE={**drf_stripe_settings.user_settings,
+                                           "USER_CREATE_DEFAULTS_ATTRIBUTE_MAP": {"username": "email"}}):
+            stripe_api_update_customers(incremental=True)
+
+        customer_list_fn.assert_called_once()
+        self.assertEqual(event_list_fn.call_args.kwargs["created"], {"gte": created})
+        self.assertTrue(StripeUser.objects.filter(customer_id=customer["id"]).exists())
+        self.assertEqual(get_sync_cursor(CUSTOMERS_SYNC), datetime.fromtimestamp(created + 60, tz=timezone.utc))
+
+    @patch('stripe.Customer.retrieve')
+    @patch('stripe.Subscription.list')
+    @patch('stripe.Event.list')
+    def test_incremental_subscriptions_without_cursor(self, event_list_fn, subscription_list_fn, retrieve_fn):
+        """
+        Test first incremental subscription sync retrieves all subscriptions and records the latest event.
+        """
+        retrieve_fn.return_value = {"email": "tester2@example.com", "id": "cus_tester2"}
+        subscription_list_fn.return_value = self._load_test_data("v1/api_subscription_list.json")
+        event_list_fn.return_value = {"data": [self._make_event("evt_latest", 1642279004, {})], "has_more": False}
+
+        stripe_api_update_subscriptions(incremental=True)
+
+        subscription_list_fn.assert_called_once()
+        self.assertEqual(Subscription.objects.count(), 2)
+        self.assertEqual(get_sync_cursor(SUBSCRIPTIONS_SYNC), datetime.fromtimestamp(1642279004, tz=timezone.utc))
+
+    @patch('stripe.Subscription.list')
+    @patch('stripe.Event.list')
+    def test_incremental_subscriptions_from_events(self, event_list_fn, subscription_list_fn):
+        """
+        Test incremental subscription sync applies the latest state of each subscription from Stripe events.
+        """
+        subscription = self._load_test_data("v1/api_subscription_list.json")["data"][0]
+        old_subscription = deepcopy(subscription)
+        subscription["status"] = "active"
+
+        since = datetime.now(tz=timezone.utc) - timedelta(days=1)
+        save_sync_cursor(SUBSCRIPTIONS_SYNC, since, "evt_old")
+        created = int(since.timestamp()) + 60
+        event_list_fn.return_value = {
+            "data": [self._make_event("evt_2", created + 1, subscription),
+                     self._make_event("evt_1", created, old_subscription)],
+            "has_more": False
+        }
+
+        stripe_api_update_subscriptions(incremental=True)
+
+        subscription_list_fn.assert_not_called()
+        self.assertEqual(event_list_fn.call_args.kwargs["created"], {"gte": int(since.timestamp())})
+        self.assertEqual(Subscription.objects.get(subscription_id="sub_0001").status, "active")
+        self.assertEqual(get_sync_cursor(SUBSCRIPTIONS_SYNC), datetime.fromtimestamp(created + 1, tz=timezone.utc))
+
+    @patch('stripe.Customer.list')
+    @patch('stripe.Subscription.list')
+    @patch('stripe.Event.list')
+    def test_incremental_sync_without_events(self, event_list_fn, subscription_list_fn, customer_list_fn):
+        """
+        Test incremental syncs of an account without events record their start time, so the next incremental syncs
+        read events instead of retrieving all objects again.
+        """
+        event_list_fn.return_value = {"data": [], "has_more": False}
+        subscription_list_fn.return_value = {"data": [], "has_more": False}
+        customer_list_fn.return_value = {"data": [], "has_more": False}
+        # the last incremental syncs are older than the events Stripe keeps
+        old_cursor = datetime.now(tz=timezone.utc) - timedelta(days=40)
+        save_sync_cursor(SUBSCRIPTIONS_SYNC, old_cursor)
+        save_sync_cursor(CUSTOMERS_SYNC, old_cursor)
+
+        for _ in range(2):
+            started_at = datetime.now(tz=timezone.utc)
+            stripe_api_update_subscriptions(incremental=True)
+            stripe_api_update_customers(incremental=True)
+            self.assertGreaterEqual(get_sync_cursor(SUBSCRIPTIONS_SYNC), started_at)
+            self.assertGreaterEqual(get_sync_cursor(CUSTOMERS_SYNC), started_at)
+
+        subscription_list_fn.assert_called_once()
+        customer_list_fn.assert_called_once()
@@ -0,0 +1,29 @@
+from unittest.mock import patch, call
+
+from drf_stripe.models import StripeUser
+from drf_stripe.stripe_api.customers import stripe_api_update_customers
+from ..base import BaseTest
+
+
+class TestPagination(BaseTest):
+    def setUp(self) -> None:
+        self.setup_user_customer()
+
+    @patch('stripe.Customer.list')
+    def test_update_customers_all_pages(self, mocked_list_fn):
+        """
+        Test all pages of customers are retrieved, following has_more and starting_after.
+        """
+        response = self._load_test_data("v1/api_customer_list_2_items.json")
+        first_page = {**response, "data": response["data"][:1], "has_more": True}
+        last_page = {**response, "data": response["data"][1:], "has_more": False}
+        mocked_list_fn.side_effect = [first_page, last_page]
+
+        stripe_api_update_customers(limit=1)
+
+        self.assertEqual(mocked_list_fn.call_args_list, [
+            call(limit=1, starting_after=None),
+            call(limit=1, starting_after=response["data"][0]["id"]),
+        ])
+        self.assertEqual(StripeUser.objects.filter(customer_id__in=[c["id"] for c in response["data"]]).count(),
+                         len(response["data"]))
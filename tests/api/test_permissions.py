@@ -0,0 +1,94 @@
+from django.core.cache import caches
+from django.test import override_settings
+from rest_framework.response import Response
+from rest_framework.test import APIRequestFactory, force_authenticate
+from rest_framework.views import APIView
+
+from drf_stripe.models import SubscriptionItem, UserEntitlement
+from drf_stripe.permissions import HasActiveSubscription, HasAnyProduct, HasFeature
+from drf_stripe.settings import drf_stripe_settings
+from drf_stripe.stripe_webhooks.handler import handle_webhook_event
+from ..base import BaseTest
+
+
+def make_view(*permissions):
+    class View(APIView):
+        permission_classes = list(permissions)
+
+        def get(self, request):
+            return Response({})
+
+    return View.as_view()
+
+
+class TestPermissions(BaseTest):
+    def setUp(self) -> None:
+        caches["shared"].clear()
+        self.setup_product_prices()
+        self.user, _ = self.setup_user_customer()
+        handle_webhook_event(self._load_test_data("2020-08-27/webhook_subscription_created.json"))
+
+    def _get(self, *permissions):
+        request = APIRequestFactory().get("/")
+        force_authenticate(request, user=self.user)
+        return make_view(*permissions)(request).status_code
+
+    def test_permissions(self):
+        """
+        Test feature, product and subscription permissions, alone and combined.
+        """
+        self.assertEqual(self._get(HasFeature("A")), 200)
+        self.assertEqual(self._get(HasFeature("C")), 403)
+        self.assertEqual(self._get(HasAnyProduct("prod_KxgA5goLUMwnoN", "prod_KxfXRXOd7dnLbz")), 200)
+        self.assertEqual(self._get(HasAnyProduct("prod_KxgA5goLUMwnoN")), 403)
+        self.assertEqual(self._get(HasActiveSubscription), 200)
+        self.assertEqual(self._get(HasFeature("C") | HasActiveSubscription), 200)
+        self.assertEqual(self._get(HasActiveSubscription & HasFeature("C")), 403)
+
+    @override_settings(DRF_STRIPE={**drf_stripe_settings.user_settings, "ENTITLEMENT_CACHE": "shared"})
+    def test_permissions_memoized_on_request(self):
+        """
+        Test several checks in one request fetch the user's entitlements once.
+        """
+        with self.assertNumQueries(2):
+            self.assertEqual(self._get(HasActiveSubscription, HasFeature("A"), HasFeature("B"),
+                                       HasAnyProduct("prod_KxfXRXOd7dnLbz")), 200)
+
+    @override_settings(DRF_STRIPE={"ENTITLEMENT_CACHE": None})
+    def test_permissions_without_cache(self):
+        """
+        Test each check runs one existence query when the entitlement cache is disabled.
+        """
+        with self.assertNumQueries(1):
+            self.assertEqual(self._get(HasFeature("A"), HasFeature("A")), 200)
+        with self.assertNumQueries(1):
+            self.assertEqual(self._get(HasFeature("C")), 403)
+        with self.assertNumQueries(1):
+            self.assertEqual(self._get(HasAnyProduct("prod_KxgA5goLUMwnoN")), 403)
+        with self.assertNumQueries(1):
+            self.assertEqual(self._get(HasActiveSubscription), 200)
+
+    @override_settings(DRF_STRIPE={"ENTITLEMENT_CACHE": None})
+    def test_permissions_without_cache_match_cached(self):
+        """
+        Test checks without the cache give the same answers as with it, whatever the UserEntitlement rows.
+        """
+        UserEntitlement.objects.all().delete()
+        self.test_permissions()
+
+    def test_active_subscription_without_items(self):
+        """
+        Test a subscription granting access without items passes HasActiveSubscription, with and without the cache.
+        """
+        SubscriptionItem.objects.all().delete()
+        for entitlement_cache in ("shared", None):
+            with override_settings(DRF_STRIPE={"ENTITLEMENT_CACHE": entitlement_cache}):
+                self.assertEqual(self._get(HasActiveSubscription), 200)
+                self.assertEqual(self._get(HasAnyProduct("prod_KxfXRXOd7dnLbz")), 403)
+
+    def test_anonymous_user(self):
+        """
+        Test anonymous users are denied without querying.
+        """
+        with self.assertNumQueries(0):
+            self.assertIn(make_view(HasFeature("A"))(APIRequestFactory().get("/")).status_code, (401, 403))
@@ -0,0 +1,79 @@
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+from django.core.management import call_command
+
+from drf_stripe.management.commands.pull_stripe import Command as PullStripeCommand
+from drf_stripe.models import Price, StripeUser, Subscription
+from drf_stripe.stripe_api import pull
+from drf_stripe.stripe_api.concurrency import PrefetchedPages
+from ..base import BaseTest
+
+
+class TestPullStripe(BaseTest):
+    def setUp(self) -> None:
+        self.setup_user_customer()
+
+    def test_prefetched_pages(self):
+        """
+        Test pages fetched on another thread are consumed in order, and fetching errors are raised to the consumer.
+        """
+
+        def pages():
+            yield from range(5)
+            raise ValueError("fetch failed")
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            consumed = []
+            with self.assertRaises(ValueError):
+                for page in PrefetchedPages(pages(), executor, max_buffered_pages=1):
+                    consumed.append(page)
+
+        self.assertEqual(consumed, [0, 1, 2, 3, 4])
+
+    @patch('stripe.Customer.retrieve')
+    @patch('stripe.Subscription.list')
+    @patch('stripe.Customer.list')
+    @patch('stripe.Price.list')
+    @patch('stripe.Product.list')
+    def test_pull_stripe_concurrently(self, product_list_fn, price_list_fn, customer_list_fn, subscription_list_fn,
+                                      retrieve_fn):
+        """
+        Test pulling all objects from Stripe with concurrent fetching.
+        """
+        product_list_fn.return_value = self._load_test_data("v1/api_product_list.json")
+        price_list_fn.return_value = self._load_test_data("v1/api_price_list.json")
+        customer_list_fn.return_value = self._load_test_data("v1/api_customer_list_2_items.json")
+        subscription_list_fn.return_value = self._load_test_data("v1/api_subscription_list.json")
+
+        call_command("pull_stripe", workers=2, rate_limit=100)
+
+        retrieve_fn.assert_not_called()
+        self.assertTrue(Price.objects.filter(price_id="price_1KHkCLL14ex1CGCipzcBdnOp").exists())
+        self.assertEqual(StripeUser.objects.get(customer_id="cus_tester2").user.email, "tester2@example.com")
+        self.assertEqual(Subscription.objects.get(subscription_id="sub_0002").stripe_user.customer_id, "cus_tester2")
+
+    @patch('stripe.Subscription.list')
+    @patch('stripe.Customer.list')
+    @patch('stripe.Price.list')
+    @patch('stripe.Product.list')
+    def test_pull_stripe_workers_capped(self, product_list_fn, price_list_fn, customer_list_fn, subscription_list_fn):
+        """
+        Test no more threads than types of objects are started.
+        """
+        for list_fn in (product_list_fn, price_list_fn, customer_list_fn, subscription_list_fn):
+            list_fn.return_value = {"object": "list", "data": [], "has_more": False}
+
+        with patch.object(pull, "ThreadPoolExecutor", wraps=ThreadPoolExecutor) as executor_cls:
+            call_command("pull_stripe", workers=8)
+
+        self.assertEqual(executor_cls.call_args.kwargs["max_workers"], 4)
+
+    def test_pull_stripe_short_flags(self):
+        """
+        Test -r means --resume, as for the update_stripe_customers and update_stripe_subscriptions commands.
+        """
+        parser = PullStripeCommand().create_parser("manage.py", "pull_stripe")
+
+        self.assertTrue(parser.parse_args(["-r"]).resume)
+        self.assertEqual(parser.parse_args(["--rate_limit", "5"]).rate_limit, 5)
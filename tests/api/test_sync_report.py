@@ -0,0 +1,94 @@
+import time
+from io import StringIO
+from unittest.mock import MagicMock, patch
+
+from django.core.management import call_command
+from django.test import override_settings
+
+from drf_stripe.settings import drf_stripe_settings
+from drf_stripe.stripe_api.subscriptions import stripe_api_update_subscriptions
+from drf_stripe.stripe_api.sync import SyncReport, format_sync_summary
+from ..base import BaseTest
+
+
+class TestSyncReport(BaseTest):
+    def setUp(self) -> None:
+        self.setup_user_customer()
+        self.setup_product_prices()
+
+    @patch('stripe.Customer.retrieve')
+    def test_sync_metrics(self, mocked_retrieve_fn):
+        """
+        Test page metrics are passed to SYNC_METRICS_CALLBACK and totals are counted in the report.
+        """
+        response = self._load_test_data("v1/api_subscription_list.json")
+        mocked_retrieve_fn.return_value = {
+            "email": "tester2@example.com",
+            "id": "cus_tester2",
+        }
+        callback = MagicMock()
+        drf_stripe_copy = {**drf_stripe_settings.user_settings, 'SYNC_METRICS_CALLBACK': callback}
+        with override_settings(DRF_STRIPE=drf_stripe_copy):
+            report = stripe_api_update_subscriptions(test_data=response)
+            resynced_report = stripe_api_update_subscriptions(test_data=response)
+
+        self.assertEqual((report.pages, report.rows, report.created, report.updated, report.skipped),
+                         (1, 2, 2, 0, 0))
+        self.assertEqual((resynced_report.created, resynced_report.updated, resynced_report.skipped), (0, 0, 2))
+        self.assertEqual(callback.call_count, 2)
+        resource, metrics = callback.call_args.args
+        self.assertEqual(resource, "subscriptions")
+        self.assertEqual((metrics["rows"], metrics["skipped"], metrics["errors"]), (2, 2, 0))
+
+    @patch('stripe.Customer.retrieve')
+    def test_sync_stripe_calls_timed_as_fetch(self, mocked_retrieve_fn):
+        """
+        Test Stripe API calls made while processing a page are counted as fetch time, not write time.
+        """
+        response = self._load_test_data("v1/api_subscription_list.json")
+
+        def retrieve(customer_id):
+            time.sleep(0.2)
+            return {"email": "tester2@example.com", "id": customer_id}
+
+        mocked_retrieve_fn.side_effect = retrieve
+        callback = MagicMock()
+        drf_stripe_copy = {**drf_stripe_settings.user_settings, 'SYNC_METRICS_CALLBACK': callback}
+        with override_settings(DRF_STRIPE=drf_stripe_copy):
+            report = stripe_api_update_subscriptions(test_data=response)
+
+        self.assertGreaterEqual(report.fetch_seconds, 0.2)
+        self.assertLess(report.write_seconds, 0.2)
+        _, metrics = callback.call_args.args
+        self.assertLess(metrics["write_seconds"], 0.2)
+
+    def test_format_sync_summary(self):
+        """
+        Test the summary table has a header and one row per report.
+        """
+        report = SyncReport("products")
+        report.rows = 10
+        report.add_counts(created=4, updated=1, skipped=5)
+        report.finish()
+
+        lines = format_sync_summary([report, SyncReport("prices")]).splitlines()
+
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[0].split()[:7], ["resource", "pages", "rows", "created", "updated", "skipped", "errors"])
+        self.assertEqual(lines[1].split()[:7], ["products", "0", "10", "4", "1", "5", "0"])
+
+    @patch('stripe.Price.list')
+    @patch('stripe.Product.list')
+    def test_update_stripe_products_command_summary(self, product_list_fn, price_list_fn):
+        """
+        Test the command prints the summary table.
+        """
+        product_list_fn.return_value = self._load_test_data("v1/api_product_list.json")
+        price_list_fn.return_value = self._load_test_data("v1/api_price_list.json")
+        out = StringIO()
+
+        call_command("update_stripe_products", stdout=out)
+
+        lines = out.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith("resource"))
+        self.assertEqual([line.split()[0] for line in lines[1:]], ["products", "prices"])
@@ -1,11 +1,15 @@
 from drf_stripe.models import get_drf_stripe_user_model as get_user_model
 
 from drf_stripe.models import StripeUser
-from drf_stripe.stripe_api.customers import stripe_api_update_customers
+from drf_stripe.stripe_api.customers import stripe_api_update_customers, get_stripe_users_by_customer_id, \
+    _update_customers
+from drf_stripe.stripe_api.sync import CUSTOMERS_SYNC, SyncReport
+from drf_stripe.stripe_models.customer import StripeCustomers
 from ..base import BaseTest
 
 from drf_stripe.settings import drf_stripe_settings
 from django.test import override_settings
+from unittest.mock import patch
 
 
 class TestCustomer(BaseTest):
@@ -60,3 +64,50 @@ class TestCustomer(BaseTest):
         self.assertIsNone(user_3)
         stripe_user_3 = StripeUser.objects.filter(customer_id="cus_tester3").first()
         self.assertIsNone(stripe_user_3)
+
+    def test_update_customers_attribute_map_with_email_field(self):
+        """
+        Test users are created when USER_CREATE_DEFAULTS_ATTRIBUTE_MAP also maps the user model's email field.
+        """
+        drf_stripe_copy = {**drf_stripe_settings.user_settings,
+                           'USER_CREATE_DEFAULTS_ATTRIBUTE_MAP': {'username': 'email', 'email': 'email'}}
+        with override_settings(DRF_STRIPE=drf_stripe_copy):
+            response = self._load_test_data("v1/api_customer_list_2_items.json")
+
+            stripe_api_update_customers(test_data=response)
+
+        user_2 = get_user_model().objects.get(email="tester2@example.com")
+        self.assertEqual(user_2.username, "tester2@example.com")
+        self.assertEqual(StripeUser.objects.get(user=user_2).customer_id, "cus_tester2")
+
+    def test_update_customers_batched_queries(self):
+        """
+        Test users of a page of customers are resolved and created with a fixed number of queries.
+        """
+        response = self._load_test_data("v1/api_customer_list_2_items.json")
+        stripe_customers = StripeCustomers(**response).data
+
+        # lookup users, create missing users in a savepoint, reload them, lookup and create StripeUsers
+        with self.assertNumQueries(7):
+            users_created, stripe_users_created = _update_customers(stripe_customers, SyncReport(CUSTOMERS_SYNC))
+
+        self.assertEqual((users_created, stripe_users_created), (2, 2))
+        self.assertEqual(StripeUser.objects.get(customer_id="cus_tester3").user.email, "tester3@example.com")
+
+    @patch('stripe.Customer.retrieve')
+    def test_get_stripe_users_by_customer_id(self, mocked_retrieve_fn):
+        """
+        Test known customers are loaded from the database and only unknown customers are retrieved from Stripe.
+        """
+        mocked_retrieve_fn.side_effect = lambda customer_id: {
+            "cus_tester2": {"id": "cus_tester2", "email": "tester2@example.com"},
+            "cus_no_email": {"id": "cus_no_email", "email": None},
+        }[customer_id]
+
+        stripe_users, errors = get_stripe_users_by_customer_id(["cus_tester", "cus_tester2", "cus_no_email"])
+
+        self.assertEqual(sorted(call.args[0] for call in mocked_retrieve_fn.call_args_list),
+                         ["cus_no_email", "cus_tester2"])
+        self.assertEqual(stripe_users["cus_tester"].user.email, "tester1@example.com")
+        self.assertEqual(stripe_users["cus_tester2"].user.email, "tester2@example.com")
+        self.assertEqual(list(errors), ["cus_no_email"])
@@ -1,4 +1,6 @@
 from drf_stripe.models import Product, Price, Feature, ProductFeature
+from drf_stripe.stripe_api.products import update_products_features
+from drf_stripe.stripe_models.product import StripeProduct
 from tests.base import BaseTest
 
 
@@ -40,3 +42,23 @@ class TestProductInitialization(BaseTest):
         self.assertEqual(price_abc1.product.product_id, prod_abc.product_id)
         self.assertEqual(price_abd1.product.product_id, prod_abd.product_id)
         self.assertEqual(price_abd2.product.product_id, prod_abd.product_id)
+
+    def test_update_products_features(self):
+        """
+        Check product features are deduplicated and only differences are written.
+        """
+        products = [
+            StripeProduct(id='prod_KxgA5goLUMwnoN', metadata={"features": "A  B B  E "}),
+            StripeProduct(id='prod_KxfXRXOd7dnLbz', metadata={"features": "A B D"}),
+        ]
+        update_products_features(products)
+
+        self.assertFalse(Feature.objects.filter(feature_id='').exists())
+        self.assertEqual(
+            set(ProductFeature.objects.filter(product_id='prod_KxgA5goLUMwnoN').values_list('feature_id', flat=True)),
+            {'A', 'B', 'E'})
+        self.assertEqual(ProductFeature.objects.filter(product_id='prod_KxgA5goLUMwnoN').count(), 3)
+
+        # unchanged features of a batch of products only need to be loaded
+        with self.assertNumQueries(2):
+            update_products_features(products)
@@ -1,10 +1,14 @@
 from django.contrib.auth import get_user_model
-from drf_stripe.models import Subscription, StripeUser
-from drf_stripe.stripe_api.subscriptions import stripe_api_update_subscriptions
+from drf_stripe.models import Subscription, StripeUser, SubscriptionItem
+from drf_stripe.stripe_api.concurrency import get_shared_rate_limiter
+from drf_stripe.stripe_api.subscriptions import stripe_api_update_subscriptions, update_subscription_items
+from drf_stripe.stripe_api.sync import SUBSCRIPTIONS_SYNC, get_sync_checkpoint, save_sync_checkpoint
+from drf_stripe.stripe_models.subscription import StripeSubscriptions
 from ..base import BaseTest
 
 from unittest.mock import patch
 from drf_stripe.settings import drf_stripe_settings
+from django.db import IntegrityError, connections
 from django.test import override_settings
 
 
@@ -53,8 +57,7 @@ class TestSubscription(BaseTest):
         """
         Test retrieving list of subscription from Stripe and update database without creating django users if they don't already exist.
         """
-        drf_stripe_copy = drf_stripe_settings.user_settings
-        drf_stripe_copy['USER_CREATE_DEFAULTS_ATTRIBUTE_MAP'] = None
+        drf_stripe_copy = {**drf_stripe_settings.user_settings, 'USER_CREATE_DEFAULTS_ATTRIBUTE_MAP': None}
         with override_settings(DRF_STRIPE=drf_stripe_copy):
             response = self._load_test_data("v1/api_subscription_list.json")
 
@@ -80,3 +83,205 @@ class TestSubscription(BaseTest):
         self.assertIsNone(user_2)
         stripe_user_2 = StripeUser.objects.filter(customer_id="cus_tester2").first()
         self.assertIsNone(stripe_user_2)
+
+    @patch('stripe.Customer.retrieve')
+    def test_update_subscription_items_diff(self, mocked_retrieve_fn):
+        """
+        Test only changed subscription items are written.
+        """
+        response = self._load_test_data("v1/api_subscription_list.json")
+        mocked_retrieve_fn.return_value = {
+            "email": "tester2@example.com",
+            "id": "cus_tester2",
+        }
+        stripe_api_update_subscriptions(test_data=response)
+        subscriptions = StripeSubscriptions(**response).data
+
+        # unchanged items only need to be loaded
+        with self.assertNumQueries(1):
+            counts = update_subscription_items({sub.id: sub.items.data for sub in subscriptions})
+        self.assertEqual(counts, (0, 0, 0))
+
+        # item quantity changed, item removed from second subscription
+        subscriptions[0].items.data[0].quantity = 3
+        counts = update_subscription_items({subscriptions[0].id: subscriptions[0].items.data, subscriptions[1].id: []})
+        self.assertEqual(counts, (0, 1, 1))
+        self.assertEqual(SubscriptionItem.objects.get(sub_item_id=subscriptions[0].items.data[0].id).quantity, 3)
+        self.assertFalse(SubscriptionItem.objects.filter(subscription_id=subscriptions[1].id).exists())
+
+    @patch('stripe.Customer.retrieve')
+    def test_update_subscriptions_reports_failed_records(self, mocked_retrieve_fn):
+        """
+        Test a subscription that cannot be synced is reported without aborting the rest of the page.
+        """
+        drf_stripe_copy = {**drf_stripe_settings.user_settings, 'USER_CREATE_DEFAULTS_ATTRIBUTE_MAP': None}
+        with override_settings(DRF_STRIPE=drf_stripe_copy):
+            response = self._load_test_data("v1/api_subscription_list.json")
+            mocked_retrieve_fn.return_value = {
+                "email": "tester2@example.com",
+                "id": "cus_tester2",
+            }
+
+            report = stripe_api_update_subscriptions(test_data=response)
+
+        self.assertTrue(Subscription.objects.filter(subscription_id="sub_0001").exists())
+        self.assertFalse(Subscription.objects.filter(subscription_id="sub_0002").exists())
+        self.assertEqual([error.object_id for error in report.errors], ["sub_0002"])
+
+    @patch('stripe.Customer.retrieve')
+    @patch('stripe.Subscription.list')
+    def test_update_subscriptions_reports_failed_writes(self, mocked_list_fn, mocked_retrieve_fn):
+        """
+        Test a subscription whose write fails is reported, the rest of the page is written one subscription at a time,
+        and the page's checkpoint is saved.
+        """
+        mocked_list_fn.return_value = self._load_test_data("v1/api_subscription_list.json")
+        mocked_retrieve_fn.return_value = {"email": "tester2@example.com", "id": "cus_tester2"}
+
+        def update_items(items_by_subscription):
+            if "sub_0001" in items_by_subscription:
+                raise IntegrityError("FOREIGN KEY constraint failed")
+            return update_subscription_items(items_by_subscription)
+
+        with patch("drf_stripe.stripe_api.subscriptions.update_subscription_items", side_effect=update_items), \
+                patch("drf_stripe.stripe_api.subscriptions.save_sync_checkpoint",
+                      wraps=save_sync_checkpoint) as mocked_checkpoint_fn:
+            report = stripe_api_update_subscriptions()
+
+        self.assertFalse(Subscription.objects.filter(subscription_id="sub_0001").exists())
+        self.assertTrue(Subscription.objects.filter(subscription_id="sub_0002").exists())
+        self.assertEqual([error.object_id for error in report.errors], ["sub_0001"])
+        self.assertEqual((report.created, report.updated), (1, 0))
+        self.assertEqual(mocked_checkpoint_fn.call_args_list[0].args[:2], (SUBSCRIPTIONS_SYNC, "sub_0002"))
+
+    @patch('stripe.Customer.retrieve')
+    @patch('stripe.Subscription.list')
+    def test_update_subscriptions_resume(self, mocked_list_fn, mocked_retrieve_fn):
+        """
+        Test pages committed before a failure are kept, and a resumed sync starts after the last committed page.
+        """
+        response = self._load_test_data("v1/api_subscription_list.json")
+        first_page = {**response, "data": response["data"][:1], "has_more": True}
+        second_page = {**response, "data": response["data"][1:], "has_more": False}
+        mocked_retrieve_fn.return_value = {
+            "email": "tester2@example.com",
+            "id": "cus_tester2",
+        }
+        mocked_list_fn.side_effect = [first_page, ConnectionError("connection lost")]
+
+        with self.assertRaises(ConnectionError):
+            stripe_api_update_subscriptions(limit=1)
+        self.assertTrue(Subscription.objects.filter(subscription_id="sub_0001").exists())
+        self.assertEqual(get_sync_checkpoint(SUBSCRIPTIONS_SYNC), "sub_0001")
+
+        # a checkpoint of a sync listing other subscriptions is not resumed
+        mocked_list_fn.side_effect = [{**response, "data": [], "has_more": False}]
+        stripe_api_update_subscriptions(limit=1, status="all", resume=True)
+        self.assertIsNone(mocked_list_fn.call_args.kwargs["starting_after"])
+
+        mocked_list_fn.side_effect = [first_page, ConnectionError("connection lost")]
+        with self.assertRaises(ConnectionError):
+            stripe_api_update_subscriptions(limit=1)
+
+        mocked_list_fn.side_effect = [second_page]
+        stripe_api_update_subscriptions(limit=1, resume=True)
+        self.assertEqual(mocked_list_fn.call_args.kwargs["starting_after"], "sub_0001")
+        self.assertTrue(Subscription.objects.filter(subscription_id="sub_0002").exists())
+        self.assertIsNone(get_sync_checkpoint(SUBSCRIPTIONS_SYNC))
+
+    @patch('stripe.Customer.retrieve')
+    def test_update_subscriptions_skips_unchanged(self, mocked_retrieve_fn):
+        """
+        Test subscriptions whose Stripe data did not change since the last sync are not written.
+        """
+        response = self._load_test_data("v1/api_subscription_list.json")
+        mocked_retrieve_fn.return_value = {
+            "email": "tester2@example.com",
+            "id": "cus_tester2",
+        }
+        stripe_api_update_subscriptions(test_data=response)
+        Subscription.objects.update(status="past_due")
+
+        response["data"][1]["status"] = "active"
+        stripe_api_update_subscriptions(test_data=response)
+
+        self.assertEqual(Subscription.objects.get(subscription_id="sub_0001").status, "past_due")
+        self.assertEqual(Subscription.objects.get(subscription_id="sub_0002").status, "active")
+
+    @patch('stripe.SubscriptionItem.list')
+    @patch('stripe.Customer.retrieve')
+    def test_update_subscriptions_items_pagination(self, mocked_retrieve_fn, mocked_item_list_fn):
+        """
+        Test subscription items not embedded in the subscription object are retrieved and saved.
+        """
+        response = self._load_test_data("v1/api_subscription_list.json")
+        mocked_retrieve_fn.return_value = {
+            "email": "tester2@example.com",
+            "id": "cus_tester2",
+        }
+        items = response["data"][0]["items"]
+        items["has_more"] = True
+        extra_item = {**items["data"][0], "id": "si_0001_extra", "quantity": 2}
+        mocked_item_list_fn.return_value = {"object": "list", "data": [extra_item], "has_more": False}
+
+        stripe_api_update_subscriptions(test_data=response)
+
+        self.assertEqual(mocked_item_list_fn.call_args.kwargs["subscription"], "sub_0001")
+        self.assertEqual(mocked_item_list_fn.call_args.kwargs["starting_after"], "si_0001")
+        self.assertEqual(set(SubscriptionItem.objects.filter(subscription_id="sub_0001").values_list(
+            "sub_item_id", flat=True)), {"si_0001", "si_0001_extra"})
+
+    @patch('stripe.SubscriptionItem.list')
+    @patch('stripe.Customer.retrieve')
+    def test_update_subscriptions_calls_stripe_outside_page_transaction(self, mocked_retrieve_fn,
+                                                                         mocked_item_list_fn):
+        """
+        Test customers and subscription items are retrieved from Stripe before the page's transaction is opened.
+        """
+        response = self._load_test_data("v1/api_subscription_list.json")
+        response["data"][0]["items"]["has_more"] = True
+        extra_item = {**response["data"][0]["items"]["data"][0], "id": "si_0001_extra"}
+
+        # the test case itself runs inside transactions, count only the ones opened by the sync. Stripe is called
+        # from worker threads, so the connection of the test's thread is captured.
+        test_connection = connections["default"]
+        atomic_blocks = len(test_connection.atomic_blocks)
+        atomic_blocks_in_calls = []
+
+        def retrieve(customer_id):
+            atomic_blocks_in_calls.append(len(test_connection.atomic_blocks))
+            return {"email": "tester2@example.com", "id": customer_id}
+
+        def list_items(**kwargs):
+            atomic_blocks_in_calls.append(len(test_connection.atomic_blocks))
+            return {"object": "list", "data": [extra_item], "has_more": False}
+
+        mocked_retrieve_fn.side_effect = retrieve
+        mocked_item_list_fn.side_effect = list_items
+
+        stripe_api_update_subscriptions(test_data=response)
+
+        self.assertTrue(atomic_blocks_in_calls)
+        self.assertEqual(set(atomic_blocks_in_calls), {atomic_blocks})
+        self.assertTrue(SubscriptionItem.objects.filter(sub_item_id="si_0001_extra").exists())
+
+    @patch('stripe.SubscriptionItem.list')
+    @patch('stripe.Customer.retrieve')
+    def test_update_subscriptions_shares_rate_limiter(self, mocked_retrieve_fn, mocked_item_list_fn):
+        """
+        Test customers and subscription items retrieved by successive syncs acquire tokens from one rate limiter.
+        """
+        response = self._load_test_data("v1/api_subscription_list.json")
+        response["data"][0]["items"]["has_more"] = True
+        mocked_retrieve_fn.return_value = {"email": "tester2@example.com", "id": "cus_tester2"}
+        mocked_item_list_fn.return_value = {"object": "list", "data": [], "has_more": False}
+
+        rate_limiter = get_shared_rate_limiter()
+        with patch.object(rate_limiter, "acquire", wraps=rate_limiter.acquire) as mocked_acquire:
+            stripe_api_update_subscriptions(test_data=response)
+            response["data"][0]["items"]["has_more"] = True
+            stripe_api_update_subscriptions(test_data=response)
+
+        # one missing customer, then the remaining items of one subscription in each sync
+        self.assertEqual(mocked_acquire.call_count, 3)
+        self.assertIs(get_shared_rate_limiter(), rate_limiter)
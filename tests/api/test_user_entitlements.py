@@ -0,0 +1,52 @@
+from django.core.management import call_command
+
+from drf_stripe.models import UserEntitlement
+from drf_stripe.stripe_api.products import stripe_api_update_products_prices
+from drf_stripe.stripe_webhooks.handler import handle_webhook_event
+from ..base import BaseTest
+
+
+class TestUserEntitlements(BaseTest):
+    def setUp(self) -> None:
+        self.setup_product_prices()
+        self.user, _ = self.setup_user_customer()
+        handle_webhook_event(self._load_test_data("2020-08-27/webhook_subscription_created.json"))
+
+    def _get_feature_ids(self):
+        return set(UserEntitlement.objects.filter(stripe_user_id=self.user.id).values_list("feature_id", flat=True))
+
+    def test_subscription_webhooks_maintain_entitlements(self):
+        """
+        Test entitlement rows are created for a new subscription and removed when it is canceled.
+        """
+        self.assertEqual(self._get_feature_ids(), {"A", "B", "D"})
+        entitlement = UserEntitlement.objects.get(stripe_user_id=self.user.id, feature_id="A")
+        self.assertEqual(entitlement.access_until, self.user.stripe_user.subscriptions.get().period_end)
+
+        handle_webhook_event(self._load_test_data("2020-08-27/webhook_subscription_updated_cancel_immediate.json"))
+
+        self.assertEqual(self._get_feature_ids(), set())
+
+    def test_product_features_change_updates_entitlements(self):
+        """
+        Test entitlement rows of subscribers are updated when features linked to a product change.
+        """
+        products = self._load_test_data("v1/api_product_list.json")
+        for product in products["data"]:
+            if product["id"] == "prod_KxfXRXOd7dnLbz":
+                product["metadata"]["features"] = "A E"
+        stripe_api_update_products_prices(test_products=products,
+                                          test_prices=self._load_test_data("v1/api_price_list.json"))
+
+        self.assertEqual(self._get_feature_ids(), {"A", "E"})
+
+    def test_rebuild_entitlements(self):
+        """
+        Test the rebuild command restores missing and removes stale entitlement rows.
+        """
+        UserEntitlement.objects.filter(feature_id="A").delete()
+        UserEntitlement.objects.create(stripe_user_id=self.user.id, feature_id="C")
+
+        call_command("rebuild_stripe_entitlements", batch_size=1)
+
+        self.assertEqual(self._get_feature_ids(), {"A", "B", "D"})
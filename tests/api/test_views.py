@@ -0,0 +1,50 @@
+from rest_framework.test import APIClient
+
+from drf_stripe.models import Price, SubscriptionItem
+from drf_stripe.stripe_webhooks.handler import handle_webhook_event
+from ..base import BaseTest
+
+
+class TestListViews(BaseTest):
+    def setUp(self) -> None:
+        self.setup_product_prices()
+        self.user, _ = self.setup_user_customer()
+        handle_webhook_event(self._load_test_data("2020-08-27/webhook_subscription_created.json"))
+        self.client = APIClient()
+
+    def _add_subscription_items(self, count):
+        subscription_item = SubscriptionItem.objects.get()
+        SubscriptionItem.objects.bulk_create([
+            SubscriptionItem(sub_item_id=f"si_extra_{i}", subscription_id=subscription_item.subscription_id,
+                             price_id=price_id, quantity=1)
+            for i, price_id in enumerate(Price.objects.values_list("price_id", flat=True)[:count])
+        ])
+
+    def test_subscription_items_queries(self):
+        """
+        Test subscription items are listed with their product features in a constant number of queries.
+        """
+        self.client.force_authenticate(self.user)
+        with self.assertNumQueries(2):
+            response = self.client.get("/stripe/my-subscription-items/")
+        self.assertEqual(len(response.data), 1)
+        self.assertEqual({service["feature_id"] for service in response.data[0]["services"]}, {"A", "B", "D"})
+
+        self._add_subscription_items(3)
+        with self.assertNumQueries(2):
+            response = self.client.get("/stripe/my-subscription-items/")
+        self.assertEqual(len(response.data), 4)
+
+    def test_subscribable_product_queries(self):
+        """
+        Test subscribable prices are listed with their product features in a constant number of queries.
+        """
+        with self.assertNumQueries(2):
+            response = self.client.get("/stripe/subscribable-product/")
+        self.assertTrue(response.data)
+        self.assertTrue(all(price["services"] for price in response.data))
+
+        self.client.force_authenticate(self.user)
+        with self.assertNumQueries(2):
+            response = self.client.get("/stripe/subscribable-product/")
+        self.assertNotIn("prod_KxfXRXOd7dnLbz", {price["product_id"] for price in response.data})
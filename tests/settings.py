@@ -1,3 +1,6 @@
+import os
+import tempfile
+
 ADMINS = ()
 
 MANAGERS = ADMINS
@@ -19,6 +22,17 @@ REST_FRAMEWORK = {
     ),
 }
 
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.dummy.DummyCache",
+    },
+    # shared between processes, used by tests of the entitlement cache and the catalog snapshot
+    "shared": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": os.path.join(tempfile.gettempdir(), "drf_stripe_tests_cache"),
+    },
+}
+
 ALLOWED_HOSTS = []
 
 TIME_ZONE = "UTC"
@@ -0,0 +1,121 @@
+import hashlib
+import hmac
+import json
+import time
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.core.management import call_command
+from django.db import connections
+from django.test import override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+from stripe.error import SignatureVerificationError
+
+from drf_stripe.models import Subscription, SubscriptionItem, WebhookEvent
+from ..base import BaseTest
+
+WEBHOOK_SECRET = "whsec_test"
+
+
+class TestWebhookInbox(BaseTest):
+
+    def setUp(self) -> None:
+        self.setup_product_prices()
+        self.user, self.stripe_user = self.setup_user_customer()
+
+    def post_webhook_event(self, file_name):
+        payload = json.dumps(self._load_test_data(file_name))
+        timestamp = int(time.time())
+        signature = hmac.new(WEBHOOK_SECRET.encode("utf-8"), f"{timestamp}.{payload}".encode("utf-8"),
+                             hashlib.sha256).hexdigest()
+        return APIClient().post("/stripe/webhook/", data=payload, content_type="application/json",
+                                HTTP_STRIPE_SIGNATURE=f"t={timestamp},v1={signature}")
+
+    @override_settings(DRF_STRIPE={"STRIPE_WEBHOOK_SECRET": WEBHOOK_SECRET})
+    def test_webhook_event_handled_in_request(self):
+        """Events are verified and handled by the webhook endpoint when the inbox is disabled."""
+        response = self.post_webhook_event("2020-08-27/webhook_subscription_created.json")
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(WebhookEvent.objects.exists())
+        Subscription.objects.get(subscription_id="sub_1KHlYHL14ex1CGCiIBo8Xk5p")
+
+    @override_settings(DRF_STRIPE={"STRIPE_WEBHOOK_SECRET": "whsec_other"})
+    def test_webhook_event_with_invalid_signature(self):
+        """Events signed with another secret are rejected."""
+        with self.assertRaises(SignatureVerificationError):
+            self.post_webhook_event("2020-08-27/webhook_subscription_created.json")
+        self.assertFalse(Subscription.objects.exists())
+
+    @override_settings(DRF_STRIPE={"STRIPE_WEBHOOK_SECRET": WEBHOOK_SECRET, "WEBHOOK_INBOX_ENABLED": True})
+    def test_webhook_event_stored_then_processed(self):
+        """Events are stored by the webhook endpoint and applied by the worker command."""
+        response = self.post_webhook_event("2020-08-27/webhook_subscription_created.json")
+        self.assertEqual(response.status_code, 200)
+
+        # event is stored but not yet applied
+        webhook_event = WebhookEvent.objects.get(event_id="evt_1KHlYKL14ex1CGCi10K7ohSd")
+        self.assertEqual(webhook_event.event_type, "customer.subscription.created")
+        self.assertIsNone(webhook_event.processed_at)
+        self.assertFalse(Subscription.objects.filter(subscription_id="sub_1KHlYHL14ex1CGCiIBo8Xk5p").exists())
+
+        # redelivery of the same event is stored only once
+        self.post_webhook_event("2020-08-27/webhook_subscription_created.json")
+        self.assertEqual(WebhookEvent.objects.count(), 1)
+
+        call_command("process_stripe_webhooks")
+
+        webhook_event.refresh_from_db()
+        self.assertIsNotNone(webhook_event.processed_at)
+        self.assertEqual(webhook_event.attempts, 1)
+        Subscription.objects.get(subscription_id="sub_1KHlYHL14ex1CGCiIBo8Xk5p")
+
+    @override_settings(DRF_STRIPE={"STRIPE_WEBHOOK_SECRET": WEBHOOK_SECRET, "WEBHOOK_INBOX_ENABLED": True})
+    def test_failed_webhook_event_is_retried_up_to_max_attempts(self):
+        """A failing event keeps its error, is retried after a backoff, and stops being retried after max attempts."""
+        self.post_webhook_event("2020-08-27/webhook_subscription_created.json")
+        self.stripe_user.delete()
+
+        call_command("process_stripe_webhooks", max_attempts=3, retry_delay=60)
+        webhook_event = WebhookEvent.objects.get(event_id="evt_1KHlYKL14ex1CGCi10K7ohSd")
+        self.assertEqual(webhook_event.attempts, 1)
+        self.assertGreater(webhook_event.next_attempt_at, timezone.now() + timedelta(seconds=50))
+
+        # not retried before its next attempt time
+        call_command("process_stripe_webhooks", max_attempts=3)
+        webhook_event.refresh_from_db()
+        self.assertEqual(webhook_event.attempts, 1)
+
+        for _ in range(3):
+            WebhookEvent.objects.update(next_attempt_at=timezone.now())
+            call_command("process_stripe_webhooks", max_attempts=3)
+
+        webhook_event.refresh_from_db()
+        self.assertIsNone(webhook_event.processed_at)
+        self.assertEqual(webhook_event.attempts, 3)
+        self.assertIn("DoesNotExist", webhook_event.last_error)
+
+    @patch('stripe.SubscriptionItem.list')
+    def test_webhook_event_prepared_before_inbox_lock(self, mocked_item_list_fn):
+        """Remaining subscription items are retrieved before the inbox row is locked."""
+        event = self._load_test_data("2020-08-27/webhook_subscription_created.json")
+        event["data"]["object"]["items"]["has_more"] = True
+        extra_item = {**event["data"]["object"]["items"]["data"][0], "id": "si_extra"}
+        WebhookEvent.objects.create(event_id=event["id"], event_type=event["type"], payload=json.dumps(event))
+
+        # Stripe is called from worker threads, so the connection of the test's thread is captured
+        test_connection = connections["default"]
+        atomic_blocks = len(test_connection.atomic_blocks)
+        atomic_blocks_in_calls = []
+
+        def list_items(**kwargs):
+            atomic_blocks_in_calls.append(len(test_connection.atomic_blocks))
+            return {"object": "list", "data": [extra_item], "has_more": False}
+
+        mocked_item_list_fn.side_effect = list_items
+
+        call_command("process_stripe_webhooks")
+
+        self.assertEqual(atomic_blocks_in_calls, [atomic_blocks])
+        self.assertIsNotNone(WebhookEvent.objects.get(event_id=event["id"]).processed_at)
+        self.assertTrue(SubscriptionItem.objects.filter(sub_item_id="si_extra").exists())
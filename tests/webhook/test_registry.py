@@ -0,0 +1,54 @@
+from drf_stripe.models import ProcessedEvent
+from drf_stripe.stripe_models.event import StripeGenericEvent, StripeSubscriptionEvent
+from drf_stripe.stripe_webhooks.handler import handle_webhook_event
+from drf_stripe.stripe_webhooks.registry import register_webhook_event_handler, unregister_webhook_event_handler
+from ..base import BaseTest
+
+
+class TestWebhookEventRegistry(BaseTest):
+
+    def setUp(self) -> None:
+        self.setup_product_prices()
+        self.setup_user_customer()
+        self.received_events = []
+
+    def _record_event(self, event):
+        self.received_events.append(event)
+
+    def test_unregistered_event_type_ignored(self):
+        """Event types without handlers are ignored without any database access"""
+        event = self._load_test_data("2020-08-27/webhook_subscription_created.json")
+        event["type"] = "invoice.paid"
+
+        with self.assertNumQueries(0):
+            handle_webhook_event(event)
+
+        self.assertFalse(ProcessedEvent.objects.exists())
+
+    def test_custom_event_handler(self):
+        """Handlers registered by applications are called with the parsed event"""
+        event = self._load_test_data("2020-08-27/webhook_subscription_created.json")
+        event["type"] = "invoice.paid"
+
+        register_webhook_event_handler("invoice.paid")(self._record_event)
+        try:
+            handle_webhook_event(event)
+        finally:
+            unregister_webhook_event_handler(self._record_event)
+
+        self.assertEqual(len(self.received_events), 1)
+        self.assertIsInstance(self.received_events[0], StripeGenericEvent)
+        self.assertEqual(self.received_events[0].id, "evt_1KHlYKL14ex1CGCi10K7ohSd")
+
+    def test_additional_handler_for_implemented_event_type(self):
+        """Handlers can be added to event types that are already handled by drf-stripe"""
+        event = self._load_test_data("2020-08-27/webhook_subscription_created.json")
+
+        register_webhook_event_handler("customer.subscription.created",
+                                       event_model=StripeSubscriptionEvent)(self._record_event)
+        try:
+            handle_webhook_event(event)
+        finally:
+            unregister_webhook_event_handler(self._record_event)
+
+        self.assertEqual(self.received_events[0].data.object.id, "sub_1KHlYHL14ex1CGCiIBo8Xk5p")
@@ -1,4 +1,11 @@
-from drf_stripe.models import Subscription, SubscriptionItem
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.core.management import call_command
+from django.db import connections
+from django.utils import timezone
+
+from drf_stripe.models import Subscription, SubscriptionItem, ProcessedEvent
 from drf_stripe.stripe_webhooks.handler import handle_webhook_event
 from ..base import BaseTest
 
@@ -87,3 +94,112 @@ class TestWebhookSubscriptionEvents(BaseTest):
 
         subscription = Subscription.objects.get(subscription_id="sub_1KHlYHL14ex1CGCiIBo8Xk5p")
         self.assertIsNotNone(subscription.ended_at)
+
+    def test_event_handler_duplicate_event_ignored(self):
+        """Mock the same event being delivered again after the subscription has changed"""
+        self.create_subscription()
+        event = self._load_test_data("2020-08-27/webhook_subscription_updated_cancel_immediate.json")
+        handle_webhook_event(event)
+
+        # redelivery of the creation event should not revert the subscription
+        self.create_subscription()
+
+        subscription = Subscription.objects.get(subscription_id="sub_1KHlYHL14ex1CGCiIBo8Xk5p")
+        self.assertIsNotNone(subscription.ended_at)
+        self.assertEqual(ProcessedEvent.objects.count(), 2)
+
+    def test_prune_processed_events(self):
+        """Processed event records older than retention period are deleted"""
+        self.create_subscription()
+        ProcessedEvent.objects.update(processed_at=timezone.now() - timedelta(days=31))
+
+        call_command("prune_stripe_events", days=30)
+        self.assertEqual(ProcessedEvent.objects.count(), 0)
+
+    def test_event_handler_stale_event_ignored(self):
+        """Mock an older subscription event arriving after a newer one"""
+        self.create_subscription()
+        event = self._load_test_data("2020-08-27/webhook_subscription_updated_cancel_immediate.json")
+        handle_webhook_event(event)
+        sub_item_ids = set(SubscriptionItem.objects.values_list("sub_item_id", flat=True))
+
+        event = self._load_test_data("2020-08-27/webhook_subscription_updated_billing_frequency.json")
+        handle_webhook_event(event)
+
+        subscription = Subscription.objects.get(subscription_id="sub_1KHlYHL14ex1CGCiIBo8Xk5p")
+        self.assertIsNotNone(subscription.ended_at)
+        self.assertEqual(int(subscription.last_event_at.timestamp()), 1642152635)
+        self.assertEqual(set(SubscriptionItem.objects.values_list("sub_item_id", flat=True)), sub_item_ids)
+
+    @patch('stripe.SubscriptionItem.list')
+    def test_event_handler_stale_event_items_not_retrieved(self, mocked_item_list_fn):
+        """Mock an older subscription event with more items than embedded arriving after a newer one"""
+        self.create_subscription()
+        event = self._load_test_data("2020-08-27/webhook_subscription_updated_cancel_immediate.json")
+        handle_webhook_event(event)
+
+        event = self._load_test_data("2020-08-27/webhook_subscription_updated_billing_frequency.json")
+        event["data"]["object"]["items"]["has_more"] = True
+        handle_webhook_event(event)
+
+        mocked_item_list_fn.assert_not_called()
+
+    @patch('stripe.SubscriptionItem.list')
+    def test_event_handler_items_retrieved_outside_ledger_transaction(self, mocked_item_list_fn):
+        """Mock a subscription event with more items than embedded, the remaining items are retrieved before the
+        transaction recording the event is opened"""
+        event = self._load_test_data("2020-08-27/webhook_subscription_created.json")
+        event["data"]["object"]["items"]["has_more"] = True
+        extra_item = {**event["data"]["object"]["items"]["data"][0], "id": "si_extra"}
+
+        # the test case itself runs inside transactions, count only the ones opened by the handler. Stripe is called
+        # from worker threads, so the connection of the test's thread is captured.
+        test_connection = connections["default"]
+        atomic_blocks = len(test_connection.atomic_blocks)
+        atomic_blocks_in_calls = []
+
+        def list_items(**kwargs):
+            atomic_blocks_in_calls.append(len(test_connection.atomic_blocks))
+            return {"object": "list", "data": [extra_item], "has_more": False}
+
+        mocked_item_list_fn.side_effect = list_items
+
+        handle_webhook_event(event)
+
+        self.assertEqual(atomic_blocks_in_calls, [atomic_blocks])
+        self.assertTrue(SubscriptionItem.objects.filter(sub_item_id="si_extra").exists())
+        self.assertEqual(ProcessedEvent.objects.count(), 1)
+
+    def test_event_handler_unchanged_subscription_skipped(self):
+        """Mock a newer event carrying the same subscription state, the row should not be written"""
+        self.create_subscription()
+        Subscription.objects.update(status="past_due")
+
+        event = self._load_test_data("2020-08-27/webhook_subscription_created.json")
+        event["id"] = "evt_unchanged"
+        event["created"] += 60
+        handle_webhook_event(event)
+
+        subscription = Subscription.objects.get(subscription_id="sub_1KHlYHL14ex1CGCiIBo8Xk5p")
+        self.assertEqual(subscription.status, "past_due")
+        self.assertEqual(ProcessedEvent.objects.count(), 2)
+
+    def test_event_handler_unchanged_event_still_orders_events(self):
+        """
+        Mock event X@10 applied, X@30 skipped as unchanged, then a delayed Y@20: Y is older than X@30 and is ignored.
+        """
+        self.create_subscription()
+        event = self._load_test_data("2020-08-27/webhook_subscription_created.json")
+        created = event["created"]
+
+        event["id"] = "evt_unchanged"
+        event["created"] = created + 20
+        handle_webhook_event(event)
+
+        event = self._load_test_data("2020-08-27/webhook_subscription_updated_cancel_immediate.json")
+        event["created"] = created + 10
+        handle_webhook_event(event)
+
+        subscription = Subscription.objects.get(subscription_id="sub_1KHlYHL14ex1CGCiIBo8Xk5p")
+        self.assertIsNone(subscription.ended_at)
+        self.assertEqual(int(subscription.last_event_at.timestamp()), created + 20)